@@ -1,32 +1,531 @@
 # coding: utf-8
+import time
+import dask.array as da
+import numpy as np
 import s3fs
 import xarray as xr
+import zarr
+from utils import truncate_zarr, trim_to_time_done, get_nldas_grid_no
+from rechunk_nldas import is_complete_cell_major
+import pandas as pd
+from sparse_weights import is_sparse_weights, triplets_to_dense, \
+    triplets_to_csr, dense_to_csr
 
+aggregation_stats = ('sum', 'mean', 'min', 'max')
+# how each of the nldas forcing variables is aggregated in time. variables
+# that are not listed are averaged
+nldas_aggregation = {'apcpsfc': ['sum'],
+                     'pevapsfc': ['sum'],
+                     'tmp2m': ['mean', 'min', 'max'],
+                     'spfh2m': ['mean'],
+                     'pressfc': ['mean'],
+                     'ugrd10m': ['mean'],
+                     'vgrd10m': ['mean'],
+                     'dlwrfsfc': ['mean'],
+                     'dswrfsfc': ['mean'],
+                     'cape180_0mb': ['mean', 'max'],
+                     'convfracsfc': ['mean']}
 
-def apply_nldas_weight_grid(weight_grid_zarr, dataset_zarr, out_store):
+
+def csr_dot_blocks(csr, data, normalize=False):
+    """
+    multiply a CSR weight matrix against the last (grid cell) axis of an array
+    (e.g., time x grid cell or variable x time x grid cell). if the array is a
+    dask array, each block is multiplied separately
+    :param csr: [scipy CSR matrix] weight matrix (catchment x grid cell)
+    :param data: [numpy or dask array] forcing data (... x grid cell)
+    :param normalize: [bool] if True, NaNs are skipped and the weighted sum is
+    divided by the sum of the weights of the non-NaN cells. the valid weights
+    are summed in the same multiply as the data
+    :return: [numpy or dask array] weighted data (... x catchment)
+    """
+    def multiply_block(block):
+        flat = block.reshape(-1, block.shape[-1])
+        if normalize:
+            valid = ~np.isnan(flat)
+            flat = np.concatenate([np.where(valid, flat, 0),
+                                   valid.astype(flat.dtype)])
+        weighted = np.asarray((csr @ flat.T).T)
+        if normalize:
+            weighted_sum, valid_weight = np.split(weighted, 2)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                weighted = np.where(valid_weight > 0,
+                                    weighted_sum / valid_weight, np.nan)
+        return weighted.reshape(block.shape[:-1] + (csr.shape[0],))
+
+    if isinstance(data, da.Array):
+        # all the grid cells of a block need to be in one block
+        data = data.rechunk({data.ndim - 1: -1})
+        return data.map_blocks(multiply_block,
+                               chunks=data.chunks[:-1] + ((csr.shape[0],),),
+                               dtype=np.result_type(data.dtype, csr.dtype))
+    return multiply_block(data)
+
+
+def apply_weights_csr(csr, comids, var_array, normalize=False):
+    """
+    apply a CSR weight matrix to a stacked forcing variable (or several
+    variables stacked along a 'variable' dimension). only the grid cells that
+    have a nonzero weight are used, so the cost scales with the number of
+    nonzero weights instead of the size of the grid
+    :param csr: [scipy CSR matrix] weight matrix (catchment x grid cell)
+    :param comids: [array-like] the comids for the rows of the weight matrix
+    :param var_array: [xarray DataArray] forcing data with dims 'time' and
+    'nldas_grid_no' (and optionally 'variable')
+    :param normalize: [bool] if True, divide by the sum of the weights of the
+    non-NaN cells instead of treating NaNs as zeros
+    :return: [xarray DataArray] weighted data with dims ('variable'),
+    'nhd_comid' and 'time'
+    """
+    used_cells = np.unique(csr.indices)
+    csr_used = csr[:, used_cells]
+    var_array = var_array.isel(nldas_grid_no=used_cells)
+    other_dims = [d for d in var_array.dims if d != 'nldas_grid_no']
+    var_array = var_array.transpose(*other_dims, 'nldas_grid_no')
+    if not normalize:
+        var_array = var_array.fillna(0)
+    weighted = csr_dot_blocks(csr_used, var_array.data, normalize)
+    coords = [(d, var_array[d].values) for d in other_dims]
+    weighted = xr.DataArray(weighted, coords + [('nhd_comid', comids)])
+    out_dims = [d for d in other_dims if d != 'time'] + ['nhd_comid', 'time']
+    return weighted.transpose(*out_dims)
+
+
+def read_weights(weight_grid_zarr, backend='dense'):
+    """
+    read the weight grid in the form the backend uses
+    :param weight_grid_zarr: [str] path to the weight grid zarr store (dense or
+    sparse format)
+    :param backend: [str] 'dense' or 'sparse'
+    :return: [xarray DataArray or tuple] the dense weights or a tuple of the
+    (CSR weight matrix, comids)
+    """
+    if backend not in ('dense', 'sparse'):
+        raise ValueError("backend should be 'dense' or 'sparse'")
     ds = xr.open_zarr(weight_grid_zarr)
-    ds_nldas = xr.open_zarr(dataset_zarr)
+    if backend == 'sparse':
+        if is_sparse_weights(ds):
+            return triplets_to_csr(ds)
+        return dense_to_csr(ds.weight)
+    if is_sparse_weights(ds):
+        return triplets_to_dense(ds)
+    return ds.weight
+
+
+def get_num_grid_cells(weights, backend='dense'):
+    if backend == 'sparse':
+        csr, comids = weights
+        return csr.shape[1]
+    return len(weights.nldas_grid_no)
+
+
+def get_used_cells(weights, backend='dense'):
+    """
+    get the nldas_grid_no of the grid cells that have a nonzero weight
+    """
+    if backend == 'sparse':
+        csr, comids = weights
+        return np.unique(csr.indices)
+    used = (weights != 0).any('nhd_comid').values
+    return weights.nldas_grid_no.values[used]
+
+
+def check_cells_in_nldas(grid_no, weights, backend='dense'):
+    """
+    make sure that all of the grid cells with weights are in the nldas data
+    (e.g., that a store pulled for a bbox covers the weight grid)
+    :param grid_no: [array-like] the nldas_grid_no of the cells in the data
+    :param weights: [xarray DataArray or tuple] weights from read_weights
+    :param backend: [str] 'dense' or 'sparse'
+    :return: None
+    """
+    missing = np.setdiff1d(get_used_cells(weights, backend), grid_no)
+    if len(missing):
+        raise ValueError(f"{len(missing)} grid cells with weights (e.g., "
+                         f"nldas_grid_no {missing[0]}) are not in the nldas "
+                         f"data. the bbox it was pulled for may not cover the "
+                         f"weight grid")
+
+
+def reindex_grid_no(ds_nldas_st, num_grid_cells):
+    """
+    reindex stacked nldas data from a bbox subset to all of the cells of the
+    weight grid. the cells outside of the subset are NaN
+    """
+    return ds_nldas_st.reindex(nldas_grid_no=np.arange(num_grid_cells))
+
+
+def stack_nldas(ds_nldas, num_grid_cells):
+    """
+    stack the lat and lon of the nldas data into one 'nldas_grid_no' dimension
+    numbered the same way as the weight grid. the cells of a store pulled for
+    a bbox keep their numbers in the full grid (see utils.get_nldas_grid_no)
+    """
+    if 'nldas_row' not in ds_nldas.variables:
+        ds_nldas_st = ds_nldas.stack(nldas_grid_no=['lat', 'lon'])
+        return ds_nldas_st.assign_coords(nldas_grid_no=range(num_grid_cells))
+    grid_no = get_nldas_grid_no(ds_nldas)
+    ds_nldas = ds_nldas.drop_vars(['nldas_row', 'nldas_col'])
     ds_nldas_st = ds_nldas.stack(nldas_grid_no=['lat', 'lon'])
-    ds_nldas_st = ds_nldas_st.assign_coords(nldas_grid_no=range(len(ds.nldas_grid_no)))
-    w = ds.weight
+    ds_nldas_st = ds_nldas_st.assign_coords(nldas_grid_no=grid_no)
+    return reindex_grid_no(ds_nldas_st, num_grid_cells)
+
+
+def estimate_bytes_read(ds_nldas, used_cells):
+    """
+    estimate the bytes of zarr chunks that have to be read to get all of the
+    time steps of the used grid cells of one variable
+    :param ds_nldas: [xarray dataset] the nldas data, either time-major (lat
+    and lon dimensions) or cell-major (nldas_grid_no dimension)
+    :param used_cells: [array-like] the grid cells with nonzero weights
+    :return: [int] estimated bytes read
+    """
+    var = ds_nldas[list(ds_nldas.data_vars)[0]]
+    chunk_sizes = {dim: c[0] for dim, c in zip(var.dims, var.chunks)}
+    chunk_bytes = np.prod(list(chunk_sizes.values())) * var.dtype.itemsize
+    num_time_chunks = len(var.chunks[var.dims.index('time')])
+    # where the cells are in the data (a bbox subset keeps the full-grid
+    # numbers, so they are not the same as the positions)
+    if 'nldas_grid_no' in var.dims:
+        grid_no = ds_nldas['nldas_grid_no'].values
+    else:
+        grid_no = get_nldas_grid_no(ds_nldas)
+    used_cells = pd.Index(grid_no).get_indexer(np.asarray(used_cells))
+    if 'nldas_grid_no' in var.dims:
+        chunk_ids = used_cells // chunk_sizes['nldas_grid_no']
+    else:
+        lat_idx, lon_idx = np.divmod(used_cells, ds_nldas.sizes['lon'])
+        num_lon_chunks = len(var.chunks[var.dims.index('lon')])
+        chunk_ids = lat_idx // chunk_sizes['lat'] * num_lon_chunks + \
+            lon_idx // chunk_sizes['lon']
+    return len(np.unique(chunk_ids)) * num_time_chunks * chunk_bytes
+
+
+def open_nldas(dataset_zarr, weights, backend='dense', cell_major_zarr=None):
+    """
+    open the nldas data stacked by grid cell. if a complete cell-major copy of
+    the data (see rechunk_nldas.py) with the same time steps is given and the
+    weights are sparse, the layout that needs fewer bytes read for the cells
+    with weights is used
+    :param dataset_zarr: [str] path to the (time-major) nldas zarr store
+    :param weights: [xarray DataArray or tuple] weights from read_weights
+    :param backend: [str] 'dense' or 'sparse'
+    :param cell_major_zarr: [str] path to the cell-major copy or None
+    :return: [xarray dataset] the stacked nldas data
+    """
+    ds_nldas = trim_to_time_done(xr.open_zarr(dataset_zarr))
+    num_grid_cells = get_num_grid_cells(weights, backend)
+    is_subset = 'nldas_row' in ds_nldas.variables
+    if is_subset:
+        check_cells_in_nldas(get_nldas_grid_no(ds_nldas), weights, backend)
+    if backend == 'sparse' and cell_major_zarr:
+        ds_cell = xr.open_zarr(cell_major_zarr)
+        same_times = ds_cell.sizes['time'] == ds_nldas.sizes['time'] and \
+            (ds_cell.time.values == ds_nldas.time.values).all()
+        if is_complete_cell_major(ds_cell) and not same_times:
+            print("the time steps of the cell-major copy do not match the "
+                  "nldas data (it may need to be rechunked again). using the "
+                  "time-major nldas data", flush=True)
+        elif is_complete_cell_major(ds_cell):
+            used_cells = get_used_cells(weights, backend)
+            time_major_bytes = estimate_bytes_read(ds_nldas, used_cells)
+            cell_major_bytes = estimate_bytes_read(ds_cell, used_cells)
+            print(f"estimated MB read per variable, time-major: "
+                  f"{time_major_bytes / 1e6:.1f}, cell-major: "
+                  f"{cell_major_bytes / 1e6:.1f}", flush=True)
+            if cell_major_bytes < time_major_bytes:
+                print("using the cell-major nldas data", flush=True)
+                ds_cell = ds_cell.drop_vars(['lat', 'lon'])
+                if is_subset:
+                    ds_cell = reindex_grid_no(ds_cell, num_grid_cells)
+                return ds_cell
+    return stack_nldas(ds_nldas, num_grid_cells)
+
+
+def weight_variables(ds_nldas_st, weights, backend='dense', fused=False,
+                     normalize=False):
+    """
+    apply the weights to all of the forcing variables in the stacked nldas
+    dataset
+    :param ds_nldas_st: [xarray dataset] the stacked nldas data
+    :param weights: [xarray DataArray or tuple] weights from read_weights
+    :param backend: [str] 'dense' or 'sparse'
+    :param fused: [bool] if True, stack all of the variables into one
+    (variable, time, grid cell) array so each block of nldas data is read once
+    and the weights are applied to all variables in one multiply instead of
+    one multiply per variable
+    :param normalize: [bool] if True, NaN cells are left out and the weighted
+    sum is divided by the weights of the valid cells (see weight_variable)
+    :return: [xarray dataset] the weighted data (nhd_comid x time)
+    """
+    var_names = list(ds_nldas_st.data_vars)
+    if fused:
+        var_array = ds_nldas_st[var_names].to_array('variable')
+        if var_array.chunks:
+            var_array = var_array.chunk({'variable': len(var_names)})
+        return weight_variable(var_array, weights, backend,
+                               normalize).to_dataset('variable')
     data_dict = {}
-    for var_name in ds_nldas_st._variables:
-        if var_name not in ('time', 'nldas_grid_no'):
-            var_array = ds_nldas_st[var_name]
-            var_array = var_array.fillna(0)
-            var_array = w.dot(var_array)
-            data_dict[var_name] = var_array
-    weigheted_ds = xr.Dataset(data_dict)
-    weigheted_ds.to_zarr(out_store)
+    for var_name in var_names:
+        data_dict[var_name] = weight_variable(ds_nldas_st[var_name], weights,
+                                              backend, normalize)
+    return xr.Dataset(data_dict)
+
+
+def weight_variable(var_array, weights, backend='dense', normalize=False):
+    """
+    apply the weights to one (or a 'variable' stack of) forcing variables
+    :param var_array: [xarray DataArray] the stacked nldas data
+    :param weights: [xarray DataArray or tuple] weights from read_weights
+    :param backend: [str] 'dense' or 'sparse'
+    :param normalize: [bool] if False, NaNs are treated as zeros, which biases
+    catchments that are partly over missing cells (e.g., on the coast) low. if
+    True, the weighted sum is divided by the sum of the weights of the non-NaN
+    cells, giving the area-weighted mean over the valid part of the catchment
+    (NaN if there is none)
+    :return: [xarray DataArray] the weighted data
+    """
+    if backend == 'sparse':
+        csr, comids = weights
+        return apply_weights_csr(csr, comids, var_array, normalize)
+    if not normalize:
+        var_array = var_array.fillna(0)
+        return weights.dot(var_array)
+    # weight the data and the valid-cell mask with one dot product
+    valid = var_array.notnull().astype(var_array.dtype)
+    stacked = xr.concat([var_array.fillna(0), valid], dim='weight_sum')
+    weighted = weights.dot(stacked)
+    valid_weight = weighted.isel(weight_sum=1)
+    return weighted.isel(weight_sum=0) / valid_weight.where(valid_weight > 0)
+
+
+def get_time_blocks(num_times, time_block, start=0):
+    """
+    get the time slices that the nldas data will be processed in
+    :param num_times: [int] the total number of time steps
+    :param time_block: [int] the number of time steps per block
+    :param start: [int] the time step to start from
+    :return: [list] time slices
+    """
+    return [slice(i, min(i + time_block, num_times))
+            for i in range(start, num_times, time_block)]
+
+
+def get_period_time_blocks(times, freq, time_block, start=0):
+    """
+    get time slices of about time_block time steps that only break between
+    aggregation periods, so no period is split across two blocks
+    :param times: [array-like] the datetimes of the data
+    :param freq: [str] pandas frequency of the aggregation periods (e.g., 'D')
+    :param time_block: [int] the minimum number of time steps per block (the
+    last block can be shorter)
+    :param start: [int] the time step to start from (should be the start of a
+    block)
+    :return: [list] time slices
+    """
+    period_starts = get_period_starts(times, freq)
+    bounds = [period_starts[0]]
+    for period_start in period_starts[1:]:
+        if period_start - bounds[-1] >= time_block:
+            bounds.append(period_start)
+    bounds.append(len(times))
+    return [slice(int(b_start), int(b_end))
+            for b_start, b_end in zip(bounds[:-1], bounds[1:])
+            if b_start >= start]
+
+
+def get_period_starts(times, freq):
+    """
+    get the positions of the first time step of each aggregation period
+    :param times: [array-like] the datetimes of the data
+    :param freq: [str] pandas frequency of the aggregation periods
+    :return: [numpy array] positions of the first time step of each period
+    """
+    positions = pd.Series(np.arange(len(times)), index=pd.DatetimeIndex(times))
+    return positions.resample(freq).first().dropna().astype(int).values
+
+
+def get_num_out_times(times, freq=None):
+    """
+    get the number of output time steps for the input times
+    :param times: [array-like] the datetimes of the input data
+    :param freq: [str] pandas frequency of the aggregation periods or None if
+    the data are not aggregated
+    :return: [int] number of output time steps
+    """
+    if not freq or len(times) == 0:
+        return len(times)
+    return len(get_period_starts(times, freq))
+
+
+def aggregate_time(ds, freq, aggregation=None):
+    """
+    aggregate the (weighted) data in time. each output variable is named
+    [variable]_[stat] (e.g., apcpsfc_sum, tmp2m_max)
+    :param ds: [xarray dataset] data with a time dimension
+    :param freq: [str] pandas frequency to aggregate to (e.g., 'D' for daily)
+    :param aggregation: [dict] the stats to calculate for each variable, e.g.,
+    {'apcpsfc': ['sum'], 'tmp2m': ['mean', 'min', 'max']}. variables that are
+    not in the dict are averaged. defaults to nldas_aggregation
+    :return: [xarray dataset] the aggregated data
+    """
+    if aggregation is None:
+        aggregation = nldas_aggregation
+    data_dict = {}
+    for var_name in ds.data_vars:
+        stats = aggregation.get(var_name, ['mean'])
+        if isinstance(stats, str):
+            stats = [stats]
+        resampled = ds[var_name].resample(time=freq)
+        for stat in stats:
+            if stat not in aggregation_stats:
+                raise ValueError(f"aggregation stat should be one of "
+                                 f"{aggregation_stats}")
+            if stat == 'sum':
+                # so a period with no valid data is NaN, not zero
+                aggregated = resampled.sum(min_count=1)
+            else:
+                aggregated = getattr(resampled, stat)()
+            data_dict[f'{var_name}_{stat}'] = aggregated
+    return xr.Dataset(data_dict)
+
+
+def get_time_steps_done(out_store):
+    """
+    get the number of (input) time steps that are done in the output zarr
+    store of a streamed run
+    :param out_store: [str or s3fsMap] the output zarr store
+    :return: [int] number of time steps done
+    """
+    try:
+        ds = xr.open_zarr(out_store)
+    except (ValueError, KeyError, FileNotFoundError):
+        return 0
+    return ds.attrs.get('time_steps_done', 0)
+
+
+def record_time_steps_done(out_store, time_steps_done):
+    z = zarr.open_group(out_store, mode='a')
+    z.attrs['time_steps_done'] = time_steps_done
+    zarr.consolidate_metadata(out_store)
+
+
+def apply_nldas_weight_grid_blocks(weights, ds_nldas_st, out_store,
+                                   backend='dense', time_block=None,
+                                   fused=False, normalize=False, freq=None,
+                                   aggregation=None):
+    """
+    apply the weights to the nldas data one block of time steps at a time.
+    each block is computed and appended to the output before the next one is
+    started and the number of time steps done is recorded in the output's
+    attributes, so a run that dies can be restarted where it left off
+    :param weights: [xarray DataArray or tuple] weights from read_weights
+    :param ds_nldas_st: [xarray dataset] the stacked nldas data
+    :param out_store: [str or s3fsMap] the output zarr store
+    :param backend: [str] 'dense' or 'sparse'
+    :param time_block: [int] the number of time steps per block. if None, the
+    time chunk size of the nldas zarr store is used
+    :param fused: [bool] whether to weight all variables in one multiply
+    :param normalize: [bool] whether to normalize by the valid weights
+    :param freq: [str] pandas frequency to aggregate each block to (or None).
+    the blocks are cut between aggregation periods
+    :param aggregation: [dict] the stats for each variable (see aggregate_time)
+    :return: None
+    """
+    if not time_block:
+        time_block = ds_nldas_st.chunks['time'][0]
+    times = ds_nldas_st.time.values
+    num_times = len(times)
+    time_steps_done = get_time_steps_done(out_store)
+    if time_steps_done:
+        # anything written after the last recorded block is removed
+        truncate_zarr(out_store, 'time',
+                      get_num_out_times(times[:time_steps_done], freq))
+    if freq:
+        time_blocks = get_period_time_blocks(times, freq, time_block,
+                                             time_steps_done)
+    else:
+        time_blocks = get_time_blocks(num_times, time_block, time_steps_done)
+    for time_slice in time_blocks:
+        start_time = time.time()
+        print(f"weighting time steps {time_slice.start} to {time_slice.stop}"
+              f" of {num_times}", flush=True)
+        ds_block = ds_nldas_st.isel(time=time_slice)
+        weighted_block = weight_variables(ds_block, weights, backend, fused,
+                                          normalize)
+        if freq:
+            weighted_block = aggregate_time(weighted_block, freq, aggregation)
+        weighted_block = weighted_block.load()
+        weighted_block = weighted_block.chunk(
+            {'time': get_num_out_times(times[:time_block], freq)})
+        # writing the block writes its attrs too, so keep the last record
+        weighted_block.attrs['time_steps_done'] = time_slice.start
+        if time_slice.start == 0:
+            weighted_block.to_zarr(out_store, mode='w')
+        else:
+            weighted_block.to_zarr(out_store, mode='a', append_dim='time')
+        record_time_steps_done(out_store, time_slice.stop)
+        print("time elapsed", time.time() - start_time, flush=True)
+
+
+def apply_nldas_weight_grid(weight_grid_zarr, dataset_zarr, out_store,
+                            backend='dense', stream=False, time_block=None,
+                            fused=False, normalize=False, freq=None,
+                            aggregation=None, cell_major_zarr=None):
+    """
+    apply the weight grid to the nldas data to get catchment-level forcings
+    :param weight_grid_zarr: [str] path to the weight grid zarr store (dense or
+    sparse format)
+    :param dataset_zarr: [str] path to the nldas zarr store
+    :param out_store: [str] path to the output zarr store
+    :param backend: [str] 'dense' to multiply the full dense weight matrix or
+    'sparse' to multiply a scipy CSR matrix against time-blocks of the data
+    :param stream: [bool] if True, walk through the time axis in blocks,
+    writing (and recording) each block before starting the next. the memory
+    used does not depend on the length of the record and the run can be
+    restarted where it left off
+    :param time_block: [int] number of time steps per block when streaming.
+    defaults to the time chunk size of the nldas store
+    :param fused: [bool] if True, read each block of nldas data once and
+    weight all of the variables in a single multiply
+    :param normalize: [bool] if True, leave NaN grid cells out and divide by
+    the sum of the weights of the valid cells so catchments that are partly
+    over missing data get the mean of the valid part instead of being biased
+    low
+    :param freq: [str] pandas frequency (e.g., 'D') to aggregate the weighted
+    data to. the aggregation is done on the weighted data while it is in
+    memory, so daily drivers come from one read of the hourly data. if None,
+    the data are not aggregated
+    :param aggregation: [dict] the stats to calculate for each variable (see
+    aggregate_time). defaults to nldas_aggregation
+    :param cell_major_zarr: [str] path to a cell-major copy of the nldas data
+    (see rechunk_nldas.py). with the sparse backend, whichever of the two
+    layouts needs less data read for the weighted cells is used
+    :return: None
+    """
+    weights = read_weights(weight_grid_zarr, backend)
+    ds_nldas_st = open_nldas(dataset_zarr, weights, backend, cell_major_zarr)
+    if stream:
+        apply_nldas_weight_grid_blocks(weights, ds_nldas_st, out_store,
+                                       backend, time_block, fused, normalize,
+                                       freq, aggregation)
+    else:
+        weigheted_ds = weight_variables(ds_nldas_st, weights, backend, fused,
+                                        normalize)
+        if freq:
+            weigheted_ds = aggregate_time(weigheted_ds, freq, aggregation)
+        weigheted_ds.to_zarr(out_store)
 
 if __name__ == "__main__":
     
     fs = s3fs.S3FileSystem()
-    nldas_data_path = 'ds-drb-data/nldas_daily_sum_precip'
+    nldas_data_path = 'ds-drb-data/nldas'
     nldas_store = s3fs.S3Map(nldas_data_path, s3=fs)
     out_path = 'ds-drb-data/nldas_weighted_nwis_dissolved'
     out_store = s3fs.S3Map(out_path, s3=fs)
 
     weight_grid_store = "/home/ec2-user/weight_grid_dissolved1"
-    apply_nldas_weight_grid(weight_grid_store, nldas_store, out_store)
+    # daily drivers straight from the hourly data
+    apply_nldas_weight_grid(weight_grid_store, nldas_store, out_store,
+                            freq='D')
 
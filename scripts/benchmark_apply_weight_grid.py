@@ -0,0 +1,106 @@
+"""
+This module benchmarks applying the weight grid to nldas data with the
+variables weighted one at a time versus all at once (fused). A synthetic
+nldas-like zarr store and sparse weight grid are written to a temporary
+directory so the benchmark does not need any data from s3.
+"""
+import shutil
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import xarray as xr
+import apply_weight_grid as aw
+import sparse_weights as sw
+
+
+def make_synthetic_nldas(out_zarr, num_times=480, num_lat=112, num_lon=232,
+                         num_vars=8, time_chunk=48):
+    """
+    write a synthetic nldas-like zarr store (time x lat x lon float32 vars)
+    :param out_zarr: [str] path to the output zarr store
+    :param num_times: [int] number of time steps
+    :param num_lat: [int] number of grid rows
+    :param num_lon: [int] number of grid columns
+    :param num_vars: [int] number of forcing variables
+    :param time_chunk: [int] time chunk size of the store
+    :return: [int] number of bytes of forcing data
+    """
+    rng = np.random.default_rng(0)
+    coords = {'time': pd.date_range('2000-01-01', periods=num_times,
+                                    freq='h'),
+              'lat': np.arange(num_lat) + 0.5,
+              'lon': np.arange(num_lon) + 0.5}
+    shape = (num_times, num_lat, num_lon)
+    data_vars = {f'var{i}': (('time', 'lat', 'lon'),
+                             rng.random(shape, dtype='float32'))
+                 for i in range(num_vars)}
+    ds = xr.Dataset(data_vars, coords=coords)
+    ds.chunk({'time': time_chunk}).to_zarr(out_zarr, mode='w')
+    return ds.nbytes
+
+
+def make_synthetic_weights(out_zarr, num_grid_cells, num_catchments=20000,
+                           cells_per_catchment=4):
+    """
+    write a synthetic sparse weight grid where each catchment covers a few
+    random grid cells
+    :param out_zarr: [str] path to the output zarr store
+    :param num_grid_cells: [int] number of cells in the grid
+    :param num_catchments: [int] number of catchments
+    :param cells_per_catchment: [int] number of cells each catchment covers
+    :return: None
+    """
+    rng = np.random.default_rng(1)
+    comids = np.repeat(np.arange(num_catchments), cells_per_catchment)
+    cells = rng.integers(0, num_grid_cells, len(comids))
+    weights = np.full(len(comids), 1 / cells_per_catchment)
+    triplets = pd.DataFrame({sw.idx_name: comids, sw.col_name: cells,
+                             sw.data_name: weights})
+    triplets = sw.format_triplets(triplets)
+    ds = sw.triplets_to_dataset(triplets, num_grid_cells=num_grid_cells)
+    ds.to_zarr(out_zarr, mode='w')
+
+
+def time_apply(weight_zarr, nldas_zarr, out_zarr, backend, fused):
+    start_time = time.time()
+    aw.apply_nldas_weight_grid(weight_zarr, nldas_zarr, out_zarr,
+                               backend=backend, stream=True, fused=fused)
+    return time.time() - start_time
+
+
+def benchmark_fused_weighting(backend='sparse', num_times=480, num_vars=8,
+                              num_lat=112, num_lon=232):
+    """
+    time the weighting of a synthetic nldas dataset with and without fusing
+    the variables and print the throughput of each
+    :param backend: [str] 'dense' or 'sparse'
+    :param num_times: [int] number of time steps
+    :param num_vars: [int] number of forcing variables
+    :param num_lat: [int] number of grid rows
+    :param num_lon: [int] number of grid columns
+    :return: [dict] seconds taken for each mode ('separate' and 'fused')
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        nldas_zarr = f'{tmp_dir}/nldas'
+        weight_zarr = f'{tmp_dir}/weights'
+        num_bytes = make_synthetic_nldas(nldas_zarr, num_times, num_lat,
+                                         num_lon, num_vars)
+        make_synthetic_weights(weight_zarr, num_lat * num_lon)
+        times = {}
+        for mode, fused in [('separate', False), ('fused', True)]:
+            times[mode] = time_apply(weight_zarr, nldas_zarr,
+                                     f'{tmp_dir}/out_{mode}', backend, fused)
+    finally:
+        shutil.rmtree(tmp_dir)
+    for mode, seconds in times.items():
+        print(f"{mode}: {seconds:.2f} s, {num_times / seconds:.1f} time "
+              f"steps/s, {num_bytes / 1e6 / seconds:.1f} MB/s", flush=True)
+    print(f"fused speedup: {times['separate'] / times['fused']:.2f}x",
+          flush=True)
+    return times
+
+
+if __name__ == "__main__":
+    benchmark_fused_weighting(backend='sparse')
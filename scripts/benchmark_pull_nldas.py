@@ -0,0 +1,220 @@
+"""
+This module benchmarks pulling nldas data into zarr without URS credentials or
+the NASA server. A synthetic NLDAS-shaped dataset is written to an on-disk
+NetCDF file and served in-process by a pydap handler, which stands in for the
+OPeNDAP server: the dataset is opened with pull_nldas.connect_to_urs, so the
+url and its constraint expression are the ones the server gets, and like the
+server only the requested slices are read. An optional latency is added to
+each data request to act like the network round trips. The pulls go through
+pull_nldas.pull_to_zarr, the same code nldas_to_zarr uses.
+"""
+import shutil
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import xarray as xr
+from pydap.handlers.lib import BaseHandler
+from pydap.model import DatasetType, BaseType
+import pull_nldas as pn
+
+nldas_variables = ['apcpsfc', 'tmp2m', 'spfh2m', 'pressfc', 'ugrd10m',
+                   'vgrd10m', 'dlwrfsfc', 'dswrfsfc']
+
+
+def make_synthetic_nldas_nc(nc_file, num_times=2000, num_lat=56, num_lon=116,
+                            variables=None):
+    """
+    write a synthetic NLDAS-shaped (hourly, 0.125 degree) NetCDF file that
+    starts at the nldas minimum date
+    :param nc_file: [str] path to the output NetCDF file
+    :param num_times: [int] number of hourly time steps
+    :param num_lat: [int] number of grid rows (224 for the full grid)
+    :param num_lon: [int] number of grid columns (464 for the full grid)
+    :param variables: [list] names of the variables. defaults to
+    nldas_variables
+    :return: None
+    """
+    if not variables:
+        variables = nldas_variables
+    rng = np.random.default_rng(0)
+    coords = {'time': pd.date_range(pn.minimum_date, periods=num_times,
+                                    freq='h'),
+              'lat': 25.0625 + 0.125 * np.arange(num_lat),
+              'lon': -124.9375 + 0.125 * np.arange(num_lon)}
+    shape = (num_times, num_lat, num_lon)
+    data_vars = {v: (('time', 'lat', 'lon'),
+                     rng.random(shape, dtype='float32'))
+                 for v in variables}
+    xr.Dataset(data_vars, coords=coords).to_netcdf(nc_file)
+
+
+class StandinArray:
+    """
+    a variable of the synthetic NetCDF file that is read lazily, one requested
+    slice at a time, and that waits before every read like a request to the
+    server would
+    :param data_array: [xarray DataArray] the lazily opened variable
+    :param latency: [float] seconds to wait per read
+    """
+    def __init__(self, data_array, latency=0.):
+        self.data_array = data_array
+        self.latency = latency
+        self.shape = data_array.shape
+        self.ndim = data_array.ndim
+        self.dtype = data_array.dtype
+
+    def __getitem__(self, index):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.data_array[index].values
+
+    def __len__(self):
+        return self.shape[0]
+
+
+def make_standin_handler(nc_file, latency=0.):
+    """
+    make a pydap handler that serves the synthetic NetCDF file in-process the
+    way the OPeNDAP server serves the nldas data
+    :param nc_file: [str] path to the synthetic NetCDF file
+    :param latency: [float] seconds to wait per data request
+    :return: [pydap BaseHandler] the handler
+    """
+    # keep the time units so the client decodes the times like the server's
+    ds = xr.open_dataset(nc_file, decode_times=False)
+    dataset = DatasetType('nldas')
+    for name, var in ds.variables.items():
+        if name in ds.dims:
+            data = var.values
+        else:
+            data = StandinArray(ds[name], latency)
+        dataset[name] = BaseType(name, data, var.dims, dict(var.attrs))
+    return BaseHandler(dataset)
+
+
+def open_standin(nc_file, lat_chunk=224, lon_chunk=464, time_chunk=480,
+                 latency=0., variables=None, bbox=None):
+    """
+    open the synthetic NetCDF file through a pydap handler with
+    connect_to_urs, like the server data are opened
+    :param nc_file: [str] path to the synthetic NetCDF file
+    :param lat_chunk: [int] the zarr chunk size for the lat dimension
+    :param lon_chunk: [int] the zarr chunk size for the lon dimension
+    :param time_chunk: [int] the zarr chunk size for the time dimension
+    :param latency: [float] seconds to wait per data request
+    :param variables: [list] names of the variables to pull. if None, all
+    variables are pulled
+    :param bbox: [list-like] (min_lon, min_lat, max_lon, max_lat) of the area
+    to pull. if None, the whole grid is pulled
+    :return: [xarray dataset] dataset standing in for the server data
+    """
+    handler = make_standin_handler(nc_file, latency)
+    return pn.connect_to_urs(None, None, lat_chunk, lon_chunk, time_chunk,
+                             variables=variables, bbox=bbox,
+                             application=handler)
+
+
+def get_end_date(num_times):
+    """
+    get the end_date that makes the pull cover num_times time steps
+    """
+    return str(pd.Timestamp(pn.minimum_date) + pd.Timedelta(hours=num_times
+                                                             - 1))
+
+
+def time_pull(ds, zarr_store, num_times, **pull_kwargs):
+    """
+    pull the stand-in data into a zarr store and measure it
+    :param ds: [xarray dataset] the stand-in dataset
+    :param zarr_store: [str] the zarr store to write to
+    :param num_times: [int] number of time steps to pull up to
+    :param pull_kwargs: other arguments to pull_to_zarr
+    :return: [dict] seconds, MB written, MB/s and peak traced memory (MB)
+    """
+    tracemalloc.start()
+    start_time = time.time()
+    num_bytes = pn.pull_to_zarr(ds, zarr_store, get_end_date(num_times),
+                                **pull_kwargs)
+    seconds = time.time() - start_time
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': seconds, 'mb': num_bytes / 1e6,
+            'mb_per_s': num_bytes / 1e6 / seconds,
+            'peak_mb': peak_memory / 1e6}
+
+
+def check_pull(nc_file, zarr_store, variables=None):
+    """
+    check that the pulled zarr store matches the synthetic data
+    :param variables: [list] names of the variables that were pulled. if None,
+    all of the variables should have been pulled
+    """
+    ds_true = xr.open_dataset(nc_file)
+    ds_pulled = xr.open_zarr(zarr_store)
+    if not (ds_pulled.time.values == ds_true.time.values).all():
+        return False
+    return all(np.array_equal(ds_pulled[v].values, ds_true[v].values)
+               for v in variables or ds_true.data_vars)
+
+
+def benchmark_pull(settings=None, num_times=2000, num_lat=56, num_lon=116,
+                   latency=0.05):
+    """
+    benchmark pulling the synthetic data with different pull settings. each
+    setting is run from scratch and then as a resume: the pull is stopped
+    halfway and restarted
+    :param settings: [list] dicts of pull_to_zarr arguments (time_pull_size,
+    time_chunk, workers, region) to compare
+    :param num_times: [int] number of hourly time steps
+    :param num_lat: [int] number of grid rows
+    :param num_lon: [int] number of grid columns
+    :param latency: [float] seconds to wait per chunk request
+    :return: [pandas df] one row of results per setting
+    """
+    if not settings:
+        settings = [{'time_pull_size': 959, 'time_chunk': 480},
+                    {'time_pull_size': 960, 'time_chunk': 480},
+                    {'time_pull_size': 960, 'time_chunk': 480, 'workers': 4},
+                    {'time_pull_size': 480, 'time_chunk': 240, 'workers': 4},
+                    {'time_pull_size': 960, 'time_chunk': 480, 'workers': 4,
+                     'region': True}]
+    tmp_dir = tempfile.mkdtemp()
+    results = []
+    try:
+        nc_file = f'{tmp_dir}/nldas.nc'
+        make_synthetic_nldas_nc(nc_file, num_times, num_lat, num_lon)
+        for i, pull_kwargs in enumerate(settings):
+            time_chunk = pull_kwargs['time_chunk']
+            ds = open_standin(nc_file, time_chunk=time_chunk,
+                              latency=latency)
+            zarr_store = f'{tmp_dir}/full_{i}'
+            result = time_pull(ds, zarr_store, num_times, **pull_kwargs)
+            result['correct'] = check_pull(nc_file, zarr_store)
+
+            # stop halfway (as if the pull died), then resume
+            resume_store = f'{tmp_dir}/resume_{i}'
+            if pull_kwargs.get('region'):
+                pull_kwargs = dict(pull_kwargs,
+                                   time_range=(0, num_times // 2))
+                pn.pull_to_zarr(ds, resume_store, get_end_date(num_times),
+                                **pull_kwargs)
+                pull_kwargs['time_range'] = None
+            else:
+                pn.pull_to_zarr(ds, resume_store,
+                                get_end_date(num_times // 2), **pull_kwargs)
+            resumed = time_pull(ds, resume_store, num_times, **pull_kwargs)
+            result['resume_seconds'] = resumed['seconds']
+            result['resume_correct'] = check_pull(nc_file, resume_store)
+            results.append(dict(pull_kwargs, **result))
+    finally:
+        shutil.rmtree(tmp_dir)
+    results = pd.DataFrame(results).drop(columns='time_range',
+                                         errors='ignore')
+    print(results.to_string(), flush=True)
+    return results
+
+
+if __name__ == '__main__':
+    benchmark_pull()
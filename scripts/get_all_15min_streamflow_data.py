@@ -10,7 +10,9 @@ sites_file = '../data/tables/all_streamflow_sites_CONUS_iv.csv'
 get_all_streamflow_data(file_name, sites_file, num_sites_per_chunk=1,
                         time_scale='15T', output_format='zarr',
                         start_date='1970-01-01', end_date='2019-03-01',
-                        num_site_chunks_write=60, s3=True
+                        num_site_chunks_write=60, s3=True, workers=8,
+                        stream=True, response_format='rdb',
+                        window_freq='10YS', window_workers=4
                         )
 
 write_indicator_file(get_all_streamflow_data,
@@ -3,22 +3,18 @@ import time
 
 
 def get_one_site_attr(site_num, attr):
-    # adding in while try/except this so if the server isn't reached the first
-    # time, it will keep trying
-    while True:
-        try:
-            url = base_url + "nwissite/USGS-{}/tot?characteristicId={}"
-            url_site_attr = url.format(site_num, attr)
-            print('getting data for {}'.format(site_num))
-            st = time.time()
-            data = json_from_nldi_request(url_site_attr)
-            end = time.time()
-            print ('elapsed time', end-st)
-            attr_value = data['characteristics'][0]['characteristic_value']
-            print('value is {}'.format(attr_value))
-            return float(attr_value)
-        except:
-            continue
+    # if the server isn't reached the first time, the http client tries again
+    # (with backoff)
+    url = base_url + "nwissite/USGS-{}/tot?characteristicId={}"
+    url_site_attr = url.format(site_num, attr)
+    print('getting data for {}'.format(site_num))
+    st = time.time()
+    data = json_from_nldi_request(url_site_attr)
+    end = time.time()
+    print ('elapsed time', end-st)
+    attr_value = data['characteristics'][0]['characteristic_value']
+    print('value is {}'.format(attr_value))
+    return float(attr_value)
 
 
 def get_sites_attr(sites, attr):
@@ -1,6 +1,6 @@
 import pandas as pd
-import requests
 import os
+import http_client
 
 
 def convert_response_to_df(response_text):
@@ -43,7 +43,7 @@ def get_sites_for_one_huc(huc, product, param_cd, out_file=None):
     base_url = 'https://waterservices.usgs.gov/nwis/site/?format=rdb&huc={}' \
           '&parameterCd=00060&siteStatus=all&hasDataTypeCd={}'
     url = base_url.format(huc, product)
-    response = requests.get(url)
+    response = http_client.get(url)
     data = convert_response_to_df(response.text)
     if out_file:
         data.to_csv(out_file)
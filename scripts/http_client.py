@@ -0,0 +1,223 @@
+"""
+This module contains the HTTP client that all of the web service calls (NWIS
+and NLDI) go through. It keeps pooled keep-alive sessions, asks for gzip,
+retries failed calls with exponential backoff and jitter, caps the number of
+calls going to one host at a time, rate limits the calls to each host with a
+token bucket, and keeps counts of the calls, retries and latency.
+"""
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# status codes that are worth trying again
+retry_statuses = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """
+    token bucket rate limiter. tokens are added at `rate` per second up to
+    `capacity` and each call takes one, waiting if there are none left
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.last_time) * self.rate)
+            self.last_time = now
+            # take the token now (going negative if need be) so that waiting
+            # callers are served in order
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class HttpClient:
+    """
+    HTTP client with pooled sessions, backoff, per-host limits and counters
+    :param max_retries: [int] number of times to retry a failed call
+    :param backoff_base: [float] seconds of the first backoff. the backoff
+    doubles each retry and a random (full jitter) part of it is waited
+    :param backoff_max: [float] max seconds to back off
+    :param max_per_host: [int] max calls going to one host at the same time
+    :param requests_per_second: [float] max calls per second to one host
+    :param timeout: [tuple] (connect, read) timeouts in seconds
+    """
+    def __init__(self, max_retries=6, backoff_base=1., backoff_max=60.,
+                 max_per_host=8, requests_per_second=10.,
+                 timeout=(10, 300)):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_per_host = max_per_host
+        self.requests_per_second = requests_per_second
+        self.timeout = timeout
+        self.local = threading.local()
+        self.host_locks = {}
+        self.host_buckets = {}
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'retries': 0, 'failures': 0,
+                      'latency_total': 0., 'latency_max': 0.}
+
+    def get_session(self):
+        # one session (and connection pool) per thread
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.max_per_host,
+                                  pool_maxsize=self.max_per_host)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            self.local.session = session
+        return session
+
+    def get_host_limits(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.host_locks:
+                self.host_locks[host] = threading.BoundedSemaphore(
+                    self.max_per_host)
+                self.host_buckets[host] = TokenBucket(
+                    self.requests_per_second, self.max_per_host)
+            return self.host_locks[host], self.host_buckets[host]
+
+    def get_backoff(self, attempt, response=None):
+        backoff = random.uniform(0, min(self.backoff_max,
+                                        self.backoff_base * 2 ** attempt))
+        retry_after = response.headers.get('Retry-After') if response \
+            is not None else None
+        if retry_after and retry_after.isdigit():
+            backoff = max(backoff, float(retry_after))
+        return backoff
+
+    def record(self, name, value=1):
+        with self.lock:
+            self.stats[name] += value
+
+    def record_latency(self, seconds):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['latency_total'] += seconds
+            self.stats['latency_max'] = max(self.stats['latency_max'],
+                                            seconds)
+
+    def hold_until_closed(self, response, host_lock, start_time):
+        """
+        keep a streamed response's place in the host's limit until it is
+        closed, and count the download of the body in its latency
+        """
+        close = response.close
+        released = threading.Event()
+
+        def close_and_release():
+            try:
+                close()
+            finally:
+                if not released.is_set():
+                    released.set()
+                    host_lock.release()
+                    self.record_latency(time.time() - start_time)
+
+        response.close = close_and_release
+        return response
+
+    def get(self, url, **kwargs):
+        """
+        make a GET call, retrying connection problems, timeouts and retry-able
+        statuses (429 and 5xx) with backoff. other responses are returned as
+        they are. a response asked for with stream=True keeps its place in
+        the host's limit (and its latency counts) until it is closed, so it
+        must be closed (e.g., with a with statement) once its body is read
+        :param url: [str] the url
+        :param kwargs: other arguments to requests.Session.get (e.g., params
+        or stream)
+        :return: [requests Response] the response. if the retries run out on
+        a bad status, the last response is returned
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        stream = kwargs.get('stream', False)
+        host_lock, bucket = self.get_host_limits(url)
+        session = self.get_session()
+        for attempt in range(self.max_retries + 1):
+            bucket.acquire()
+            response = None
+            start_time = time.time()
+            host_lock.acquire()
+            try:
+                response = session.get(url, **kwargs)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                host_lock.release()
+                self.record_latency(time.time() - start_time)
+                if attempt == self.max_retries:
+                    self.record('failures')
+                    raise
+                problem = type(e).__name__
+            except BaseException:
+                host_lock.release()
+                raise
+            else:
+                if stream and response.status_code not in retry_statuses:
+                    return self.hold_until_closed(response, host_lock,
+                                                  start_time)
+                host_lock.release()
+                self.record_latency(time.time() - start_time)
+                if response.status_code not in retry_statuses:
+                    return response
+                problem = f'status {response.status_code}'
+            if attempt == self.max_retries:
+                self.record('failures')
+                return response
+            if response is not None:
+                response.close()
+            backoff = self.get_backoff(attempt, response)
+            print(f'there was some problem ({problem}). trying again in '
+                  f'{backoff:.1f} s', flush=True)
+            self.record('retries')
+            time.sleep(backoff)
+
+    def get_stats(self):
+        """
+        get the counts of calls, retries and failures and the mean and max
+        latency (seconds) of the calls
+        """
+        with self.lock:
+            stats = dict(self.stats)
+        num_requests = stats['requests']
+        stats['latency_mean'] = stats['latency_total'] / num_requests \
+            if num_requests else 0.
+        return stats
+
+
+default_client = HttpClient()
+
+
+def get(url, **kwargs):
+    """
+    make a GET call with the shared client (see HttpClient.get)
+    """
+    return default_client.get(url, **kwargs)
+
+
+def get_stats():
+    return default_client.get_stats()
+
+
+def print_stats():
+    stats = get_stats()
+    print(f"{stats['requests']} http calls, {stats['retries']} retries, "
+          f"{stats['failures']} failures, mean latency "
+          f"{stats['latency_mean']:.2f} s, max latency "
+          f"{stats['latency_max']:.2f} s", flush=True)
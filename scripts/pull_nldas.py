@@ -1,27 +1,32 @@
+from collections import deque
+from multiprocessing.pool import ThreadPool
 from pydap.client import open_url
 from pydap.cas.urs import setup_session
+import dask.array as da
+import numpy as np
 import pandas as pd
 import xarray as xr
 import time
 import zarr
 import s3fs
-from utils import write_indicator_file
+from utils import write_indicator_file, truncate_zarr
 
 minimum_date = "1979-01-01 13:00"
 base_url = 'https://hydro1.sci.gsfc.nasa.gov/dods/NLDAS_FORA0125_H.002?'
+nldas_coords = ['time', 'lat', 'lon']
 
 
 def max_num_dates_done(zarr_store):
     try:
         ds = xr.open_zarr(zarr_store)
-    except ValueError:
+    except (ValueError, KeyError, FileNotFoundError):
         return None
     t = ds['time']
     return len(t)
 
 
 def get_total_time_steps(end_date):
-    date_range = pd.date_range(start=minimum_date, end=end_date, freq='H')
+    date_range = pd.date_range(start=minimum_date, end=end_date, freq='h')
     return len(date_range)
 
 
@@ -35,8 +40,8 @@ def delete_last_time_chunk(zarr_store):
     # read in zarr
     z = zarr.group(store=zarr_store)
     # get sizes and time_chunk size
-    time_size = z.time.size
-    time_chunk_size = z.time.chunks[0]
+    time_size = z['time'].size
+    time_chunk_size = z['time'].chunks[0]
     new_time_size = time_size - time_chunk_size
     # delete last time_chunk for each array
     for a in z.arrays():
@@ -46,26 +51,236 @@ def delete_last_time_chunk(zarr_store):
             if arr.shape[0] != time_size:
                 raise ValueError(f'the {name} time dimension does not equal\
                         overall time dimension')
-            if name == 'time':
-                arr.resize(new_time_size)
-            else:
-                arr.resize(new_time_size, arr.shape[1], arr.shape[2])
+            arr.resize((new_time_size,) + arr.shape[1:])
+    # so the consolidated metadata shows the new sizes
+    zarr.consolidate_metadata(zarr_store)
+
+
+def get_aligned_pull_size(time_pull_size, time_chunk):
+    """
+    round the pull size to the nearest multiple of the zarr time chunk size
+    (at least one chunk) so that every pull writes whole chunks
+    :param time_pull_size: [int] the requested number of time steps per pull
+    :param time_chunk: [int] the zarr chunk size for the time dimension
+    :return: [int] the chunk-aligned pull size
+    """
+    pull_size = max(1, round(time_pull_size / time_chunk)) * time_chunk
+    if pull_size != time_pull_size:
+        print(f"using a time pull size of {pull_size} instead of "
+              f"{time_pull_size} to line up with the time chunks of "
+              f"{time_chunk}", flush=True)
+    return pull_size
+
+
+def plan_time_slices(start, end, time_chunk, time_pull_size):
+    """
+    plan the time slices to pull so that each zarr chunk is written exactly
+    once. the slices are a multiple of the chunk size long and start and end
+    on chunk boundaries (a first slice that starts mid-chunk only goes to the
+    next boundary and the last slice ends at end)
+    :param start: [int] the first time step to pull
+    :param end: [int] the time step to pull up to (not included)
+    :param time_chunk: [int] the zarr chunk size for the time dimension
+    :param time_pull_size: [int] the requested number of time steps per pull
+    :return: [list] the time slices
+    """
+    pull_size = get_aligned_pull_size(time_pull_size, time_chunk)
+    time_slices = []
+    slice_start = start
+    while slice_start < end:
+        slice_end = (slice_start + pull_size) // time_chunk * time_chunk
+        slice_end = min(slice_end, end)
+        time_slices.append(slice(slice_start, slice_end))
+        slice_start = slice_end
+    return time_slices
 
 
-def get_undone_range(zarr_store, time_pull_size, end_date):
-    print('deleting last time chunk')
-    delete_last_time_chunk(zarr_store)
+def get_undone_range(zarr_store, time_pull_size, end_date, time_chunk=480):
+    """
+    get the chunk-aligned time slices that still need to be appended. the
+    last pull that was written may not have finished, so it is removed and
+    pulled again
+    :param zarr_store: [str or s3fsMap] the nldas zarr store
+    :param time_pull_size: [int] the requested number of time steps per pull
+    :param end_date: [str] date until which the data should be pulled
+    :param time_chunk: [int] the zarr chunk size for the time dimension
+    :return: [list] the time slices
+    """
     num_total_dt_steps = get_total_time_steps(end_date)
     max_date_num = max_num_dates_done(zarr_store)
+    start = 0
     if max_date_num:
-        start = max_date_num
-    else:
-        start = 1
-    return range(start, num_total_dt_steps, time_pull_size)
+        pull_size = get_aligned_pull_size(time_pull_size, time_chunk)
+        start = (max_date_num - 1) // pull_size * pull_size
+        truncate_zarr(zarr_store, 'time', start)
+    return plan_time_slices(start, num_total_dt_steps, time_chunk,
+                            time_pull_size)
+
+
+def init_region_store(ds, zarr_store, num_time_steps, wait=60):
+    """
+    pre-allocate a zarr store with the full time axis so that time slices can
+    be written to it in any order with region writes. only the metadata and
+    coordinates are written. a 'time_done' coordinate (the completion bitmap)
+    records which time steps have been written. if the store already exists
+    (e.g., another process that was started at the same time made it first),
+    it is used as long as it is a region store for the same variables and
+    number of time steps
+    :param ds: [xarray dataset] dataset representing server data
+    :param zarr_store: [str or s3fsMap] the zarr store to write to
+    :param num_time_steps: [int] the total number of time steps to allocate
+    :param wait: [int] seconds to wait for a store that another process is
+    making to be readable
+    :return: None
+    """
+    if max_num_dates_done(zarr_store) is None:
+        template = ds.isel(time=slice(0, num_time_steps))
+        time_done = da.zeros(num_time_steps, dtype=bool,
+                             chunks=template.chunks['time'])
+        template = template.assign_coords(time_done=('time', time_done))
+        try:
+            template.to_zarr(zarr_store, compute=False)
+        except (FileExistsError, ValueError):
+            # another process made the store first (older zarr versions
+            # raise a ValueError for this)
+            if not wait_for_store(zarr_store, wait):
+                raise
+    check_region_store(ds, zarr_store, num_time_steps)
+
+
+def wait_for_store(zarr_store, wait):
+    """
+    wait for a zarr store to be readable
+    :param zarr_store: [str or s3fsMap] the zarr store
+    :param wait: [int] max seconds to wait
+    :return: [bool] True if the store is readable
+    """
+    for _ in range(wait):
+        if max_num_dates_done(zarr_store) is not None:
+            return True
+        time.sleep(1)
+    return max_num_dates_done(zarr_store) is not None
+
+
+def check_region_store(ds, zarr_store, num_time_steps):
+    """
+    make sure an existing store is a region store that the data can be
+    written to
+    :param ds: [xarray dataset] dataset representing server data
+    :param zarr_store: [str or s3fsMap] the pre-allocated zarr store
+    :param num_time_steps: [int] the number of time steps it should have
+    :return: None
+    """
+    ds_store = xr.open_zarr(zarr_store)
+    if 'time_done' not in ds_store.variables:
+        raise ValueError(f'{zarr_store} is not a region store (it has no '
+                         f'time_done bitmap). it was pulled with '
+                         f'region=False, so keep pulling it that way or pull '
+                         f'into a new store')
+    if set(ds_store.data_vars) != set(ds.data_vars) or \
+            ds_store.sizes['time'] != num_time_steps:
+        raise ValueError(f'the region store {zarr_store} has the variables '
+                         f'{sorted(ds_store.data_vars)} and '
+                         f'{ds_store.sizes["time"]} time steps but the pull is '
+                         f'for {sorted(ds.data_vars)} and {num_time_steps} '
+                         f'time steps')
+
+
+def get_undone_region_slices(zarr_store, time_pull_size, time_range=None):
+    """
+    get the time slices of a pre-allocated store that are not all done yet
+    according to its completion bitmap
+    :param zarr_store: [str or s3fsMap] the pre-allocated zarr store
+    :param time_pull_size: [int] the number of time steps per slice
+    :param time_range: [tuple] (start, end) time step numbers that this
+    process should fill. if None, the whole time axis is used. separate
+    processes (or machines) can fill disjoint ranges at the same time. the
+    range is moved to the time chunk boundaries so that two processes never
+    write the same chunk
+    :return: [list] the chunk-aligned time slices that still need to be
+    pulled
+    """
+    ds = xr.open_zarr(zarr_store)
+    time_done = ds.time_done.values
+    time_chunk = ds.time_done.encoding['chunks'][0]
+    num_times = len(time_done)
+    start, end = time_range if time_range else (0, num_times)
+    start = start // time_chunk * time_chunk
+    end = num_times if end >= num_times else end // time_chunk * time_chunk
+    return [time_slice for time_slice
+            in plan_time_slices(start, end, time_chunk, time_pull_size)
+            if not time_done[time_slice].all()]
+
+
+def write_region_slice(ds_sliced, zarr_store, time_slice):
+    """
+    write a pulled time slice to its place in a pre-allocated store and then
+    mark its time steps as done in the completion bitmap. the bitmap is only
+    written once the data are, so a failed write leaves the slice not done
+    :param ds_sliced: [xarray dataset] the pulled data
+    :param zarr_store: [str or s3fsMap] the pre-allocated zarr store
+    :param time_slice: [slice] where the data goes in the time axis
+    :return: None
+    """
+    no_time = [v for v in ds_sliced.variables
+               if 'time' not in ds_sliced[v].dims]
+    ds_sliced.drop_vars(no_time).to_zarr(zarr_store,
+                                         region={'time': time_slice})
+    z = zarr.open_group(zarr_store, mode='r+')
+    z['time_done'][time_slice] = True
+
+
+def get_nldas_url(variables=None):
+    """
+    get the OPeNDAP url for the nldas data. if variables are given, they are
+    put in the url's constraint expression so the server only describes (and
+    sends) those variables. the time, lat and lon coordinates are always put
+    in too, since the server leaves out anything that is not projected
+    :param variables: [list] names of the variables to pull (e.g., ['apcpsfc',
+    'tmp2m']). if None, all variables are pulled
+    :return: [str] the url
+    """
+    if variables:
+        return base_url + ','.join(nldas_coords + list(variables))
+    return base_url
+
+
+def subset_nldas(ds, variables=None, bbox=None):
+    """
+    subset the (lazy) server dataset by variable and bounding box. since the
+    data are not loaded yet, only the selected hyperslab of each variable is
+    requested from the server when the data are pulled
+    :param ds: [xarray dataset] dataset representing server data
+    :param variables: [list] names of the variables to keep. if None, all are
+    kept
+    :param bbox: [list-like] (min_lon, min_lat, max_lon, max_lat) in degrees.
+    all grid cells that overlap the box are kept. the rows and columns of the
+    kept cells in the full grid are kept as the nldas_row and nldas_col
+    coordinates (and the numbers of rows and columns of the full grid as the
+    nldas_num_lat and nldas_num_lon attributes) so the cells can be numbered
+    like the weight grids (see utils.get_nldas_grid_no). if None, the whole
+    grid is kept
+    :return: [xarray dataset] the subset dataset
+    """
+    if variables:
+        ds = ds[variables]
+    if bbox is not None:
+        ds = ds.assign_coords(nldas_row=('lat', np.arange(ds.sizes['lat'])),
+                              nldas_col=('lon', np.arange(ds.sizes['lon'])))
+        ds = ds.assign_attrs(nldas_num_lat=ds.sizes['lat'],
+                             nldas_num_lon=ds.sizes['lon'])
+        min_lon, min_lat, max_lon, max_lat = bbox
+        # keep cells whose edges (not just centers) are in the box
+        half_lat = abs(float(ds.lat[1] - ds.lat[0])) / 2
+        half_lon = abs(float(ds.lon[1] - ds.lon[0])) / 2
+        ds = ds.sel(lat=slice(min_lat - half_lat, max_lat + half_lat),
+                    lon=slice(min_lon - half_lon, max_lon + half_lon))
+    return ds
 
 
 def connect_to_urs(urs_user, urs_pass, lat_chunk=224, lon_chunk=464,
-                   time_chunk=480):
+                   time_chunk=480, variables=None, bbox=None,
+                   application=None):
     """
     make a connection to the urs server 
     :param urs_user: [str] the urs username
@@ -73,19 +288,130 @@ def connect_to_urs(urs_user, urs_pass, lat_chunk=224, lon_chunk=464,
     :param lat_chunk: [int] the zarr chunk size for the lat dimension
     :param lon_chunk: [int] the zarr chunk size for the lon dimension
     :param time_chunk: [int] the zarr chunk size for the time dimension
+    :param variables: [list] names of the variables to pull. if None, all
+    variables are pulled
+    :param bbox: [list-like] (min_lon, min_lat, max_lon, max_lat) of the area
+    to pull. if None, the whole grid is pulled
+    :param application: [WSGI app] if given, the requests are answered by this
+    app in-process (e.g., a pydap handler) instead of by the server and no urs
+    session is made
     :return: [xarray dataset] dataset representing server data
     """
-    session = setup_session(urs_pass, urs_user, check_url=base_url)
-
-    store = xr.backends.PydapDataStore.open(base_url, session=session)
+    url = get_nldas_url(variables)
+    if application is None:
+        session = setup_session(urs_pass, urs_user, check_url=url)
+        store = xr.backends.PydapDataStore.open(url, session=session)
+    else:
+        store = xr.backends.PydapDataStore(open_url(url,
+                                                    application=application))
     chunks = {'lat': lat_chunk, 'lon': lon_chunk, 'time': time_chunk}
-    ds = xr.open_dataset(store).chunk(chunks)
+    ds = subset_nldas(xr.open_dataset(store), variables, bbox)
+    ds = ds.chunk(chunks)
     return ds
 
 
+def fetch_time_slice(ds, time_slice):
+    """
+    pull one slice of time steps from the server into memory
+    :param ds: [xarray dataset] dataset representing server data
+    :param time_slice: [slice] the time steps to pull
+    :return: [xarray dataset] the pulled data, chunked like ds
+    """
+    ds_sliced = ds.isel(time=time_slice)
+    chunks = ds_sliced.chunks
+    return ds_sliced.load().chunk(chunks)
+
+
+def write_time_slices(ds, zarr_store, time_slices, workers=1, region=False):
+    """
+    pull the time slices from the server and append them to the zarr store. if
+    workers > 1, up to that many slices are fetched at the same time (the
+    next ones are prefetched while the current one is being written), so at
+    most workers slices are in memory or in flight. the slices are always
+    written in order so appending along time stays correct
+    :param ds: [xarray dataset] dataset representing server data
+    :param zarr_store: [str or s3fsMap] the zarr store to write to
+    :param time_slices: [iterable] the time slices to pull, in order
+    :param workers: [int] number of slices to fetch at the same time
+    :param region: [bool] if True, write each slice to its place in a
+    pre-allocated store (see init_region_store) instead of appending
+    :return: [int] the number of bytes written
+    """
+    start_time = time.time()
+    total_bytes = 0
+    append = region or max_num_dates_done(zarr_store) is not None
+    pending = deque()
+    pool = ThreadPool(workers) if workers > 1 else None
+    try:
+        for time_slice in time_slices:
+            if pool:
+                pending.append((time_slice, time.time(), pool.apply_async(
+                    fetch_time_slice, (ds, time_slice))))
+                # keep up to workers slices in flight, counting the one
+                # that is about to be written
+                if len(pending) < workers:
+                    continue
+            else:
+                pending.append((time_slice, time.time(), None))
+            total_bytes += write_next_slice(ds, zarr_store, pending, append,
+                                            region)
+            append = True
+            print_throughput(total_bytes, start_time)
+        while pending:
+            total_bytes += write_next_slice(ds, zarr_store, pending, append,
+                                            region)
+            append = True
+            print_throughput(total_bytes, start_time)
+    finally:
+        if pool:
+            pool.terminate()
+    return total_bytes
+
+
+def write_next_slice(ds, zarr_store, pending, append=True, region=False):
+    """
+    wait for the oldest pending slice and append it to the zarr store
+    :param ds: [xarray dataset] dataset representing server data
+    :param zarr_store: [str or s3fsMap] the zarr store to write to
+    :param pending: [deque] (time slice, request time, async result or None)
+    tuples in the order they should be written
+    :param append: [bool] whether to append to an existing store (if False,
+    the store is created)
+    :param region: [bool] if True, write the slice to its region of a
+    pre-allocated store instead of appending
+    :return: [int] the number of bytes written
+    """
+    time_slice, start_request_time, result = pending.popleft()
+    print(f"getting data for time {time_slice.start} to {time_slice.stop}",
+          flush=True)
+    if result:
+        ds_sliced = result.get()
+    else:
+        ds_sliced = fetch_time_slice(ds, time_slice)
+    if region:
+        write_region_slice(ds_sliced, zarr_store, time_slice)
+    elif append:
+        ds_sliced.to_zarr(zarr_store, mode='a', append_dim='time')
+    else:
+        ds_sliced.to_zarr(zarr_store)
+    end_request_time = time.time()
+    num_mb = ds_sliced.nbytes / 1e6
+    print("time elapsed", (end_request_time - start_request_time),
+          f"({num_mb / (end_request_time - start_request_time):.2f} MB/s)",
+          flush=True)
+    return ds_sliced.nbytes
+
+
+def print_throughput(total_bytes, start_time):
+    elapsed = time.time() - start_time
+    print(f"total {total_bytes / 1e6:.1f} MB in {elapsed:.1f} s "
+          f"({total_bytes / 1e6 / elapsed:.2f} MB/s)", flush=True)
+
+
 def nldas_to_zarr(zarr_store, urs_user, urs_pass, end_date="2019-01-01",
                   time_pull_size=959, lat_chunk=224, lon_chunk=464,
-                  time_chunk=480):
+                  time_chunk=480, workers=1, region=False, time_range=None,
+                  variables=None, bbox=None):
     """
     pull data from nldas and put into a zarr store for of CONUS
     :param zarr_store: [str] the path to the zarr store to which the data will
@@ -94,27 +420,60 @@ def nldas_to_zarr(zarr_store, urs_user, urs_pass, end_date="2019-01-01",
     :param urs_pass: [str] the urs password
     :param end_date: [str] date until which the data should be pulled
     :param time_pull_size: [int] the number of dates that should be pulled and
-    written to zarr at a time
+    written to zarr at a time. it is rounded to a multiple of time_chunk and
+    the pulls are lined up with the time chunks so each chunk is written once
     :param lat_chunk: [int] the zarr chunk size for the lat dimension
     :param lon_chunk: [int] the zarr chunk size for the lon dimension
     :param time_chunk: [int] the zarr chunk size for the time dimension
+    :param workers: [int] the number of time slices to request from the server
+    at the same time. the slices are still written to zarr in order
+    :param region: [bool] if True, pre-allocate the time axis up to end_date
+    and write each slice to its region of the store, recording it in the
+    store's completion bitmap. nothing needs to be deleted to resume and
+    several processes can fill disjoint time ranges at the same time
+    :param time_range: [tuple] (start, end) time step numbers to fill when
+    region is True. if None, all of the undone time steps are filled
+    :param variables: [list] names of the variables to pull (e.g., ['apcpsfc',
+    'tmp2m']). if None, all variables are pulled
+    :param bbox: [list-like] (min_lon, min_lat, max_lon, max_lat) of the area
+    to pull. only the grid cells that overlap it are requested and stored. if
+    None, the whole grid is pulled
     :return: None
     """
-    ds = connect_to_urs(urs_user, urs_pass, lat_chunk, lon_chunk, time_chunk)
-
-    undone_range = get_undone_range(zarr_store, time_pull_size, end_date)
-    for i in undone_range:
-        start_date_num = i - 1
-        end_date_num = i + time_pull_size - 1
-        time_slice = slice(start_date_num, end_date_num, 1)
-        start_request_time = time.time()
-        print(f"getting data for time {start_date_num} to {end_date_num}",
-              flush=True)
-        ds_sliced = ds.isel(time=time_slice)
-        ds_sliced.to_zarr(zarr_store, mode='a', append_dim='time')
-        end_request_time = time.time()
-        print("time elapsed", (end_request_time - start_request_time),
-              flush=True)
+    ds = connect_to_urs(urs_user, urs_pass, lat_chunk, lon_chunk, time_chunk,
+                        variables, bbox)
+    pull_to_zarr(ds, zarr_store, end_date, time_pull_size, time_chunk,
+                 workers, region, time_range)
+
+
+def pull_to_zarr(ds, zarr_store, end_date="2019-01-01", time_pull_size=959,
+                 time_chunk=480, workers=1, region=False, time_range=None):
+    """
+    pull the undone time steps of a (lazy) nldas dataset into a zarr store.
+    this is the part of nldas_to_zarr after connecting to the server, so it
+    can be run against a local stand-in of the server (see
+    benchmark_pull_nldas.py)
+    :param ds: [xarray dataset] dataset representing server data
+    :param zarr_store: [str or s3fsMap] the zarr store to write to
+    :param end_date: [str] date until which the data should be pulled
+    :param time_pull_size: [int] the number of dates to pull at a time
+    :param time_chunk: [int] the zarr chunk size for the time dimension
+    :param workers: [int] the number of time slices to request at once
+    :param region: [bool] whether to write to a pre-allocated store
+    :param time_range: [tuple] (start, end) time step numbers to fill when
+    region is True
+    :return: [int] the number of bytes written
+    """
+    if region:
+        init_region_store(ds, zarr_store, get_total_time_steps(end_date))
+        time_slices = get_undone_region_slices(zarr_store, time_pull_size,
+                                               time_range)
+        return write_time_slices(ds, zarr_store, time_slices, workers,
+                                 region=True)
+
+    time_slices = get_undone_range(zarr_store, time_pull_size, end_date,
+                                   time_chunk)
+    return write_time_slices(ds, zarr_store, time_slices, workers)
 
 
 def get_urs_pass_user(netrc_file):
@@ -149,16 +508,18 @@ if __name__ == '__main__':
     # zarr_store = snakemake.params.zarr_store
     # indicator_file = snakemake.output[0]
     zarr_store = s3map
-    time_pull_size= 959
+    time_pull_size = 960
     lat_chunk = 112
     lon_chunk = 464
     time_chunk = 960
-    
+    workers = 4
+
 
     username, password = get_urs_pass_user("/home/ec2-user/.netrc")
     nldas_to_zarr(zarr_store, password, username,
                   time_pull_size=time_pull_size, lat_chunk=lat_chunk,
-                  lon_chunk=lon_chunk, time_chunk=time_chunk, end_date='2020-12-31')
+                  lon_chunk=lon_chunk, time_chunk=time_chunk, end_date='2020-12-31',
+                  workers=workers)
     # write_indicator_file(nldas_to_zarr, indicator_file)
 
 
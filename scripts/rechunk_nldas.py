@@ -0,0 +1,282 @@
+"""
+This module builds a cell-major copy of the nldas zarr store. The pulled store
+is chunked by time (e.g., lat 112 x lon 464 x time 960), which is good for
+pulling but means that getting a long time series for a few cells reads a
+chunk of the whole grid for every time chunk. The cell-major copy stacks lat
+and lon into one 'nldas_grid_no' dimension (numbered the same way as the
+weight grid) and uses long time chunks, so a few cells for all times only
+touch a few chunks.
+"""
+import math
+import time
+import dask.array as da
+import numpy as np
+import xarray as xr
+import zarr
+from utils import trim_to_time_done, get_nldas_grid_no
+
+cell_dim = 'nldas_grid_no'
+
+
+def get_block_shape(num_lon, row_chunk, source_time_chunk, cell_chunk,
+                    time_chunk, itemsize, max_mem=5e8):
+    """
+    get the number of grid rows and time steps to rechunk at a time. the time
+    window is a multiple of both the source and the copy's time chunks, so
+    the blocks read whole source chunks and each chunk of the copy is written
+    by just one block (and so once, and never by two blocks at the same
+    time). a block takes the rows of a source lat chunk across the whole grid
+    if that fits in max_mem, so each source chunk is read once. otherwise it
+    takes as many rows as fit, in whole rows of the copy's cell chunks, and
+    the source chunks are read more than once
+    :param num_lon: [int] number of grid columns
+    :param row_chunk: [int] the lat chunk size of the source store
+    :param source_time_chunk: [int] the time chunk size of the source store
+    :param cell_chunk: [int] the cell chunk size of the copy
+    :param time_chunk: [int] the time chunk size of the copy
+    :param itemsize: [int] bytes per value
+    :param max_mem: [float] max bytes of one block
+    :return: [tuple] (number of grid rows per block, number of time steps per
+    block)
+    """
+    window = source_time_chunk * time_chunk // math.gcd(source_time_chunk,
+                                                        time_chunk)
+    row_bytes = num_lon * window * itemsize
+    # the number of grid rows that make up whole cell chunks of the copy
+    row_unit = cell_chunk // math.gcd(cell_chunk, num_lon)
+    if row_chunk % row_unit == 0 and row_chunk * row_bytes <= max_mem:
+        num_windows = int(max_mem // (row_chunk * row_bytes))
+        return row_chunk, num_windows * window
+    num_rows = int(max_mem // row_bytes) // row_unit * row_unit
+    if num_rows < 1:
+        raise ValueError(f"max_mem ({max_mem:.0f} bytes) is less than "
+                         f"{row_unit} grid rows (whole cell chunks) for "
+                         f"{window} time steps (a multiple of the source and "
+                         f"the copy's time chunks), which is "
+                         f"{row_unit * row_bytes} bytes")
+    print(f"a lat chunk of the source does not fit in max_mem for {window} "
+          f"time steps. rechunking {num_rows} rows at a time, so the source "
+          f"chunks are read more than once", flush=True)
+    return num_rows, window
+
+
+def get_rechunk_blocks(var_names, num_lat, num_lon, num_times, block_rows,
+                       time_window, time_start=0):
+    """
+    get the (variable, cell slice, time slice) blocks to rechunk, in order.
+    the cells of a block are block_rows whole grid rows and the time windows
+    start at multiples of time_window so they line up with the source and the
+    copy's time chunks (see get_block_shape)
+    :param var_names: [list] the names of the variables
+    :param num_lat: [int] number of grid rows
+    :param num_lon: [int] number of grid columns
+    :param num_times: [int] total number of time steps
+    :param block_rows: [int] number of grid rows per block
+    :param time_window: [int] number of time steps per block
+    :param time_start: [int] the time step to start from
+    :return: [list] (variable, cell slice, time slice) tuples
+    """
+    if time_start >= num_times:
+        return []
+    first_end = (time_start // time_window + 1) * time_window
+    time_bounds = [time_start] + list(range(first_end, num_times,
+                                            time_window)) + [num_times]
+    return [(var_name, slice(r * num_lon,
+                             min(r + block_rows, num_lat) * num_lon),
+             slice(t_start, t_end))
+            for t_start, t_end in zip(time_bounds[:-1], time_bounds[1:])
+            for r in range(0, num_lat, block_rows)
+            for var_name in var_names]
+
+
+def init_cell_major_store(ds, out_store, cell_chunk, time_chunk):
+    """
+    pre-allocate the cell-major store (only metadata and coordinates are
+    written), replacing anything that is already there. the number of time
+    steps of the source data is recorded in the store's attrs
+    :param ds: [xarray dataset] the time-major nldas data
+    :param out_store: [str or s3fsMap] the cell-major zarr store
+    :param cell_chunk: [int] the cell chunk size
+    :param time_chunk: [int] the time chunk size
+    :return: None
+    """
+    num_lat, num_lon = ds.sizes['lat'], ds.sizes['lon']
+    num_cells = num_lat * num_lon
+    shape = (num_cells, ds.sizes['time'])
+    data_vars = {}
+    for var_name in ds.data_vars:
+        data = da.zeros(shape, chunks=(cell_chunk, time_chunk),
+                        dtype=ds[var_name].dtype)
+        data_vars[var_name] = xr.DataArray(data, dims=(cell_dim, 'time'),
+                                           attrs=ds[var_name].attrs)
+    coords = {cell_dim: get_nldas_grid_no(ds), 'time': ds.time.values,
+              'lat': (cell_dim, np.repeat(ds.lat.values, num_lon)),
+              'lon': (cell_dim, np.tile(ds.lon.values, num_lat))}
+    template = xr.Dataset(data_vars, coords=coords)
+    template.attrs['layout'] = 'cell_major'
+    template.attrs['source_num_times'] = ds.sizes['time']
+    template.attrs['time_start'] = 0
+    # the number of blocks is recorded once they are planned
+    template.attrs['num_blocks'] = -1
+    template.attrs['blocks_done'] = 0
+    template.to_zarr(out_store, mode='w', compute=False)
+
+
+def extend_cell_major_store(ds, out_store, num_done):
+    """
+    grow the time axis of the cell-major store to the time steps of the
+    source data. the first num_done time steps are already in the store
+    :param ds: [xarray dataset] the time-major nldas data
+    :param out_store: [str or s3fsMap] the cell-major zarr store
+    :param num_done: [int] the number of time steps in the store
+    :return: None
+    """
+    num_times = ds.sizes['time']
+    z = zarr.open_group(out_store, mode='a')
+    for var_name in ds.data_vars:
+        arr = z[var_name]
+        arr.resize((arr.shape[0], num_times))
+    time_arr = z['time']
+    time_arr.resize((num_times,))
+    new_times, _, _ = xr.coding.times.encode_cf_datetime(
+        ds.time.values[num_done:], time_arr.attrs['units'],
+        time_arr.attrs.get('calendar'))
+    time_arr[num_done:] = new_times
+    zarr.consolidate_metadata(out_store)
+    update_store_attrs(out_store, {'source_num_times': num_times,
+                                   'time_start': num_done, 'num_blocks': -1,
+                                   'blocks_done': 0})
+
+
+def prepare_cell_major_store(ds, out_store, cell_chunk, time_chunk):
+    """
+    get the cell-major store ready to be filled from the source data and get
+    the time step to rechunk from. if the store was made from the same time
+    steps, it is left as it is so the rechunk can resume. if it is a complete
+    copy of the first time steps of the source (e.g., more were pulled since),
+    it is extended. otherwise (or if there is no store) it is made from
+    scratch
+    :param ds: [xarray dataset] the time-major nldas data
+    :param out_store: [str or s3fsMap] the cell-major zarr store
+    :param cell_chunk: [int] the cell chunk size
+    :param time_chunk: [int] the time chunk size
+    :return: [int] the time step to rechunk from
+    """
+    try:
+        ds_cell = xr.open_zarr(out_store)
+    except (ValueError, KeyError, FileNotFoundError):
+        ds_cell = None
+    if ds_cell is not None:
+        cell_times = ds_cell.time.values
+        num_done = len(cell_times)
+        same_start = set(ds_cell.data_vars) == set(ds.data_vars) and \
+            ds_cell.sizes[cell_dim] == ds.sizes['lat'] * ds.sizes['lon'] and \
+            (ds_cell[cell_dim].values == get_nldas_grid_no(ds)).all() and \
+            ds_cell.attrs.get('source_num_times') == num_done and \
+            num_done <= ds.sizes['time'] and \
+            (cell_times == ds.time.values[:num_done]).all()
+        if same_start and num_done == ds.sizes['time']:
+            return ds_cell.attrs.get('time_start', 0)
+        if same_start and is_complete_cell_major(ds_cell):
+            print(f"extending the cell-major copy from {num_done} to "
+                  f"{ds.sizes['time']} time steps", flush=True)
+            extend_cell_major_store(ds, out_store, num_done)
+            return num_done
+        print("the cell-major copy does not match the nldas data. making it "
+              "again", flush=True)
+    init_cell_major_store(ds, out_store, cell_chunk, time_chunk)
+    return 0
+
+
+def read_cell_block(ds, var_name, cell_slice, time_slice):
+    """
+    read a block of cells (whole grid rows, numbered lat-major) and time steps
+    of one variable from the time-major nldas data as a cell-major dataset
+    :param ds: [xarray dataset] the time-major nldas data
+    :param var_name: [str] the variable to read
+    :param cell_slice: [slice] the cells to read (whole rows)
+    :param time_slice: [slice] the time steps to read
+    :return: [xarray dataset] the block (nldas_grid_no x time)
+    """
+    num_lon = ds.sizes['lon']
+    rows = ds[var_name].isel(lat=slice(cell_slice.start // num_lon,
+                                       cell_slice.stop // num_lon),
+                             time=time_slice)
+    values = rows.transpose('time', 'lat', 'lon').values
+    values = values.reshape(values.shape[0], -1)
+    return xr.Dataset({var_name: ((cell_dim, 'time'), values.T)})
+
+
+def update_store_attrs(out_store, attrs):
+    z = zarr.open_group(out_store, mode='a')
+    z.attrs.update(attrs)
+    zarr.consolidate_metadata(out_store)
+
+
+def record_blocks_done(out_store, blocks_done):
+    update_store_attrs(out_store, {'blocks_done': blocks_done})
+
+
+def rechunk_nldas(nldas_store, out_store, cell_chunk=1856, time_chunk=8640,
+                  max_mem=5e8):
+    """
+    build a cell-major copy of the nldas zarr store (nldas_grid_no x time).
+    the copy is made one variable at a time in blocks of whole source chunks
+    that fit in max_mem and line up with the chunks of the copy (see
+    get_block_shape and get_rechunk_blocks). the blocks are written to a pre-allocated store and the number of
+    blocks done is recorded after each one, so the rechunk can be restarted
+    where it left off. if the source has more time steps than a complete
+    copy, only the new ones are rechunked; if it has changed otherwise, the
+    copy is made again
+    :param nldas_store: [str or s3fsMap] the time-major nldas zarr store
+    :param out_store: [str or s3fsMap] the cell-major zarr store
+    :param cell_chunk: [int] the cell chunk size of the copy (the default is
+    four rows of the nldas grid)
+    :param time_chunk: [int] the time chunk size of the copy (the default is
+    360 days of hourly data, which is a multiple of the 480 and 960 step time
+    chunks of the pulls, so the time windows of the blocks can line up with
+    both)
+    :param max_mem: [float] max bytes of data in one block
+    :return: None
+    """
+    ds = trim_to_time_done(xr.open_zarr(nldas_store))
+    ds = ds[list(ds.data_vars)]
+    var_names = list(ds.data_vars)
+    source_chunks = dict(zip(ds[var_names[0]].dims, ds[var_names[0]].chunks))
+    itemsize = max(ds[v].dtype.itemsize for v in var_names)
+    time_start = prepare_cell_major_store(ds, out_store, cell_chunk,
+                                          time_chunk)
+    # line the blocks up with the chunks of the store, which may have been
+    # made by an earlier run with other chunk sizes
+    out_cell_chunk, out_time_chunk = zarr.open_group(
+        out_store, mode='r')[var_names[0]].chunks
+    block_rows, time_window = get_block_shape(
+        ds.sizes['lon'], source_chunks['lat'][0], source_chunks['time'][0],
+        out_cell_chunk, out_time_chunk, itemsize, max_mem)
+    blocks = get_rechunk_blocks(var_names, ds.sizes['lat'], ds.sizes['lon'],
+                                ds.sizes['time'], block_rows, time_window,
+                                time_start)
+    update_store_attrs(out_store, {'num_blocks': len(blocks)})
+    blocks_done = xr.open_zarr(out_store).attrs.get('blocks_done', 0)
+    for i in range(blocks_done, len(blocks)):
+        start_time = time.time()
+        var_name, cell_slice, time_slice = blocks[i]
+        print(f"rechunking block {i + 1} of {len(blocks)}: {var_name} cells "
+              f"{cell_slice.start} to {cell_slice.stop}, time steps "
+              f"{time_slice.start} to {time_slice.stop}", flush=True)
+        ds_block = read_cell_block(ds, var_name, cell_slice, time_slice)
+        ds_block.to_zarr(out_store,
+                         region={cell_dim: cell_slice, 'time': time_slice})
+        record_blocks_done(out_store, i + 1)
+        print("time elapsed", time.time() - start_time, flush=True)
+
+
+def is_complete_cell_major(ds):
+    """
+    check if a dataset is a cell-major nldas copy that has been completely
+    written
+    :param ds: [xarray dataset] the dataset to check
+    :return: [bool] True if it is a complete cell-major copy
+    """
+    return ds.attrs.get('layout') == 'cell_major' and \
+        ds.attrs.get('blocks_done') == ds.attrs.get('num_blocks')
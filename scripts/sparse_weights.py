@@ -0,0 +1,254 @@
+"""
+This module contains functions for storing and using the catchment/grid weight
+matrix in a sparse, coordinate (COO) format. Each row of a sparse weight table
+is one (nhd_comid, nldas_grid_no, weight) triplet for a catchment and grid cell
+that actually intersect. Catchments that do not intersect any grid cell do not
+show up in the sparse tables.
+"""
+import numpy as np
+import pandas as pd
+import xarray as xr
+import zarr
+from scipy import sparse
+
+idx_name = 'nhd_comid'
+col_name = 'nldas_grid_no'
+data_name = 'weight'
+nnz_dim = 'nnz'
+triplet_cols = [idx_name, col_name, data_name]
+triplet_dtypes = {idx_name: 'uint32', col_name: 'uint32', data_name: 'float32'}
+quantize_error_keys = ['max_error', 'mean_error', 'max_sum_error',
+                       'num_weights']
+# nldas has 224 rows and 464 columns
+nldas_num_grid_cells = 224 * 464
+
+
+def format_triplets(triplets):
+    """
+    make sure the triplets have the standard columns and dtypes and combine
+    any duplicate (comid, grid cell) pairs by summing their weights
+    :param triplets: [pandas df] df with nhd_comid, nldas_grid_no, and weight
+    columns
+    :return: [pandas df] formatted triplets sorted by comid and grid cell
+    """
+    triplets = triplets[triplet_cols].astype(triplet_dtypes)
+    triplets = triplets.groupby([idx_name, col_name], as_index=False,
+                                sort=True)[data_name].sum()
+    return triplets
+
+
+def overlay_to_triplets(inter, polygon_id_col, grid_id_col='grid_num',
+                        weight_col='weighted_area'):
+    """
+    get the sparse weight triplets straight from the result of the overlay of
+    the grid and the catchments
+    :param inter: [geodataframe] intersection of the grid and catchments
+    :param polygon_id_col: [str] name of the catchment id column
+    :param grid_id_col: [str] name of the grid cell id column
+    :param weight_col: [str] name of the column with the area weights
+    :return: [pandas df] the weight triplets
+    """
+    triplets = pd.DataFrame({idx_name: inter[polygon_id_col].values,
+                             col_name: inter[grid_id_col].values,
+                             data_name: inter[weight_col].values})
+    return format_triplets(triplets)
+
+
+def dense_to_triplets(weight_df, scale=1.):
+    """
+    convert a dense weight matrix (catchments as the index, grid cells as the
+    columns) into sparse weight triplets. zeros and NaNs are dropped
+    :param weight_df: [pandas df] the dense weight matrix
+    :param scale: [float] number the stored values are divided by to get the
+    weights (e.g., 255 for the uint8 chunks)
+    :return: [pandas df] the weight triplets
+    """
+    values = weight_df.fillna(0).values
+    rows, cols = np.nonzero(values)
+    triplets = pd.DataFrame({idx_name: np.asarray(weight_df.index)[rows],
+                             col_name: np.asarray(weight_df.columns,
+                                                  dtype='uint32')[cols],
+                             data_name: values[rows, cols] / scale})
+    return format_triplets(triplets)
+
+
+def quantize_triplets(triplets, dtype='uint16'):
+    """
+    quantize the weights of weight triplets to unsigned integers (weight x
+    scale, where the scale is the max value of dtype, e.g., 255 for uint8).
+    the weights are rounded so that the quantized weights of each catchment
+    still add up to its covered fraction (to the nearest 1/scale)
+    :param triplets: [pandas df] the weight triplets with float weights
+    :param dtype: [str] 'uint8' or 'uint16'
+    :return: [tuple] (triplets with quantized weights, dict with the max and
+    mean absolute quantization error of the weights, the max error of the
+    catchment sums and the number of weights. see combine_quantize_errors to
+    add up the errors of several batches)
+    """
+    scale = np.iinfo(dtype).max
+    triplets = triplets.reset_index(drop=True)
+    comids = triplets[idx_name].values
+    weights = np.clip(triplets[data_name].values.astype('float64'), 0, 1)
+    scaled = weights * scale
+    floored = np.floor(scaled)
+    remainder = scaled - floored
+    # the number of 1/scale steps each catchment is short after flooring
+    target = pd.Series(scaled).groupby(comids).transform('sum').round()
+    deficit = target - pd.Series(floored).groupby(comids).transform('sum')
+    # give those steps to the weights with the largest remainders
+    order = np.lexsort((-remainder, comids))
+    rank = np.empty(len(order), dtype='int64')
+    rank[order] = pd.Series(comids[order]).groupby(
+        comids[order]).cumcount().values
+    quantized = floored + (rank < deficit.values)
+
+    error = quantized / scale - weights
+    sum_error = pd.Series(error).groupby(comids).sum()
+    errors = {'max_error': float(np.abs(error).max()) if len(error) else 0.,
+              'mean_error': float(np.abs(error).mean()) if len(error) else 0.,
+              'max_sum_error': float(sum_error.abs().max())
+              if len(error) else 0.,
+              'num_weights': len(error)}
+    triplets[data_name] = quantized.astype(dtype)
+    return triplets, errors
+
+
+def combine_quantize_errors(errors, new_errors):
+    """
+    add the quantization errors of one more batch of triplets to the errors
+    of the batches before it
+    :param errors: [dict] the errors so far (see quantize_triplets) or None
+    :param new_errors: [dict] the errors of the new batch
+    :return: [dict] the max and mean errors over all of the batches
+    """
+    if not errors:
+        return dict(new_errors)
+    num_weights = errors['num_weights'] + new_errors['num_weights']
+    total_error = errors['mean_error'] * errors['num_weights'] + \
+        new_errors['mean_error'] * new_errors['num_weights']
+    return {'max_error': max(errors['max_error'], new_errors['max_error']),
+            'mean_error': total_error / num_weights if num_weights else 0.,
+            'max_sum_error': max(errors['max_sum_error'],
+                                 new_errors['max_sum_error']),
+            'num_weights': num_weights}
+
+
+def write_quantize_errors(zarr_store, errors):
+    """
+    store the quantization errors of all of the weights in a sparse weight
+    store in its attrs (as weight_max_error, weight_mean_error,
+    weight_max_sum_error and weight_num_weights, next to weight_scale)
+    :param zarr_store: [str or s3fsMap] the weight zarr store
+    :param errors: [dict] the errors (see combine_quantize_errors)
+    :return: None
+    """
+    print(f"quantization max error: {errors['max_error']}, mean error: "
+          f"{errors['mean_error']}, max catchment sum error: "
+          f"{errors['max_sum_error']}", flush=True)
+    z = zarr.open_group(zarr_store, mode='a')
+    z.attrs.update({f'weight_{k}': errors[k] for k in quantize_error_keys})
+    # so the consolidated metadata has the new attrs
+    zarr.consolidate_metadata(zarr_store)
+
+
+def is_quantized(triplets):
+    """
+    check if the weights of weight triplets are quantized (stored as integers)
+    """
+    return np.issubdtype(triplets[data_name].dtype, np.integer)
+
+
+def is_sparse_weights(weights):
+    """
+    check if weights (df or dataset) are in the sparse triplet format
+    :param weights: [pandas df or xarray dataset] weights to check
+    :return: [bool] True if sparse
+    """
+    if isinstance(weights, xr.Dataset):
+        return nnz_dim in weights.dims
+    return list(weights.columns) == triplet_cols
+
+
+def triplets_to_dataset(triplets, num_grid_cells=nldas_num_grid_cells,
+                        chunk_size=1000000):
+    """
+    convert weight triplets into an xarray dataset along a single 'nnz'
+    dimension so that it can be written to (and appended to in) zarr
+    :param triplets: [pandas df] the weight triplets (float or quantized)
+    :param num_grid_cells: [int] the total number of cells in the grid
+    :param chunk_size: [int] the zarr chunk size along the nnz dimension
+    :return: [xarray dataset] the sparse weights
+    """
+    data_vars = {c: ((nnz_dim,), triplets[c].values) for c in triplet_cols}
+    ds = xr.Dataset(data_vars)
+    ds.attrs['weight_format'] = 'coo'
+    ds.attrs['num_grid_cells'] = int(num_grid_cells)
+    if is_quantized(triplets):
+        # the stored weights need to be divided by this to get the weights
+        ds.attrs['weight_scale'] = int(np.iinfo(triplets[data_name].dtype).max)
+    if chunk_size:
+        ds = ds.chunk({nnz_dim: chunk_size})
+        for c in triplet_cols:
+            ds[c].encoding['chunks'] = (chunk_size,)
+    return ds
+
+
+def dataset_to_triplets(ds):
+    """
+    read the weight triplets out of a sparse weight dataset. quantized weights
+    are converted back to float weights
+    :param ds: [xarray dataset] the sparse weights
+    :return: [pandas df] the weight triplets
+    """
+    triplets = pd.DataFrame({c: ds[c].values for c in triplet_cols})
+    scale = ds.attrs.get('weight_scale')
+    if scale:
+        triplets[data_name] = (triplets[data_name] / scale).astype('float32')
+    return triplets
+
+
+def triplets_to_dense(ds):
+    """
+    expand a sparse weight dataset into a dense (nhd_comid x nldas_grid_no)
+    weight DataArray like the one stored in the dense zarr format
+    :param ds: [xarray dataset] the sparse weights
+    :return: [xarray DataArray] the dense weights
+    """
+    triplets = dataset_to_triplets(ds)
+    num_grid_cells = ds.attrs.get('num_grid_cells', nldas_num_grid_cells)
+    comids = np.unique(triplets[idx_name])
+    rows = np.searchsorted(comids, triplets[idx_name])
+    dense = np.zeros((len(comids), num_grid_cells), dtype='float32')
+    dense[rows, triplets[col_name].values] = triplets[data_name].values
+    return xr.DataArray(dense, [(idx_name, comids),
+                                (col_name, np.arange(num_grid_cells))],
+                        name=data_name)
+
+
+def triplets_to_csr(ds):
+    """
+    convert a sparse weight dataset into a scipy CSR matrix (nhd_comid x
+    nldas_grid_no)
+    :param ds: [xarray dataset] the sparse weights
+    :return: [tuple] (CSR weight matrix, array of the comids for the rows)
+    """
+    triplets = dataset_to_triplets(ds)
+    num_grid_cells = ds.attrs.get('num_grid_cells', nldas_num_grid_cells)
+    comids = np.unique(triplets[idx_name])
+    rows = np.searchsorted(comids, triplets[idx_name])
+    csr = sparse.csr_matrix((triplets[data_name].values,
+                             (rows, triplets[col_name].values)),
+                            shape=(len(comids), num_grid_cells))
+    return csr, comids
+
+
+def dense_to_csr(w):
+    """
+    convert a dense weight DataArray (nhd_comid x nldas_grid_no) into a scipy
+    CSR matrix
+    :param w: [xarray DataArray] the dense weights
+    :return: [tuple] (CSR weight matrix, array of the comids for the rows)
+    """
+    w = w.transpose(idx_name, col_name)
+    csr = sparse.csr_matrix(np.nan_to_num(w.values))
+    return csr, w[idx_name].values
@@ -1,21 +1,36 @@
+import codecs
 import datetime
+import io
 import json
+from collections import deque
+from operator import itemgetter
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 import pandas as pd
 import requests
 import xarray as xr
 
+import http_client
+
 from utils import divide_chunks, get_indices_not_done, \
     get_site_codes, append_to_csv_column_wise, load_s3_zarr_store,\
     convert_df_to_dataset
 
+# utc offsets (hours) of the time zone codes in nwis rdb data
+nwis_tz_offsets = {'UTC': 0, 'GMT': 0, 'AST': -4, 'ADT': -3, 'EST': -5,
+                   'EDT': -4, 'CST': -6, 'CDT': -5, 'MST': -7, 'MDT': -6,
+                   'PST': -8, 'PDT': -7, 'AKST': -9, 'AKDT': -8, 'HST': -10,
+                   'HDT': -9, 'SST': -11, 'GST': 10, 'ChST': 10}
+
 
 def get_all_streamflow_data(output_file, sites_file, huc2=None,
                             num_sites_per_chunk=5, start_date="1970-01-01",
                             end_date='2019-01-01', time_scale='H',
                             output_format='zarr', num_site_chunks_write=6,
-                            s3=False):
+                            s3=False, workers=1, stream=False,
+                            response_format='json', window_freq=None,
+                            window_workers=4):
     """
     gets all streamflow data for a date range for a given huc2. Calls are
     chunked by station
@@ -36,6 +51,21 @@ def get_all_streamflow_data(output_file, sites_file, huc2=None,
     :param output_format: [str] the format of the output file. 'csv' or 'zarr'
     :param num_site_chunks_write:
     :param S3:
+    :param workers: [int] the number of web service calls to keep going at
+    the same time. the data are still written in the order of the sites and
+    in batches of num_site_chunks_write chunks
+    :param stream: [bool] if True, decode each response one site at a time
+    as it comes in instead of all at once (see iter_nwis_time_series)
+    :param response_format: [str] the format to ask nwis for, 'json' or
+    'rdb' (tab-delimited, which is much smaller)
+    :param window_freq: [str] if given, each chunk of sites is asked for in
+    date windows of this pandas frequency (e.g., 'YS' for yearly or '10YS'
+    for by decade) instead of all at once (see get_streamflow_data_windows)
+    :param window_workers: [int] the number of windows of a chunk of sites to
+    ask for at the same time. the windows of all of the chunks are asked for
+    with one pool of workers * window_workers threads that is kept for the
+    whole run, so the threads' http sessions (and their kept-alive
+    connections) are used again from chunk to chunk
     :return: None
     """
     product = get_product_from_time_scale(time_scale)
@@ -46,33 +76,114 @@ def get_all_streamflow_data(output_file, sites_file, huc2=None,
                                           s3=s3)
     site_codes_chunked = divide_chunks(not_done_sites, num_sites_per_chunk)
 
+    window_pool = ThreadPool(workers * window_workers) if window_freq \
+        else None
+    try:
+        write_streamflow_chunks(
+            iterate_streamflow_chunks(site_codes_chunked, start_date, end_date,
+                                      product, time_scale, workers, stream,
+                                      response_format, window_freq,
+                                      window_pool),
+            not_done_sites, output_file, output_format, num_sites_per_chunk,
+            num_site_chunks_write)
+    finally:
+        if window_pool:
+            window_pool.terminate()
+
+
+def write_streamflow_chunks(chunk_results, not_done_sites, output_file,
+                            output_format, num_sites_per_chunk,
+                            num_site_chunks_write):
+    """
+    write out the streamflow data of the site chunks in batches of
+    num_site_chunks_write chunks
+    :param chunk_results: [iterable] (site chunk, streamflow df or None)
+    tuples (see iterate_streamflow_chunks)
+    :param not_done_sites: [list] the site codes that are being retrieved
+    :return: None
+    """
     # loop through site_code_chunks
     chunk_dfs = []
     i = 0
-    for site_chunk in site_codes_chunked:
+    for site_chunk, streamflow_df_sites in chunk_results:
         last_chunk = False
         if site_chunk[-1] == not_done_sites[-1]:
             last_chunk = True
-        streamflow_df_sites = None
-        # catch if there is a problem on the server retrieving the data
-        try:
-            streamflow_df_sites = get_streamflow_data(site_chunk,
-                                                      start_date,
-                                                      end_date,
-                                                      product,
-                                                      time_scale)
-        except json.decoder.JSONDecodeError:
-            continue
+        write_now = False
         if streamflow_df_sites is not None:
             chunk_dfs.append(streamflow_df_sites)
             # add the number of stations for which we got data
             i += streamflow_df_sites.shape[1]
+            write_now = not i % (num_site_chunks_write * num_sites_per_chunk)
+
+        if chunk_dfs and (write_now or last_chunk):
+            print('writing out', flush=True)
+            write_out_chunks(chunk_dfs, output_file, output_format)
+            http_client.print_stats()
+            chunk_dfs = []
+
+
+def get_streamflow_data_chunk(site_chunk, start_date, end_date, product,
+                              time_scale, stream=False, response_format='json',
+                              window_freq=None, window_pool=None):
+    """
+    get the streamflow data for one chunk of sites
+    :return: [pandas df] the streamflow data or None if there was a problem
+    on the server retrieving the data
+    """
+    try:
+        if window_freq:
+            return get_streamflow_data_windows(
+                site_chunk, start_date, end_date, product, time_scale,
+                window_freq, stream=stream, response_format=response_format,
+                window_pool=window_pool)
+        return get_streamflow_data(site_chunk, start_date, end_date, product,
+                                   time_scale, stream=stream,
+                                   response_format=response_format)
+    except (json.decoder.JSONDecodeError,
+            requests.exceptions.RequestException):
+        return None
 
-            if not i % (num_site_chunks_write * num_sites_per_chunk) or \
-                    last_chunk:
-                print('writing out', flush=True)
-                write_out_chunks(chunk_dfs, output_file, output_format)
-                chunk_dfs = []
+
+def iterate_streamflow_chunks(site_codes_chunked, start_date, end_date,
+                              product, time_scale, workers=1, stream=False,
+                              response_format='json', window_freq=None,
+                              window_pool=None):
+    """
+    get the streamflow data for each chunk of sites. with more than one
+    worker, up to that many chunks are requested at the same time, but the
+    data are still given back in the order of the chunks
+    :param site_codes_chunked: [iterable] lists of site codes
+    :param start_date: [str] the start date of the data
+    :param end_date: [str] the end date of the data
+    :param product: [str] the nwis product ('iv' or 'dv')
+    :param time_scale: [str] the time scale to resample to
+    :param workers: [int] the number of requests to have going at once
+    :param stream: [bool] if True, decode the responses as they come in
+    :param response_format: [str] the format to ask nwis for, 'json' or 'rdb'
+    :param window_freq: [str] if given, the frequency of the date windows to
+    ask for each chunk in
+    :param window_pool: [ThreadPool] the pool to ask for the windows with
+    :return: [generator] (site chunk, streamflow df or None) tuples
+    """
+    args = (start_date, end_date, product, time_scale, stream,
+            response_format, window_freq, window_pool)
+    if workers <= 1:
+        for site_chunk in site_codes_chunked:
+            yield site_chunk, get_streamflow_data_chunk(site_chunk, *args)
+        return
+    pending = deque()
+    with ThreadPool(workers) as pool:
+        for site_chunk in site_codes_chunked:
+            pending.append((site_chunk, pool.apply_async(
+                get_streamflow_data_chunk, (site_chunk,) + args)))
+            # keep workers requests going while the oldest is handed back
+            if len(pending) >= workers:
+                finished_chunk, result = pending.popleft()
+                yield finished_chunk, result.get()
+        while pending:
+            finished_chunk, result = pending.popleft()
+            yield finished_chunk, result.get()
 
 
 def write_out_chunks(chunks_dfs, out_file, out_format):
@@ -115,30 +226,201 @@ def append_to_zarr(streamflow_df, output_zarr):
     ds.to_zarr(output_zarr, append_dim='site_code', mode='a')
 
 
-def get_streamflow_data(sites, start_date, end_date, product, time_scale):
-    response = call_nwis_service(sites, start_date, end_date, product)
-    data = json.loads(response.text)
-    streamflow_df = nwis_json_to_df(data, start_date, end_date,
-                                    time_scale)
-    return streamflow_df
+def get_streamflow_data(sites, start_date, end_date, product, time_scale,
+                        stream=False, response_format='json'):
+    """
+    get the streamflow data for a list of sites
+    :param stream: [bool] if True, the response is decoded one site at a time
+    as it comes in, so the whole response text and json are never held in
+    memory at once
+    :param response_format: [str] the format to ask nwis for, 'json' or 'rdb'
+    :return: [pandas df] the streamflow data (None if there is no data)
+    """
+    if response_format == 'rdb':
+        response = call_nwis_service(sites, start_date, end_date, product,
+                                     stream=stream, response_format='rdb')
+        try:
+            byte_chunks = response.iter_content(2 ** 20) if stream \
+                else [response.content]
+            return nwis_rdb_to_df(iter_rdb_sections(byte_chunks), start_date,
+                                  end_date, time_scale)
+        finally:
+            response.close()
+    elif response_format != 'json':
+        raise ValueError("response_format should be 'json' or 'rdb'")
+    if not stream:
+        response = call_nwis_service(sites, start_date, end_date, product)
+        data = json.loads(response.text)
+        streamflow_df = nwis_json_to_df(data, start_date, end_date,
+                                        time_scale)
+        return streamflow_df
+    response = call_nwis_service(sites, start_date, end_date, product,
+                                 stream=True)
+    try:
+        time_series = iter_nwis_time_series(response.iter_content(2 ** 20))
+        return nwis_time_series_to_df(time_series, start_date, end_date,
+                                      time_scale)
+    finally:
+        response.close()
+
+
+def get_date_windows(start_date, end_date, window_freq):
+    """
+    split the period from start_date to end_date into date windows. nwis
+    takes the dates in the local time of the sites, so each window but the
+    last is asked for through one day past the start of the next window. its
+    data are kept up to that day (utc) and the next window's data from then
+    on, so neither side of the cut is missing any time steps
+    :param start_date: [str] the start date of the period
+    :param end_date: [str] the end date of the period
+    :param window_freq: [str] pandas frequency of the window starts (e.g.,
+    'YS' for yearly or '10YS' for by decade)
+    :return: [list] (request start date, request end date, keep from, keep
+    until) tuples. the keep times are utc Timestamps or None for no limit
+    """
+    start = pd.Timestamp(start_date)
+    end = pd.Timestamp(end_date)
+    bounds = [b for b in pd.date_range(start, end, freq=window_freq)
+              if start < b < end]
+    bounds = [start] + bounds + [end]
+    cuts = [None] + [b + pd.Timedelta(days=1) for b in bounds[1:-1]] + [None]
+    windows = []
+    for i in range(len(bounds) - 1):
+        request_end = bounds[i + 1]
+        if cuts[i + 1] is not None:
+            request_end = cuts[i + 1]
+        windows.append((bounds[i].strftime('%Y-%m-%d'),
+                        request_end.strftime('%Y-%m-%d'), cuts[i],
+                        cuts[i + 1]))
+    return windows
+
+
+def get_streamflow_data_windows(sites, start_date, end_date, product,
+                                time_scale, window_freq, window_workers=4,
+                                stream=False, response_format='json',
+                                window_pool=None):
+    """
+    get the streamflow data for a list of sites in date windows (see
+    get_date_windows) instead of in one call, so no one response is very
+    large. the windows are asked for at the same time and the resampled
+    windows are put back together in order
+    :param window_freq: [str] pandas frequency of the window starts
+    :param window_workers: [int] the number of windows to ask for at once if
+    no window_pool is given
+    :param window_pool: [ThreadPool] a long-lived pool to ask for the windows
+    with. if None, a pool of window_workers threads is made for this call
+    :return: [pandas df] the streamflow data from start_date to end_date
+    (None if there is no data)
+    """
+    def get_window(window):
+        request_start, request_end, keep_from, keep_until = window
+        window_df = get_streamflow_data(sites, request_start, request_end,
+                                        product, time_scale, stream=stream,
+                                        response_format=response_format)
+        if window_df is None:
+            return None
+        if keep_from is not None:
+            window_df = window_df[window_df.index >= keep_from]
+        if keep_until is not None:
+            window_df = window_df[window_df.index < keep_until]
+        return window_df
+
+    windows = get_date_windows(start_date, end_date, window_freq)
+    if window_pool:
+        window_dfs = window_pool.map(get_window, windows)
+    else:
+        with ThreadPool(window_workers) as pool:
+            window_dfs = pool.map(get_window, windows)
+    window_dfs = [df for df in window_dfs if df is not None]
+    if not window_dfs:
+        return None
+    streamflow_df = pd.concat(window_dfs, axis=0, sort=False)
+    date_index = pd.date_range(start=start_date, end=end_date,
+                               freq=time_scale)
+    return streamflow_df.reindex(date_index)
 
 
-def call_nwis_service(sites, start_date, end_date, product):
+def iter_nwis_time_series(byte_chunks):
+    """
+    decode the 'timeSeries' list of an nwis json response one time series
+    (site) at a time from the raw bytes. only the text of the time series
+    being decoded (and what has come in after it) is held in memory
+    :param byte_chunks: [iterable] chunks of bytes of the response body
+    :return: [generator] the time series dicts
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    byte_chunks = iter(byte_chunks)
+    buffer = ''
+    pos = None
+    done_reading = False
+
+    def read_more():
+        nonlocal buffer, done_reading
+        chunk = next(byte_chunks, None)
+        if chunk is None:
+            done_reading = True
+            buffer += text_decoder.decode(b'', final=True)
+        else:
+            buffer += text_decoder.decode(chunk)
+
+    # find the start of the time series list
+    marker = '"timeSeries"'
+    while pos is None:
+        start = buffer.find(marker)
+        if start >= 0:
+            colon = buffer.find(':', start)
+            bracket = buffer.find('[', colon) if colon >= 0 else -1
+            if bracket >= 0:
+                pos = bracket + 1
+                break
+        if done_reading:
+            raise json.JSONDecodeError('no timeSeries list in the response',
+                                       buffer[:200], 0)
+        read_more()
+
+    # decode the time series one at a time. a failed decode is only tried
+    # again once the buffer has doubled so that decoding a large time series
+    # that comes in many chunks does not take quadratic time
+    tried_len = 0
+    while True:
+        buffer = buffer[pos:].lstrip(' \t\n\r,')
+        pos = 0
+        if buffer.startswith(']'):
+            return
+        if buffer and len(buffer) >= 2 * tried_len or done_reading:
+            try:
+                time_series, pos = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                if done_reading:
+                    raise
+                tried_len = len(buffer)
+            else:
+                tried_len = 0
+                yield time_series
+                continue
+        if done_reading:
+            raise json.JSONDecodeError('the timeSeries list did not end',
+                                       buffer[:200], 0)
+        read_more()
+
+
+def call_nwis_service(sites, start_date, end_date, product, stream=False,
+                      response_format='json'):
     """
     gets the data for a list of sites from a start date to an end date
+    :param stream: [bool] if True, the body is not downloaded until it is
+    read from the response
+    :param response_format: [str] the format to ask nwis for, 'json' or 'rdb'
     """
-    base_url = "http://waterservices.usgs.gov/nwis/{}/?format=json&sites={}&" \
+    base_url = "http://waterservices.usgs.gov/nwis/{}/?format={}&sites={}&" \
                "startDT={}&endDT={}&parameterCd=00060&siteStatus=all"
-    url = base_url.format(product, ",".join(sites), start_date, end_date)
+    url = base_url.format(product, response_format, ",".join(sites),
+                          start_date, end_date)
     request_start_time = datetime.datetime.now()
     print(f"starting request for sites {sites} at {request_start_time}, "
           f"for period {start_date} to {end_date}", flush=True)
-    r = None
-    while not r:
-        try:
-            r = requests.get(url)
-        except:
-            print('there was some problem. trying again', flush=True)
+    r = http_client.get(url, stream=stream)
     request_end_time = datetime.datetime.now()
     request_time = request_end_time - request_start_time
     print(f"took {request_time} to get data for huc {sites}", flush=True)
@@ -224,25 +506,222 @@ def format_df(ts_df, site_code, start_date, end_date, time_scale,
     return ts_df
 
 
-def nwis_json_to_df(json_data, start_date, end_date, time_scale='H'):
+def parse_nwis_datetimes(datetime_txt):
+    """
+    parse nwis datetime strings (e.g., '2019-01-01T00:15:00.000-05:00', or
+    with no utc offset for daily values) to utc datetimes without going
+    through a general datetime parser. the first 23 characters are the local
+    time and the rest is the utc offset
+    :param datetime_txt: [array-like] the datetime strings
+    :return: [numpy array] utc datetime64[ms] values
+    """
+    datetime_txt = np.asarray(datetime_txt, dtype=str)
+    local_time = datetime_txt.astype('U23').astype('datetime64[ms]')
+    if datetime_txt.dtype.itemsize // 4 < 29:
+        return local_time
+    # the offset characters as unicode code points (0 where there is none)
+    chars = datetime_txt.astype('U29').view(np.uint32).reshape(
+        len(datetime_txt), 29)
+    sign = np.where(chars[:, 23] == ord('-'), -1,
+                    np.where(chars[:, 23] == ord('+'), 1, 0))
+    digits = chars[:, 24:29].astype('int64') - ord('0')
+    offset_minutes = (digits[:, 0] * 10 + digits[:, 1]) * 60 + \
+        digits[:, 3] * 10 + digits[:, 4]
+    offset = (sign * offset_minutes).astype('timedelta64[m]')
+    return local_time - offset
+
+
+def format_ts_data(ts_data, site_code, start_date, end_date, time_scale,
+                   only_approved=True):
+    """
+    columnar version of format_df that goes straight from the list of nwis
+    json values to the formatted dataframe. the values, datetimes and first
+    qualifier codes are pulled out into numpy arrays in one pass and the
+    non-approved data are screened out with a mask
+    :param ts_data: [list] the 'value' list of dicts from the nwis json
+    :param site_code: (str) the site_code of the site
+    :param start_date: (str) start date of call
+    :param end_date: (str) end date of call
+    :param time_scale: (str) time scale to resample and reindex to
+    :param only_approved: (bool) whether or not to screen out non-approved data
+    points
+    :return: formatted dataframe
+    """
+    values, datetime_txt, qualifiers = zip(*map(
+        itemgetter('value', 'dateTime', 'qualifiers'), ts_data))
+    values = np.array(values).astype('float64')
+    datetimes = parse_nwis_datetimes(datetime_txt)
+    if only_approved:
+        qualifiers = np.fromiter(map(itemgetter(0), qualifiers), dtype='U8',
+                                 count=len(qualifiers))
+        if qualifiers[0] not in ['A', 'P']:
+            print("we have a weird qualifier. it is ", qualifiers[0])
+        approved = qualifiers == 'A'
+        values = values[approved]
+        datetimes = datetimes[approved]
+    ts_df = pd.DataFrame({site_code: values},
+                         index=pd.DatetimeIndex(datetimes, name='dateTime'))
+    return resample_reindex(ts_df, start_date, end_date, time_scale)
+
+
+def nwis_json_to_df(json_data, start_date, end_date, time_scale='H',
+                    vectorized=True):
     """
     combine time series in json produced by nwis web from multiple sites into
     one pandas df. the df is also resampled to a time scale and reindexed so
     the dataframes are from the start date to the end date regardless of
     whether there is data available or not
+    :param vectorized: [bool] if True, format each site with the columnar
+    format_ts_data instead of building a df of dicts and using format_df
+    """
+    return nwis_time_series_to_df(json_data['value']['timeSeries'], start_date,
+                                  end_date, time_scale, vectorized)
+
+
+def nwis_time_series_to_df(time_series, start_date, end_date, time_scale='H',
+                           vectorized=True):
+    """
+    format and combine nwis json time series (one per site) into one pandas
+    df. each time series is formatted before the next is taken, so it can be
+    a generator (e.g., iter_nwis_time_series)
+    :param time_series: [iterable] the nwis json time series dicts
+    :param vectorized: [bool] if True, format each site with format_ts_data,
+    otherwise with format_df
+    :return: [pandas df] the combined df or None if there is no data
     """
     df_collection = []
-    time_series = json_data['value']['timeSeries']
     for ts in time_series:
         site_code = ts['sourceInfo']['siteCode'][0]['value']
         print('processing the data for site ', site_code, flush=True)
         # this is where the actual data is
         ts_data = ts['values'][0]['value']
-        if ts_data:
+        if ts_data and vectorized:
+            df_collection.append(format_ts_data(ts_data, site_code,
+                                                start_date, end_date,
+                                                time_scale))
+        elif ts_data:
             ts_df = pd.DataFrame(ts_data)
             ts_df_formatted = format_df(ts_df, site_code, start_date, end_date,
                                         time_scale)
             df_collection.append(ts_df_formatted)
+        # let go of this site's json before the next one is decoded
+        del ts, ts_data
+    if df_collection:
+        df_combined = pd.concat(df_collection, axis=1)
+        df_combined = df_combined.replace(-999999, np.nan)
+        return df_combined
+    else:
+        return None
+
+
+def find_rdb_header(buffer, start=0):
+    """
+    find the start of the next rdb header line ('agency_cd\t...') in a
+    buffer of bytes, starting at start
+    :return: [int] the index of the header line or -1 if there is none
+    """
+    if start == 0 and buffer.startswith(b'agency_cd\t'):
+        return 0
+    found = buffer.find(b'\nagency_cd\t', max(start - 1, 0))
+    return found + 1 if found >= 0 else -1
+
+
+def iter_rdb_sections(byte_chunks):
+    """
+    split an nwis rdb response into its sections (one per site and time
+    series), each starting at its header line. a section is given back as soon
+    as the header of the next one has come in
+    :param byte_chunks: [iterable] chunks of bytes of the response body
+    :return: [generator] the sections as bytes
+    """
+    buffer = bytearray()
+    start = -1
+    for chunk in byte_chunks:
+        # only look for headers in what is new (and a header's length back)
+        search_from = max(len(buffer) - len(b'\nagency_cd\t'), 0)
+        buffer.extend(chunk)
+        if start < 0:
+            start = find_rdb_header(buffer, search_from)
+            if start < 0:
+                continue
+            search_from = start + 1
+        next_start = find_rdb_header(buffer, max(search_from, start + 1))
+        while next_start >= 0:
+            yield bytes(buffer[start:next_start])
+            del buffer[:next_start]
+            start = 0
+            next_start = find_rdb_header(buffer, 1)
+    if start >= 0:
+        yield bytes(buffer[start:])
+
+
+def format_rdb_section(section, start_date, end_date, time_scale,
+                       only_approved=True):
+    """
+    format one section of an nwis rdb response like format_df formats the
+    json data of one site. the section is read with the C csv reader straight
+    from the bytes. the first discharge column of the section is used
+    :param section: [bytes] the section (header line, column format line and
+    data lines)
+    :param start_date: (str) start date of call
+    :param end_date: (str) end date of call
+    :param time_scale: (str) time scale to resample and reindex to
+    :param only_approved: (bool) whether or not to screen out non-approved data
+    points
+    :return: formatted dataframe or None if there is no discharge data
+    """
+    header = section[:section.find(b'\n')].decode().rstrip('\r').split('\t')
+    value_cols = [c for c in header if '_00060' in c and not c.endswith('_cd')]
+    if not value_cols:
+        return None
+    value_col = value_cols[0]
+    use_cols = ['site_no', 'datetime', value_col, value_col + '_cd']
+    if 'tz_cd' in header:
+        use_cols.append('tz_cd')
+    df = pd.read_csv(io.BytesIO(section), sep='\t', comment='#',
+                     skiprows=[1], usecols=use_cols, dtype=str, engine='c')
+    if df.empty:
+        return None
+    site_code = df['site_no'].iloc[0]
+    # iv times are like '2019-01-01 00:15' and dv dates like '2019-01-01'
+    datetime_format = '%Y-%m-%d %H:%M' if len(df['datetime'].iloc[0]) > 10 \
+        else '%Y-%m-%d'
+    datetimes = pd.to_datetime(df['datetime'], format=datetime_format)
+    if 'tz_cd' in df.columns:
+        offsets = df['tz_cd'].map(nwis_tz_offsets)
+        if offsets.isna().any():
+            unknown = df.loc[offsets.isna(), 'tz_cd'].unique()
+            raise ValueError(f"unknown nwis time zone code(s) {unknown}")
+        datetimes = datetimes - pd.to_timedelta(offsets, unit='h')
+    # non-numeric values (e.g., 'Ice' or 'Eqp') become nan
+    values = pd.to_numeric(df[value_col], errors='coerce').astype('float64')
+    if only_approved:
+        # the codes are like 'A', 'P:e' or 'A:[91]'. the first is the approval
+        qualifiers = df[value_col + '_cd'].str.partition(':')[0]
+        if qualifiers.iloc[0] not in ['A', 'P']:
+            print("we have a weird qualifier. it is ", qualifiers.iloc[0])
+        approved = (qualifiers == 'A').to_numpy()
+        values = values[approved]
+        datetimes = datetimes[approved]
+    ts_df = pd.DataFrame({site_code: values.to_numpy()},
+                         index=pd.DatetimeIndex(datetimes, name='dateTime'))
+    return resample_reindex(ts_df, start_date, end_date, time_scale)
+
+
+def nwis_rdb_to_df(sections, start_date, end_date, time_scale='H'):
+    """
+    format and combine the sections of an nwis rdb response (one per site)
+    into one pandas df, like nwis_json_to_df does for json
+    :param sections: [iterable] the rdb sections (e.g., iter_rdb_sections)
+    :return: [pandas df] the combined df or None if there is no data
+    """
+    df_collection = []
+    for section in sections:
+        ts_df = format_rdb_section(section, start_date, end_date, time_scale)
+        if ts_df is not None:
+            print('processing the data for site ', ts_df.columns[0],
+                  flush=True)
+            df_collection.append(ts_df)
     if df_collection:
         df_combined = pd.concat(df_collection, axis=1)
         df_combined = df_combined.replace(-999999, np.nan)
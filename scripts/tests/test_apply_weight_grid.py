@@ -0,0 +1,214 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+import apply_weight_grid as aw
+import sparse_weights as sw
+
+triplets = pd.DataFrame({'nhd_comid': [10, 20, 20],
+                         'nldas_grid_no': [3, 0, 5],
+                         'weight': [1., 0.2, 0.8]})
+weight_ds = sw.triplets_to_dataset(triplets, num_grid_cells=6)
+times = pd.date_range('2000-01-01', periods=5, freq='D')
+forcing = xr.DataArray(np.arange(30, dtype='float32').reshape(5, 6),
+                       [('time', times), ('nldas_grid_no', range(6))])
+
+
+def test_apply_weights_csr_matches_dense():
+    csr, comids = sw.triplets_to_csr(weight_ds)
+    w = sw.triplets_to_dense(weight_ds)
+    true_weighted = w.dot(forcing)
+    weighted = aw.apply_weights_csr(csr, comids, forcing)
+    assert weighted.dims == ('nhd_comid', 'time')
+    assert np.allclose(weighted.values, true_weighted.values)
+
+
+def test_apply_weights_csr_dask():
+    csr, comids = sw.triplets_to_csr(weight_ds)
+    weighted = aw.apply_weights_csr(csr, comids,
+                                    forcing.chunk({'time': 2,
+                                                   'nldas_grid_no': 3}))
+    in_memory = aw.apply_weights_csr(csr, comids, forcing)
+    assert np.allclose(weighted.values, in_memory.values)
+
+
+def test_get_time_blocks():
+    blocks = aw.get_time_blocks(10, 4)
+    assert blocks == [slice(0, 4), slice(4, 8), slice(8, 10)]
+    assert aw.get_time_blocks(10, 4, start=8) == [slice(8, 10)]
+
+
+def test_apply_nldas_weight_grid_stream(tmp_path):
+    weight_zarr = str(tmp_path / 'weights')
+    nldas_zarr = str(tmp_path / 'nldas')
+    weight_ds.to_zarr(weight_zarr)
+    lat_lon = forcing.values.reshape(5, 2, 3)
+    ds_nldas = xr.Dataset({'apcpsfc': (('time', 'lat', 'lon'), lat_lon)},
+                          coords={'time': times, 'lat': [0.5, 1.5],
+                                  'lon': [0.5, 1.5, 2.5]})
+    ds_nldas.chunk({'time': 2}).to_zarr(nldas_zarr)
+    aw.apply_nldas_weight_grid(weight_zarr, nldas_zarr,
+                               str(tmp_path / 'all'), backend='sparse')
+    aw.apply_nldas_weight_grid(weight_zarr, nldas_zarr,
+                               str(tmp_path / 'stream'), backend='sparse',
+                               stream=True)
+    all_at_once = xr.open_zarr(str(tmp_path / 'all'))
+    streamed = xr.open_zarr(str(tmp_path / 'stream'))
+    assert streamed.attrs['time_steps_done'] == 5
+    assert np.allclose(all_at_once.apcpsfc.values, streamed.apcpsfc.values)
+
+
+def test_weight_variables_fused():
+    ds_st = xr.Dataset({'apcpsfc': forcing, 'tmp2m': forcing * 2 + 1})
+    ds_st['tmp2m'][0, 3] = np.nan
+    csr_weights = sw.triplets_to_csr(weight_ds)
+    dense_weights = sw.triplets_to_dense(weight_ds)
+    for backend, weights in [('sparse', csr_weights),
+                             ('dense', dense_weights)]:
+        for ds in [ds_st, ds_st.chunk({'time': 2})]:
+            separate = aw.weight_variables(ds, weights, backend)
+            fused = aw.weight_variables(ds, weights, backend, fused=True)
+            for var_name in ['apcpsfc', 'tmp2m']:
+                assert fused[var_name].dims == ('nhd_comid', 'time')
+                assert np.allclose(fused[var_name].values,
+                                   separate[var_name].values)
+
+
+def test_weight_variables_normalize():
+    with_nan = forcing.copy()
+    # comid 20 has cells 0 (w=0.2) and 5 (w=0.8); comid 10 only has cell 3
+    with_nan[0, 5] = np.nan
+    with_nan[1, 3] = np.nan
+    ds_st = xr.Dataset({'apcpsfc': with_nan})
+    csr_weights = sw.triplets_to_csr(weight_ds)
+    dense_weights = sw.triplets_to_dense(weight_ds)
+    for backend, weights in [('sparse', csr_weights),
+                             ('dense', dense_weights)]:
+        for fused in [False, True]:
+            weighted = aw.weight_variables(ds_st, weights, backend, fused,
+                                           normalize=True).apcpsfc
+            weighted = weighted.transpose('nhd_comid', 'time')
+            # only cell 0 is valid for comid 20 at time 0
+            assert np.isclose(weighted.sel(nhd_comid=20)[0], with_nan[0, 0])
+            assert np.isnan(weighted.sel(nhd_comid=10)[1])
+            assert np.allclose(weighted.sel(nhd_comid=20)[1:],
+                               0.2 * forcing[1:, 0] + 0.8 * forcing[1:, 5])
+
+
+def test_get_period_time_blocks():
+    hourly = pd.date_range('2000-01-01 06:00', periods=24 * 4, freq='h')
+    blocks = aw.get_period_time_blocks(hourly, 'D', 48)
+    # the first day only has 18 hours, so the first block has 3 days
+    assert blocks == [slice(0, 66), slice(66, 96)]
+    assert aw.get_period_time_blocks(hourly, 'D', 48, start=66) == \
+        [slice(66, 96)]
+    assert aw.get_num_out_times(hourly[:66], 'D') == 3
+
+
+def test_aggregate_time():
+    hourly = pd.date_range('2000-01-01', periods=48, freq='h')
+    values = np.arange(96, dtype='float32').reshape(2, 48)
+    ds = xr.Dataset({'apcpsfc': (('nhd_comid', 'time'), values),
+                     'tmp2m': (('nhd_comid', 'time'), values)},
+                    coords={'nhd_comid': [10, 20], 'time': hourly})
+    daily = aw.aggregate_time(ds, 'D')
+    assert set(daily.data_vars) == {'apcpsfc_sum', 'tmp2m_mean', 'tmp2m_min',
+                                    'tmp2m_max'}
+    assert daily.sizes['time'] == 2
+    first_day_sum = daily.apcpsfc_sum.sel(nhd_comid=10).values[0]
+    assert first_day_sum == values[0, :24].sum()
+    assert daily.tmp2m_max.sel(nhd_comid=20).values[1] == values[1, 47]
+
+
+def test_apply_nldas_weight_grid_stream_aggregated(tmp_path):
+    weight_zarr = str(tmp_path / 'weights')
+    nldas_zarr = str(tmp_path / 'nldas')
+    weight_ds.to_zarr(weight_zarr)
+    hourly = pd.date_range('2000-01-01 06:00', periods=24 * 5, freq='h')
+    values = np.random.default_rng(0).random((len(hourly), 2, 3))
+    ds_nldas = xr.Dataset({'apcpsfc': (('time', 'lat', 'lon'), values),
+                           'tmp2m': (('time', 'lat', 'lon'), values + 1)},
+                          coords={'time': hourly, 'lat': [0.5, 1.5],
+                                  'lon': [0.5, 1.5, 2.5]})
+    ds_nldas.chunk({'time': 48}).to_zarr(nldas_zarr)
+    aw.apply_nldas_weight_grid(weight_zarr, nldas_zarr, str(tmp_path / 'all'),
+                               backend='sparse', freq='D')
+    aw.apply_nldas_weight_grid(weight_zarr, nldas_zarr,
+                               str(tmp_path / 'stream'), backend='sparse',
+                               stream=True, freq='D')
+    all_at_once = xr.open_zarr(str(tmp_path / 'all'))
+    streamed = xr.open_zarr(str(tmp_path / 'stream'))
+    assert streamed.sizes['time'] == 6
+    for var_name in all_at_once.data_vars:
+        assert np.allclose(all_at_once[var_name].values,
+                           streamed[var_name].values)
+
+
+def test_apply_nldas_weight_grid_cell_major(tmp_path, capsys):
+    import rechunk_nldas as rc
+    weight_zarr = str(tmp_path / 'weights')
+    nldas_zarr = str(tmp_path / 'nldas')
+    cell_zarr = str(tmp_path / 'cell_major')
+    weight_ds.to_zarr(weight_zarr)
+    lat_lon = forcing.values.reshape(5, 2, 3)
+    ds_nldas = xr.Dataset({'apcpsfc': (('time', 'lat', 'lon'), lat_lon)},
+                          coords={'time': times, 'lat': [0.5, 1.5],
+                                  'lon': [0.5, 1.5, 2.5]})
+    ds_nldas.chunk({'time': 1}).to_zarr(nldas_zarr)
+    rc.rechunk_nldas(nldas_zarr, cell_zarr, cell_chunk=1, time_chunk=5)
+    # the weights use 3 of the 6 cells, so 3 one-cell chunks are read from
+    # the cell-major copy vs 5 whole-grid chunks from the time-major store
+    ds_cell = xr.open_zarr(cell_zarr)
+    assert aw.estimate_bytes_read(ds_cell, [0, 3, 5]) == 3 * 5 * 4
+    assert aw.estimate_bytes_read(xr.open_zarr(nldas_zarr),
+                                  [0, 3, 5]) == 5 * 6 * 4
+    aw.apply_nldas_weight_grid(weight_zarr, nldas_zarr,
+                               str(tmp_path / 'time_major'), backend='sparse')
+    aw.apply_nldas_weight_grid(weight_zarr, nldas_zarr,
+                               str(tmp_path / 'cell_major_out'),
+                               backend='sparse', stream=True,
+                               cell_major_zarr=cell_zarr)
+    assert 'using the cell-major nldas data' in capsys.readouterr().out
+    time_major = xr.open_zarr(str(tmp_path / 'time_major'))
+    cell_major = xr.open_zarr(str(tmp_path / 'cell_major_out'))
+    assert np.allclose(time_major.apcpsfc.values, cell_major.apcpsfc.values)
+
+
+def test_apply_nldas_weight_grid_partial_store(tmp_path):
+    weight_zarr = str(tmp_path / 'weights')
+    nldas_zarr = str(tmp_path / 'nldas')
+    weight_ds.to_zarr(weight_zarr)
+    lat_lon = forcing.values.reshape(5, 2, 3).copy()
+    # a region-mode store where only the first 3 time steps were pulled
+    lat_lon[3:] = np.nan
+    ds_nldas = xr.Dataset({'apcpsfc': (('time', 'lat', 'lon'), lat_lon)},
+                          coords={'time': times, 'lat': [0.5, 1.5],
+                                  'lon': [0.5, 1.5, 2.5],
+                                  'time_done': ('time', [True, True, True,
+                                                         False, False])})
+    ds_nldas.chunk({'time': 1}).to_zarr(nldas_zarr)
+    aw.apply_nldas_weight_grid(weight_zarr, nldas_zarr,
+                               str(tmp_path / 'out'), backend='sparse')
+    out = xr.open_zarr(str(tmp_path / 'out'))
+    assert out.sizes['time'] == 3
+    assert 'time_done' not in out.variables
+    true_weighted = sw.triplets_to_dense(weight_ds).dot(forcing[:3])
+    assert np.allclose(out.apcpsfc.values, true_weighted.values)
+
+
+def test_open_nldas_stale_cell_major(tmp_path, capsys):
+    import rechunk_nldas as rc
+    nldas_zarr = str(tmp_path / 'nldas')
+    cell_zarr = str(tmp_path / 'cell_major')
+    lat_lon = forcing.values.reshape(5, 2, 3)
+    ds_nldas = xr.Dataset({'apcpsfc': (('time', 'lat', 'lon'), lat_lon)},
+                          coords={'time': times, 'lat': [0.5, 1.5],
+                                  'lon': [0.5, 1.5, 2.5]})
+    ds_nldas.isel(time=slice(0, 3)).chunk({'time': 1}).to_zarr(nldas_zarr)
+    rc.rechunk_nldas(nldas_zarr, cell_zarr, cell_chunk=1, time_chunk=5)
+    # the nldas data get more time steps after the copy is made
+    ds_nldas.isel(time=slice(3, 5)).chunk({'time': 1}).to_zarr(
+        nldas_zarr, append_dim='time')
+    weights = sw.triplets_to_csr(weight_ds)
+    ds_st = aw.open_nldas(nldas_zarr, weights, 'sparse', cell_zarr)
+    assert 'do not match' in capsys.readouterr().out
+    assert ds_st.sizes['time'] == 5
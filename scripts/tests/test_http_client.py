@@ -0,0 +1,100 @@
+import gzip
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing.pool import ThreadPool
+import pytest
+from http_client import HttpClient, TokenBucket
+
+
+class Handler(BaseHTTPRequestHandler):
+    calls = {}
+    in_flight = 0
+    max_in_flight = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.calls[self.path] = cls.calls.get(self.path, 0) + 1
+            num_calls = cls.calls[self.path]
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+        if self.path.startswith('/slow'):
+            time.sleep(0.05)
+        with cls.lock:
+            cls.in_flight -= 1
+        if self.path == '/flaky' and num_calls <= 2:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = gzip.compress(b'{"ok": true}')
+        self.send_response(200)
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def server_url():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+
+
+def test_retry_with_backoff(server_url):
+    client = HttpClient(backoff_base=0.01)
+    response = client.get(f'{server_url}/flaky')
+    assert response.status_code == 200
+    assert response.json() == {'ok': True}
+    stats = client.get_stats()
+    assert stats['retries'] == 2
+    assert stats['requests'] == 3
+
+
+def test_retries_run_out(server_url):
+    Handler.calls['/flaky'] = 0
+    client = HttpClient(max_retries=1, backoff_base=0.01)
+    assert client.get(f'{server_url}/flaky').status_code == 503
+    assert client.get_stats()['failures'] == 1
+
+
+def test_max_per_host(server_url):
+    Handler.max_in_flight = 0
+    client = HttpClient(max_per_host=2, requests_per_second=1000)
+    with ThreadPool(6) as pool:
+        pool.map(lambda i: client.get(f'{server_url}/slow{i}'), range(12))
+    assert Handler.max_in_flight <= 2
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=100, capacity=1)
+    start_time = time.monotonic()
+    for i in range(11):
+        bucket.acquire()
+    # the first token is there, the other 10 take 0.01 s each
+    assert time.monotonic() - start_time >= 0.09
+
+
+def test_stream_holds_host_limit(server_url):
+    client = HttpClient(max_per_host=1, requests_per_second=1000)
+    response = client.get(f'{server_url}/stream', stream=True)
+    second = []
+    thread = threading.Thread(
+        target=lambda: second.append(client.get(f'{server_url}/other')))
+    thread.start()
+    time.sleep(0.1)
+    # the second call waits until the streamed body is read and closed
+    assert not second
+    with response:
+        assert response.json() == {'ok': True}
+    thread.join(timeout=5)
+    assert second[0].status_code == 200
+    response.close()
+    assert client.get_stats()['requests'] == 2
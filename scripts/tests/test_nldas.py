@@ -1,13 +1,47 @@
 import shutil
 import os
-from pull_nldas import delete_last_time_chunk
+import numpy as np
+import pandas as pd
+from pull_nldas import delete_last_time_chunk, write_time_slices, \
+    init_region_store, get_undone_region_slices, subset_nldas, \
+    connect_to_urs, plan_time_slices, get_undone_range, pull_to_zarr, \
+    write_region_slice
+import pytest
+from pydap.handlers.lib import BaseHandler
+from pydap.model import DatasetType, BaseType
+from benchmark_pull_nldas import make_synthetic_nldas_nc, open_standin, \
+    get_end_date, check_pull
 import xarray as xr
 
 
-def test_delete_last_time_chunk():
-    orig_zarr_store = 'E:/data/nldas/nldas2_c'
-    # tmp_zarr_store = 'data/sm_nldas_tmp'
-    # shutil.copytree(orig_zarr_store, tmp_zarr_store)
+def make_server_ds(num_times=20):
+    times = pd.date_range('1979-01-01 13:00', periods=num_times, freq='h')
+    values = np.random.default_rng(0).random((num_times, 4, 6))
+    ds = xr.Dataset({'apcpsfc': (('time', 'lat', 'lon'), values),
+                     'tmp2m': (('time', 'lat', 'lon'), values + 1)},
+                    coords={'time': times, 'lat': np.arange(4) + 25.,
+                            'lon': np.arange(6) - 120.})
+    return ds.chunk({'time': 4, 'lat': 4, 'lon': 6})
+
+
+def make_server_handler(ds):
+    # serves the dataset in-process the way the OPeNDAP server does
+    dataset = DatasetType('nldas')
+    for name, var in ds.variables.items():
+        values = var.values
+        attrs = dict(var.attrs)
+        if name == 'time':
+            values, units, calendar = xr.coding.times.encode_cf_datetime(
+                values)
+            attrs.update(units=units, calendar=calendar)
+        dataset[name] = BaseType(name, values, var.dims, attrs)
+    return BaseHandler(dataset)
+
+
+def test_delete_last_time_chunk(tmp_path):
+    orig_zarr_store = str(tmp_path / 'nldas')
+    make_server_ds().rename(tmp2m='spfh2m').to_zarr(
+        orig_zarr_store, encoding={'time': {'chunks': (4,)}})
     ds_orig = xr.open_zarr(orig_zarr_store)
     delete_last_time_chunk(orig_zarr_store)
     ds_del = xr.open_zarr(orig_zarr_store)
@@ -22,3 +56,236 @@ def test_delete_last_time_chunk():
     assert ds_del.time.shape[0] == new_true_size 
     assert ds_del.apcpsfc.shape[0] == new_true_size 
 
+
+def test_write_time_slices(tmp_path, monkeypatch):
+    import pull_nldas as pn
+    ds = make_server_ds()
+    time_slices = [slice(i, i + 4) for i in range(0, 20, 4)]
+    fetch_time_slice = pn.fetch_time_slice
+    write_next_slice = pn.write_next_slice
+    counts = {'fetched': 0, 'written': 0, 'max_held': 0}
+
+    def counting_fetch(*args):
+        counts['fetched'] += 1
+        counts['max_held'] = max(counts['max_held'],
+                                 counts['fetched'] - counts['written'])
+        return fetch_time_slice(*args)
+
+    def counting_write(*args):
+        num_bytes = write_next_slice(*args)
+        counts['written'] += 1
+        return num_bytes
+
+    monkeypatch.setattr(pn, 'fetch_time_slice', counting_fetch)
+    monkeypatch.setattr(pn, 'write_next_slice', counting_write)
+    for workers in [1, 3]:
+        counts.update(fetched=0, written=0, max_held=0)
+        zarr_store = str(tmp_path / f'nldas_{workers}')
+        write_time_slices(ds, zarr_store, time_slices, workers=workers)
+        # no more than workers slices are fetched and not yet written
+        assert counts['max_held'] <= workers
+        ds_written = xr.open_zarr(zarr_store)
+        assert ds_written.apcpsfc.chunks[0][0] == 4
+        assert (ds_written.time.values == ds.time.values).all()
+        assert np.allclose(ds_written.tmp2m.values, ds.tmp2m.values)
+
+
+def test_region_writes(tmp_path):
+    ds = make_server_ds()
+    zarr_store = str(tmp_path / 'nldas')
+    init_region_store(ds, zarr_store, 16)
+    ds_empty = xr.open_zarr(zarr_store)
+    assert ds_empty.sizes['time'] == 16
+    assert not ds_empty.time_done.values.any()
+    # fill the second half first, as a separate process would
+    second_half = get_undone_region_slices(zarr_store, 4, time_range=(8, 16))
+    assert second_half == [slice(8, 12), slice(12, 16)]
+    write_time_slices(ds, zarr_store, second_half, region=True)
+    undone = get_undone_region_slices(zarr_store, 4)
+    assert undone == [slice(0, 4), slice(4, 8)]
+    write_time_slices(ds, zarr_store, undone, workers=2, region=True)
+    assert get_undone_region_slices(zarr_store, 4) == []
+    ds_written = xr.open_zarr(zarr_store)
+    assert ds_written.time_done.values.all()
+    assert np.allclose(ds_written.apcpsfc.values, ds.apcpsfc.values[:16])
+
+
+def test_init_region_store_existing(tmp_path, monkeypatch):
+    import pull_nldas as pn
+    ds = make_server_ds()
+    zarr_store = str(tmp_path / 'nldas')
+    init_region_store(ds, zarr_store, 16)
+    write_time_slices(ds, zarr_store, [slice(0, 4)], region=True)
+    # a second process that was started at the same time also sees no store
+    max_num_dates_done = pn.max_num_dates_done
+    calls = []
+
+    def no_store_yet(store):
+        calls.append(store)
+        return None if len(calls) == 1 else max_num_dates_done(store)
+
+    monkeypatch.setattr(pn, 'max_num_dates_done', no_store_yet)
+    init_region_store(ds, zarr_store, 16)
+    monkeypatch.undo()
+    # the store is used as it is
+    assert get_undone_region_slices(zarr_store, 4) == [slice(4, 8),
+                                                        slice(8, 12),
+                                                        slice(12, 16)]
+    with pytest.raises(ValueError):
+        init_region_store(ds, zarr_store, 20)
+    append_store = str(tmp_path / 'appended')
+    write_time_slices(ds, append_store, [slice(0, 4)])
+    with pytest.raises(ValueError, match='not a region store'):
+        init_region_store(ds, append_store, 16)
+
+
+def test_write_region_slice_fails(tmp_path):
+    ds = make_server_ds()
+    zarr_store = str(tmp_path / 'nldas')
+    init_region_store(ds, zarr_store, 8)
+
+    def fail(block):
+        raise IOError('server went away')
+
+    ds_sliced = ds.isel(time=slice(0, 4))
+    ds_sliced['apcpsfc'] = ds_sliced.apcpsfc.copy(
+        data=ds_sliced.apcpsfc.data.map_blocks(fail, dtype=float))
+    with pytest.raises(IOError):
+        write_region_slice(ds_sliced, zarr_store, slice(0, 4))
+    assert not xr.open_zarr(zarr_store).time_done.values.any()
+    assert get_undone_region_slices(zarr_store, 4) == [slice(0, 4),
+                                                        slice(4, 8)]
+
+
+def test_subset_nldas():
+    ds = make_server_ds()
+    # lat centers are 25-28 and lon centers are -120 to -115
+    ds_sub = subset_nldas(ds, variables=['tmp2m'],
+                          bbox=(-118.8, 25.4, -117.2, 26.2))
+    assert list(ds_sub.data_vars) == ['tmp2m']
+    assert list(ds_sub.lat.values) == [25., 26.]
+    assert list(ds_sub.lon.values) == [-119., -118., -117.]
+
+
+def test_connect_to_urs_subset(tmp_path):
+    ds = make_server_ds()
+    handler = make_server_handler(ds)
+    # the constraint expression only asks for tmp2m (and the coordinates)
+    ds_sub = connect_to_urs(None, None, lat_chunk=4, lon_chunk=6,
+                            time_chunk=4, variables=['tmp2m'],
+                            bbox=(-118.8, 25.4, -117.2, 26.2),
+                            application=handler)
+    assert list(ds_sub.data_vars) == ['tmp2m']
+    assert list(ds_sub.lat.values) == [25., 26.]
+    assert list(ds_sub.lon.values) == [-119., -118., -117.]
+    assert list(ds_sub.nldas_col.values) == [1, 2, 3]
+    assert (ds_sub.time.values == ds.time.values).all()
+    assert np.allclose(ds_sub.tmp2m.values,
+                       ds.tmp2m.values[:, :2, 1:4])
+    # a variables-only pull keeps the time coordinate, so it can be resumed
+    ds_vars = connect_to_urs(None, None, lat_chunk=4, lon_chunk=6,
+                             time_chunk=4, variables=['apcpsfc'],
+                             application=handler)
+    zarr_store = str(tmp_path / 'nldas')
+    pull_to_zarr(ds_vars, zarr_store, '1979-01-01 20:00', time_pull_size=4,
+                 time_chunk=4)
+    pull_to_zarr(ds_vars, zarr_store, '1979-01-02 08:00', time_pull_size=4,
+                 time_chunk=4)
+    ds_written = xr.open_zarr(zarr_store)
+    assert (ds_written.time.values == ds.time.values).all()
+    assert np.allclose(ds_written.apcpsfc.values, ds.apcpsfc.values)
+
+
+def test_plan_time_slices():
+    # 959 is rounded to two chunks of 480
+    assert plan_time_slices(0, 2000, 480, 959) == \
+        [slice(0, 960), slice(960, 1920), slice(1920, 2000)]
+    # a start in the middle of a chunk only goes to the next boundary
+    assert plan_time_slices(500, 2000, 480, 960) == \
+        [slice(500, 1440), slice(1440, 2000)]
+
+
+def test_get_undone_range(tmp_path):
+    ds = make_server_ds()
+    zarr_store = str(tmp_path / 'nldas')
+    # the second pull died after writing one of its two chunks
+    write_time_slices(ds, zarr_store, [slice(0, 8), slice(8, 12)])
+    # 20 hourly time steps from the minimum date
+    time_slices = get_undone_range(zarr_store, 8, '1979-01-02 08:00',
+                                   time_chunk=4)
+    assert time_slices == [slice(8, 16), slice(16, 20)]
+    assert xr.open_zarr(zarr_store).sizes['time'] == 8
+    write_time_slices(ds, zarr_store, time_slices)
+    ds_written = xr.open_zarr(zarr_store)
+    assert (ds_written.time.values == ds.time.values).all()
+    assert np.allclose(ds_written.apcpsfc.values, ds.apcpsfc.values)
+
+
+def test_pull_to_zarr_standin(tmp_path):
+    nc_file = str(tmp_path / 'nldas.nc')
+    make_synthetic_nldas_nc(nc_file, num_times=40, num_lat=4, num_lon=6,
+                            variables=['apcpsfc', 'tmp2m'])
+    for variables in [None, ['tmp2m']]:
+        ds = open_standin(nc_file, time_chunk=8, latency=0.001,
+                          variables=variables)
+        zarr_store = str(tmp_path / f'nldas_{variables}')
+        pull_to_zarr(ds, zarr_store, get_end_date(20), time_pull_size=16,
+                     time_chunk=8, workers=2)
+        assert xr.open_zarr(zarr_store).sizes['time'] == 20
+        # resume to the full record
+        pull_to_zarr(ds, zarr_store, get_end_date(40), time_pull_size=16,
+                     time_chunk=8, workers=2)
+        assert check_pull(nc_file, zarr_store, variables)
+
+
+def test_bbox_store_weighting(tmp_path):
+    import apply_weight_grid as aw
+    import rechunk_nldas as rc
+    import sparse_weights as sw
+    nc_file = str(tmp_path / 'nldas.nc')
+    make_synthetic_nldas_nc(nc_file, num_times=16, num_lat=4, num_lon=6,
+                            variables=['apcpsfc', 'tmp2m'])
+    ds = open_standin(nc_file, time_chunk=8)
+    # the cells in rows 1-2 and columns 1-2 (nldas_grid_no 7, 8, 13 and 14)
+    lat, lon = ds.lat.values, ds.lon.values
+    ds_sub = open_standin(nc_file, time_chunk=8,
+                          bbox=(lon[1], lat[1], lon[2], lat[2]))
+    assert list(ds_sub.nldas_row.values) == [1, 2]
+    assert list(ds_sub.nldas_col.values) == [1, 2]
+    triplets = pd.DataFrame({'nhd_comid': [1, 1, 2],
+                             'nldas_grid_no': [7, 14, 8],
+                             'weight': [0.5, 0.5, 1.]})
+    weight_zarr = str(tmp_path / 'weights')
+    sw.triplets_to_dataset(triplets, num_grid_cells=24).to_zarr(weight_zarr)
+    full_zarr = str(tmp_path / 'full')
+    pull_to_zarr(ds, full_zarr, get_end_date(16), time_pull_size=8,
+                 time_chunk=8)
+    aw.apply_nldas_weight_grid(weight_zarr, full_zarr,
+                               str(tmp_path / 'full_out'), backend='sparse')
+    expected = xr.open_zarr(str(tmp_path / 'full_out'))
+    for region in [False, True]:
+        sub_zarr = str(tmp_path / f'sub_{region}')
+        pull_to_zarr(ds_sub, sub_zarr, get_end_date(16), time_pull_size=8,
+                     time_chunk=8, region=region)
+        cell_zarr = str(tmp_path / f'sub_cell_{region}')
+        rc.rechunk_nldas(sub_zarr, cell_zarr, cell_chunk=1, time_chunk=16)
+        assert list(xr.open_zarr(cell_zarr).nldas_grid_no.values) == \
+            [7, 8, 13, 14]
+        for backend, cell_major in [('dense', None), ('sparse', None),
+                                    ('sparse', cell_zarr)]:
+            out_zarr = str(tmp_path / f'out_{region}_{backend}_{cell_major}')
+            aw.apply_nldas_weight_grid(weight_zarr, sub_zarr, out_zarr,
+                                       backend=backend,
+                                       cell_major_zarr=cell_major)
+            out = xr.open_zarr(out_zarr)
+            for var_name in expected.data_vars:
+                assert np.allclose(out[var_name].values,
+                                   expected[var_name].values)
+    # a weight grid with cells outside of the bbox
+    triplets.loc[2, 'nldas_grid_no'] = 9
+    outside_zarr = str(tmp_path / 'outside_weights')
+    sw.triplets_to_dataset(triplets, num_grid_cells=24).to_zarr(outside_zarr)
+    with pytest.raises(ValueError):
+        aw.apply_nldas_weight_grid(outside_zarr, sub_zarr,
+                                   str(tmp_path / 'outside_out'),
+                                   backend='sparse')
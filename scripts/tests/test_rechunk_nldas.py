@@ -0,0 +1,129 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+import rechunk_nldas as rc
+
+times = pd.date_range('2000-01-01', periods=50, freq='h')
+values = np.random.default_rng(0).random((50, 6, 7)).astype('float32')
+ds_nldas = xr.Dataset({'apcpsfc': (('time', 'lat', 'lon'), values),
+                       'tmp2m': (('time', 'lat', 'lon'), values + 1)},
+                      coords={'time': times, 'lat': np.arange(6.) + 25,
+                              'lon': np.arange(7.) - 120})
+
+
+def test_get_rechunk_blocks():
+    blocks = rc.get_rechunk_blocks(['a', 'b'], 6, 7, 50, 4, 20)
+    assert blocks[0] == ('a', slice(0, 28), slice(0, 20))
+    assert blocks[1] == ('b', slice(0, 28), slice(0, 20))
+    assert blocks[2] == ('a', slice(28, 42), slice(0, 20))
+    assert blocks[-1] == ('b', slice(28, 42), slice(40, 50))
+    assert len(blocks) == 12
+    resumed = rc.get_rechunk_blocks(['a'], 6, 7, 50, 6, 20, time_start=30)
+    assert resumed == [('a', slice(0, 42), slice(30, 40)),
+                       ('a', slice(0, 42), slice(40, 50))]
+    assert rc.get_rechunk_blocks(['a'], 6, 7, 50, 6, 20, time_start=50) == []
+
+
+def test_get_block_shape():
+    # 7 columns x 20 time steps (source and copy time chunks of 10 and 20) x
+    # 4 bytes = 560 bytes per row, so the 3 rows of a source chunk are 1680
+    assert rc.get_block_shape(7, 3, 10, 7, 20, 4, max_mem=1700) == (3, 20)
+    assert rc.get_block_shape(7, 3, 10, 7, 20, 4, max_mem=3400) == (3, 40)
+    # the time window is a multiple of both time chunks
+    assert rc.get_block_shape(7, 3, 10, 7, 25, 4, max_mem=8000) == (3, 50)
+    # a source chunk does not fit, so the blocks are whole cell chunks (2 rows)
+    assert rc.get_block_shape(7, 3, 10, 14, 20, 4, max_mem=1200) == (2, 20)
+    with pytest.raises(ValueError):
+        rc.get_block_shape(7, 3, 10, 14, 20, 4, max_mem=1000)
+
+
+def test_rechunk_nldas(tmp_path):
+    nldas_zarr = str(tmp_path / 'nldas')
+    cell_zarr = str(tmp_path / 'cell_major')
+    ds_nldas.chunk({'time': 10, 'lat': 3}).to_zarr(nldas_zarr)
+    # blocks of 2 rows (one cell chunk) that do not line up with the 3-row
+    # source chunks
+    rc.rechunk_nldas(nldas_zarr, cell_zarr, cell_chunk=14, time_chunk=20,
+                     max_mem=1200)
+    ds_cell = xr.open_zarr(cell_zarr)
+    assert rc.is_complete_cell_major(ds_cell)
+    assert ds_cell.attrs['num_blocks'] == 2 * 3 * 3
+    assert ds_cell.apcpsfc.chunks[0][0] == 14
+    assert ds_cell.apcpsfc.chunks[1][0] == 20
+    ds_st = ds_nldas.stack(nldas_grid_no=['lat', 'lon'])
+    for var_name in ds_nldas.data_vars:
+        assert np.array_equal(ds_cell[var_name].values,
+                              ds_st[var_name].values.T)
+    assert np.array_equal(ds_cell.lon.values, ds_st.lon.values)
+
+
+def test_rechunk_nldas_partial_store(tmp_path):
+    nldas_zarr = str(tmp_path / 'nldas')
+    cell_zarr = str(tmp_path / 'cell_major')
+    time_done = np.arange(50) < 30
+    ds_nldas.assign_coords(time_done=('time', time_done)).chunk(
+        {'time': 10}).to_zarr(nldas_zarr)
+    rc.rechunk_nldas(nldas_zarr, cell_zarr, cell_chunk=6, time_chunk=20)
+    ds_cell = xr.open_zarr(cell_zarr)
+    assert ds_cell.sizes['time'] == 30
+    assert np.array_equal(ds_cell.time.values, times[:30])
+
+
+def test_rechunk_nldas_resume(tmp_path):
+    nldas_zarr = str(tmp_path / 'nldas')
+    cell_zarr = str(tmp_path / 'cell_major')
+    ds_nldas.chunk({'time': 10, 'lat': 3}).to_zarr(nldas_zarr)
+    rc.rechunk_nldas(nldas_zarr, cell_zarr, cell_chunk=21, time_chunk=20,
+                     max_mem=1700)
+    ds_cell = xr.open_zarr(cell_zarr)
+    assert ds_cell.attrs['num_blocks'] == 12
+    # act like the run died while writing block 6 (tmp2m, first rows, time
+    # steps 20 to 40)
+    rc.record_blocks_done(cell_zarr, 5)
+    ds_garbage = ds_cell[['tmp2m']].load() * 0
+    ds_garbage.drop_vars(['lat', 'lon']).isel(
+        nldas_grid_no=slice(0, 21), time=slice(20, 40)).to_zarr(
+        cell_zarr, region={'nldas_grid_no': slice(0, 21),
+                           'time': slice(20, 40)})
+    assert not rc.is_complete_cell_major(xr.open_zarr(cell_zarr))
+    rc.rechunk_nldas(nldas_zarr, cell_zarr, cell_chunk=21, time_chunk=20,
+                     max_mem=1700)
+    ds_cell = xr.open_zarr(cell_zarr)
+    assert rc.is_complete_cell_major(ds_cell)
+    ds_st = ds_nldas.stack(nldas_grid_no=['lat', 'lon'])
+    for var_name in ds_nldas.data_vars:
+        assert np.array_equal(ds_cell[var_name].values,
+                              ds_st[var_name].values.T)
+
+
+def test_rechunk_nldas_source_changes(tmp_path, capsys):
+    nldas_zarr = str(tmp_path / 'nldas')
+    cell_zarr = str(tmp_path / 'cell_major')
+    ds_st = ds_nldas.stack(nldas_grid_no=['lat', 'lon'])
+    ds_nldas.isel(time=slice(0, 30)).chunk({'time': 10}).to_zarr(nldas_zarr)
+    rc.rechunk_nldas(nldas_zarr, cell_zarr, cell_chunk=21, time_chunk=20)
+    assert xr.open_zarr(cell_zarr).attrs['source_num_times'] == 30
+    # more time steps are pulled, so only the new ones are rechunked
+    ds_nldas.isel(time=slice(30, 50)).chunk({'time': 10}).to_zarr(
+        nldas_zarr, append_dim='time')
+    rc.rechunk_nldas(nldas_zarr, cell_zarr, cell_chunk=21, time_chunk=20)
+    assert 'extending the cell-major copy from 30 to 50' in \
+        capsys.readouterr().out
+    ds_cell = xr.open_zarr(cell_zarr)
+    assert rc.is_complete_cell_major(ds_cell)
+    assert ds_cell.attrs['time_start'] == 30
+    assert np.array_equal(ds_cell.time.values, times)
+    for var_name in ds_nldas.data_vars:
+        assert np.array_equal(ds_cell[var_name].values,
+                              ds_st[var_name].values.T)
+    # the source is pulled again with different time steps
+    ds_nldas.isel(time=slice(10, 40)).chunk({'time': 10}).to_zarr(
+        nldas_zarr, mode='w')
+    rc.rechunk_nldas(nldas_zarr, cell_zarr, cell_chunk=21, time_chunk=20)
+    assert 'making it again' in capsys.readouterr().out
+    ds_cell = xr.open_zarr(cell_zarr)
+    assert rc.is_complete_cell_major(ds_cell)
+    assert np.array_equal(ds_cell.time.values, times[10:40])
+    assert np.array_equal(ds_cell.apcpsfc.values,
+                          ds_st.apcpsfc.values[10:40].T)
@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import sparse_weights as sw
+
+dense_df = pd.DataFrame([[0, 255, 0, 0], [51, 0, 0, 204], [0, 0, 0, 0]],
+                        columns=['0', '3', '11', '12'], index=[10, 20, 30])
+true_triplets = pd.DataFrame({'nhd_comid': [10, 20, 20],
+                              'nldas_grid_no': [3, 0, 12],
+                              'weight': [1., 0.2, 0.8]})
+
+
+def test_dense_to_triplets():
+    triplets = sw.dense_to_triplets(dense_df, scale=255.)
+    assert list(triplets.columns) == sw.triplet_cols
+    assert triplets['nhd_comid'].dtype == 'uint32'
+    assert triplets['weight'].dtype == 'float32'
+    assert triplets['nhd_comid'].tolist() == true_triplets['nhd_comid'].tolist()
+    assert triplets['nldas_grid_no'].tolist() == \
+        true_triplets['nldas_grid_no'].tolist()
+    assert np.allclose(triplets['weight'], true_triplets['weight'])
+
+
+def test_overlay_duplicates_summed():
+    inter = pd.DataFrame({'FEATUREID': [20, 10, 20],
+                          'grid_num': [0, 3, 0],
+                          'weighted_area': [0.1, 1., 0.1]})
+    triplets = sw.overlay_to_triplets(inter, 'FEATUREID')
+    assert triplets['nhd_comid'].tolist() == [10, 20]
+    assert triplets['nldas_grid_no'].tolist() == [3, 0]
+    assert np.allclose(triplets['weight'], [1., 0.2])
+
+
+def test_triplets_dataset_round_trip():
+    ds = sw.triplets_to_dataset(true_triplets, num_grid_cells=13)
+    assert sw.is_sparse_weights(ds)
+    assert sw.is_sparse_weights(true_triplets)
+    assert not sw.is_sparse_weights(dense_df)
+    back = sw.dataset_to_triplets(ds)
+    assert back.equals(true_triplets)
+
+
+def test_triplets_to_dense():
+    ds = sw.triplets_to_dataset(true_triplets, num_grid_cells=13)
+    w = sw.triplets_to_dense(ds)
+    assert w.shape == (2, 13)
+    assert w.sel(nhd_comid=20, nldas_grid_no=12) == np.float32(0.8)
+    assert float(w.sum()) == np.float32(2.)
+
+
+def test_quantize_triplets():
+    triplets = pd.DataFrame({'nhd_comid': [1, 1, 1, 2, 2],
+                             'nldas_grid_no': [0, 1, 2, 3, 4],
+                             'weight': [1 / 3., 1 / 3., 1 / 3., 0.301, 0.4]})
+    quantized, errors = sw.quantize_triplets(triplets, 'uint8')
+    assert quantized['weight'].dtype == 'uint8'
+    sums = quantized.groupby('nhd_comid')['weight'].sum()
+    # each catchment still adds up to its covered fraction
+    assert sums.tolist() == [255, round(0.701 * 255)]
+    assert errors['max_error'] <= 1 / 255.
+    assert errors['max_sum_error'] <= 0.5 / 255.
+    assert errors['num_weights'] == 5
+
+
+def test_combine_quantize_errors():
+    first = {'max_error': 0.002, 'mean_error': 0.001, 'max_sum_error': 0.,
+             'num_weights': 3}
+    second = {'max_error': 0.001, 'mean_error': 0.0005,
+              'max_sum_error': 0.001, 'num_weights': 1}
+    errors = sw.combine_quantize_errors(None, first)
+    errors = sw.combine_quantize_errors(errors, second)
+    assert errors['max_error'] == 0.002
+    assert errors['max_sum_error'] == 0.001
+    assert errors['num_weights'] == 4
+    assert np.isclose(errors['mean_error'], 0.0035 / 4)
+
+
+def test_quantized_dataset_round_trip():
+    quantized, _ = sw.quantize_triplets(true_triplets, 'uint16')
+    ds = sw.triplets_to_dataset(quantized, num_grid_cells=13)
+    assert ds.attrs['weight_scale'] == 65535
+    assert ds['weight'].dtype == 'uint16'
+    back = sw.dataset_to_triplets(ds)
+    assert back['weight'].dtype == 'float32'
+    assert np.allclose(back['weight'], true_triplets['weight'], atol=1e-4)
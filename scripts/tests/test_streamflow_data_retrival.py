@@ -0,0 +1,242 @@
+import json
+import threading
+import time
+import numpy as np
+import pandas as pd
+import pytest
+import streamflow_data_retrival as sdr
+
+
+def fake_streamflow_data(sites, start_date, end_date, product, time_scale,
+                         **kwargs):
+    # later chunks come back first
+    time.sleep(0.01 * (5 - int(sites[0]) % 5))
+    if sites[0] == '03':
+        return None
+    index = pd.date_range(start_date, end_date, freq=time_scale)
+    return pd.DataFrame({s: np.full(len(index), int(s)) for s in sites},
+                        index=index)
+
+
+def test_get_all_streamflow_data_workers(tmp_path, monkeypatch):
+    sites_file = str(tmp_path / 'sites.csv')
+    site_codes = [f'{i:02}' for i in range(10)]
+    pd.DataFrame({'site_no': site_codes, 'huc_cd': '02'}).to_csv(sites_file)
+    monkeypatch.setattr(sdr, 'get_streamflow_data', fake_streamflow_data)
+    batches = {}
+    for workers in [1, 4]:
+        batches[workers] = []
+        monkeypatch.setattr(sdr, 'write_out_chunks',
+                            lambda dfs, out_file, out_format, w=workers:
+                            batches[w].append(
+                                list(pd.concat(dfs, axis=1).columns)))
+        sdr.get_all_streamflow_data(str(tmp_path / 'out.csv'), sites_file,
+                                    num_sites_per_chunk=1, time_scale='D',
+                                    output_format='csv',
+                                    num_site_chunks_write=3,
+                                    start_date='2000-01-01',
+                                    end_date='2000-01-05', workers=workers)
+    assert batches[4] == batches[1]
+    assert batches[1] == [['00', '01', '02'], ['04', '05', '06'],
+                          ['07', '08', '09']]
+
+
+def test_get_all_streamflow_data_window_pool(tmp_path, monkeypatch):
+    sites_file = str(tmp_path / 'sites.csv')
+    site_codes = [f'{i:02}' for i in range(10)]
+    pd.DataFrame({'site_no': site_codes, 'huc_cd': '02'}).to_csv(sites_file)
+    thread_names = set()
+
+    def fake_window_data(sites, start_date, end_date, product, time_scale,
+                         **kwargs):
+        thread_names.add(threading.current_thread().name)
+        index = pd.date_range(start_date, end_date, freq=time_scale)
+        return pd.DataFrame({s: np.full(len(index), int(s)) for s in sites},
+                            index=index)
+
+    monkeypatch.setattr(sdr, 'get_streamflow_data', fake_window_data)
+    monkeypatch.setattr(sdr, 'write_out_chunks', lambda *args: None)
+    sdr.get_all_streamflow_data(str(tmp_path / 'out.csv'), sites_file,
+                                num_sites_per_chunk=1, time_scale='D',
+                                output_format='csv', start_date='2000-01-01',
+                                end_date='2005-01-01', workers=2,
+                                window_freq='YS', window_workers=2)
+    # the window threads (and their sessions) are shared by all 10 chunks
+    assert len(thread_names) <= 4
+
+
+def make_nwis_json(sites, num_times, utc_offset=True, freq='15min'):
+    rng = np.random.default_rng(0)
+    time_series = []
+    for site in sites:
+        values = []
+        for t in pd.date_range('2000-03-25', periods=num_times, freq=freq):
+            offset = '-05:00' if t < pd.Timestamp('2000-04-02') else '-04:00'
+            date_txt = t.strftime('%Y-%m-%dT%H:%M:%S.000')
+            values.append({'value': f'{rng.random() * 100:.2f}',
+                           'qualifiers': ['A'] if rng.random() > .2
+                           else ['P', 'e'],
+                           'dateTime': date_txt + (offset if utc_offset
+                                                   else '')})
+        time_series.append({'sourceInfo': {'siteCode': [{'value': site}]},
+                            'values': [{'value': values}]})
+    return {'value': {'timeSeries': time_series}}
+
+
+def test_parse_nwis_datetimes():
+    txt = ['2000-03-25T01:15:00.000-05:00', '2000-04-02T03:00:00.000-04:00',
+           '2000-04-02T03:00:00.000+01:30']
+    expected = pd.to_datetime(txt, utc=True).tz_localize(None)
+    parsed = sdr.parse_nwis_datetimes(txt)
+    assert (pd.DatetimeIndex(parsed) == expected).all()
+
+
+def test_nwis_json_to_df_vectorized():
+    for utc_offset, time_scale in [(True, 'h'), (True, '15min'),
+                                   (False, 'D')]:
+        json_data = make_nwis_json(['01', '02'], 2000, utc_offset)
+        args = (json_data, '2000-03-20', '2000-04-20', time_scale)
+        df = sdr.nwis_json_to_df(*args, vectorized=False)
+        df_vectorized = sdr.nwis_json_to_df(*args)
+        pd.testing.assert_frame_equal(df, df_vectorized)
+
+
+class FakeResponse:
+    def __init__(self, body):
+        self.body = body
+        self.content = body
+        self.text = body.decode('utf-8')
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+def test_iter_nwis_time_series():
+    json_data = make_nwis_json(['01', '02', '03'], 50)
+    json_data['value']['queryInfo'] = {'note': 'café – [x]'}
+    for indent in [None, 2]:
+        body = json.dumps(json_data, indent=indent,
+                          ensure_ascii=False).encode('utf-8')
+        for chunk_size in [1, 7, 1000, len(body)]:
+            chunks = (body[i:i + chunk_size]
+                      for i in range(0, len(body), chunk_size))
+            assert list(sdr.iter_nwis_time_series(chunks)) == \
+                json_data['value']['timeSeries']
+    with pytest.raises(json.JSONDecodeError):
+        list(sdr.iter_nwis_time_series([body[:len(body) // 2]]))
+    with pytest.raises(json.JSONDecodeError):
+        list(sdr.iter_nwis_time_series([b'<html>error</html>']))
+
+
+def test_get_streamflow_data_stream(monkeypatch):
+    body = json.dumps(make_nwis_json(['01', '02'], 2000)).encode('utf-8')
+    monkeypatch.setattr(sdr, 'call_nwis_service',
+                        lambda *args, **kwargs: FakeResponse(body))
+    args = (['01', '02'], '2000-03-20', '2000-04-20', 'iv', 'h')
+    pd.testing.assert_frame_equal(sdr.get_streamflow_data(*args),
+                                  sdr.get_streamflow_data(*args, stream=True))
+
+
+def json_to_rdb(json_data, utc_offset=True):
+    # write the nwis json data the way nwis writes rdb
+    lines = ['# US Geological Survey', '# retrieved: 2020-01-01']
+    tz_codes = {'-05:00': 'EST', '-04:00': 'EDT'}
+    for i, ts in enumerate(json_data['value']['timeSeries']):
+        site_code = ts['sourceInfo']['siteCode'][0]['value']
+        value_col = f'{1000 + i}_00060' + ('' if utc_offset else '_00003')
+        lines += ['#', f'# Data provided for site {site_code}', '#']
+        if utc_offset:
+            lines += [f'agency_cd\tsite_no\tdatetime\ttz_cd\t{value_col}\t'
+                      f'{value_col}_cd', '5s\t15s\t20d\t6s\t14n\t10s']
+        else:
+            lines += [f'agency_cd\tsite_no\tdatetime\t{value_col}\t'
+                      f'{value_col}_cd', '5s\t15s\t20d\t14n\t10s']
+        for v in ts['values'][0]['value']:
+            date_txt = v['dateTime'][:10] + ' ' + v['dateTime'][11:16]
+            if not utc_offset:
+                # daily values only have the date
+                date_txt = date_txt[:10]
+            tz = [tz_codes[v['dateTime'][23:]]] if utc_offset else []
+            lines.append('\t'.join(['USGS', site_code, date_txt] + tz +
+                                   [v['value'], ':'.join(v['qualifiers'])]))
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def test_iter_rdb_sections():
+    body = json_to_rdb(make_nwis_json(['01', '02', '03'], 20))
+    sections = list(sdr.iter_rdb_sections([body]))
+    assert len(sections) == 3
+    assert all(s.startswith(b'agency_cd\t') for s in sections)
+    for chunk_size in [1, 5, 11, 300]:
+        chunks = (body[i:i + chunk_size]
+                  for i in range(0, len(body), chunk_size))
+        assert list(sdr.iter_rdb_sections(chunks)) == sections
+    assert list(sdr.iter_rdb_sections([b'# No sites found\n'])) == []
+
+
+def test_nwis_rdb_to_df():
+    for utc_offset, time_scale in [(True, 'h'), (True, '15min'),
+                                   (False, 'D')]:
+        freq = '15min' if utc_offset else 'D'
+        json_data = make_nwis_json(['01', '02'], 2000, utc_offset, freq)
+        args = ('2000-03-20', '2000-04-20', time_scale)
+        sections = sdr.iter_rdb_sections([json_to_rdb(json_data,
+                                                      utc_offset)])
+        pd.testing.assert_frame_equal(sdr.nwis_json_to_df(json_data, *args),
+                                      sdr.nwis_rdb_to_df(sections, *args))
+
+
+def test_get_streamflow_data_rdb(monkeypatch):
+    json_data = make_nwis_json(['01', '02'], 2000)
+    bodies = {'json': json.dumps(json_data).encode(),
+              'rdb': json_to_rdb(json_data)}
+    monkeypatch.setattr(sdr, 'call_nwis_service',
+                        lambda *args, response_format='json', **kwargs:
+                        FakeResponse(bodies[response_format]))
+    args = (['01', '02'], '2000-03-20', '2000-04-20', 'iv', 'h')
+    df = sdr.get_streamflow_data(*args)
+    for stream in [False, True]:
+        pd.testing.assert_frame_equal(df, sdr.get_streamflow_data(
+            *args, stream=stream, response_format='rdb'))
+    with pytest.raises(ValueError):
+        sdr.get_streamflow_data(*args, response_format='xml')
+
+
+def test_get_date_windows():
+    windows = sdr.get_date_windows('1999-06-01', '2002-01-01', 'YS')
+    assert [w[:2] for w in windows] == [('1999-06-01', '2000-01-02'),
+                                        ('2000-01-01', '2001-01-02'),
+                                        ('2001-01-01', '2002-01-01')]
+    assert windows[0][2] is None and windows[-1][3] is None
+    assert windows[0][3] == windows[1][2] == pd.Timestamp('2000-01-02')
+    assert len(sdr.get_date_windows('2000-01-01', '2000-06-01', 'YS')) == 1
+
+
+def test_get_streamflow_data_windows(monkeypatch):
+    utc_index = pd.date_range('1999-01-01', '2003-01-01', freq='15min')
+    truth = pd.DataFrame({'01': np.arange(len(utc_index), dtype='float64'),
+                          '02': np.arange(len(utc_index), dtype='float64')},
+                         index=utc_index)
+    truth.loc['2000-03-01':'2000-04-01', '02'] = np.nan
+    calls = []
+
+    def fake_streamflow_data(sites, start_date, end_date, product,
+                             time_scale, **kwargs):
+        # like nwis, the dates are local (EST) days
+        calls.append((start_date, end_date))
+        local_start = pd.Timestamp(start_date) + pd.Timedelta(hours=5)
+        local_end = pd.Timestamp(end_date) + pd.Timedelta(hours=29)
+        df = truth[(truth.index >= local_start) & (truth.index < local_end)]
+        df = df.dropna(how='all', axis=1)
+        return sdr.resample_reindex(df, start_date, end_date, time_scale)
+
+    monkeypatch.setattr(sdr, 'get_streamflow_data', fake_streamflow_data)
+    args = (['01', '02'], '1999-06-01', '2002-07-01', 'iv', 'h')
+    df = fake_streamflow_data(*args)
+    df_windows = sdr.get_streamflow_data_windows(*args, window_freq='YS')
+    assert len(calls) == 5
+    pd.testing.assert_frame_equal(df, df_windows)
@@ -22,4 +22,32 @@ def test_convert_df_to_ds():
     assert len(ds[idx_name]) == 31
 
 
+def test_truncate_zarr(tmp_path):
+    out_zarr = str(tmp_path / 'data')
+    dates = pd.date_range(start='2019-01-01', end='2019-01-05')
+    df = pd.DataFrame(np.arange(15).reshape(5, 3), index=dates,
+                      columns=['a', 'b', 'c'])
+    ds = ut.convert_df_to_dataset(df, 'site', 'date', 'my_data')
+    ds.transpose('site', 'date').to_zarr(out_zarr)
+    ut.truncate_zarr(out_zarr, 'date', 2)
+    ds = xr.open_zarr(out_zarr)
+    assert ds.sizes['date'] == 2
+    assert ds['my_data'].sel(site='b').values.tolist() == [1, 4]
 
+
+def test_align_chunks_for_append(tmp_path):
+    out_zarr = str(tmp_path / 'data')
+    df = pd.DataFrame(np.arange(60).reshape(20, 3), columns=['a', 'b', 'c'])
+    chunks = {'idx': 4, 'col': 2}
+    for start, end in [(0, 7), (7, 14), (14, 20)]:
+        ds = ut.convert_df_to_dataset(df.iloc[start:end], 'col', 'idx',
+                                      'my_data', chunks)
+        if start:
+            ds = ut.align_chunks_for_append(ds, out_zarr, 'idx')
+            # the first dask chunk fills up the last zarr chunk
+            assert ds['my_data'].chunks[0][0] == 4 - start % 4
+            ds.to_zarr(out_zarr, mode='a', append_dim='idx')
+        else:
+            ds.to_zarr(out_zarr, mode='w')
+    ds = xr.open_zarr(out_zarr)
+    assert ds['my_data'].values.tolist() == df.values.tolist()
@@ -1,5 +1,10 @@
+import pytest
 import weight_grid_nldas as wt
+import numpy as np
 import pandas as pd
+import xarray as xr
+import geopandas as gpd
+from shapely.geometry import box
 
 col1 = ['0', '12', '3']
 col2 = ['0', '11', '3']
@@ -46,3 +51,229 @@ def test_resize_individual_cols():
     assert resized.columns.equals(combined_cols)
     assert resized.index.equals(df1.index)
 
+
+def test_get_candidate_cells():
+    lat = np.array([0.5, 1.5, 2.5])
+    lon = np.array([10.5, 11.5, 12.5, 13.5])
+    bounds = pd.DataFrame({'minx': [10.2, 12.1, 20.], 'miny': [0.2, 1.1, 0.],
+                           'maxx': [10.8, 13.9, 21.], 'maxy': [0.8, 2.2, 1.]})
+    poly_pos, grid_nums = wt.get_candidate_cells(bounds, lat, lon)
+    assert poly_pos.tolist() == [0, 1, 1, 1, 1]
+    assert grid_nums.tolist() == [0, 6, 7, 10, 11]
+
+
+def test_regular_grid_weights():
+    lat = np.array([0.5, 1.5, 2.5])
+    lon = np.array([10.5, 11.5, 12.5, 13.5])
+    catchments = gpd.GeoDataFrame({'FEATUREID': [1, 2]},
+                                  geometry=[box(10, 0, 11, 1),
+                                            box(12, 1, 12.5, 3)],
+                                  crs='epsg:4326')
+    triplets = wt.calculate_weight_matrix_regular_grid(catchments, lat, lon,
+                                                       'FEATUREID')
+    assert triplets['nhd_comid'].tolist() == [1, 2, 2]
+    assert triplets['nldas_grid_no'].tolist() == [0, 6, 10]
+    assert np.allclose(triplets['weight'], [1., 0.5, 0.5])
+
+
+def test_regular_grid_weights_bbox_sample(tmp_path):
+    from pull_nldas import subset_nldas
+    lat = np.array([0.5, 1.5, 2.5])
+    lon = np.array([10.5, 11.5, 12.5, 13.5])
+    ds = xr.Dataset({'pressfc': (('lat', 'lon'), np.ones((3, 4)))},
+                    coords={'lat': lat, 'lon': lon})
+    full_nc = str(tmp_path / 'full.nc')
+    ds.to_netcdf(full_nc)
+    # the sample of a store pulled for rows 1-2 and columns 2-3
+    sub_nc = str(tmp_path / 'sub.nc')
+    subset_nldas(ds, bbox=(12.2, 1.2, 13.8, 2.8)).to_netcdf(sub_nc)
+    catchments = gpd.GeoDataFrame({'FEATUREID': [1, 2]},
+                                  geometry=[box(12, 1, 13, 2),
+                                            box(12.5, 1, 14, 3)],
+                                  crs='epsg:4326')
+    weights = {}
+    for name, nc_file in [('full', full_nc), ('sub', sub_nc)]:
+        sub_lat, sub_lon, grid_no, num_grid_cells = \
+            wt.read_regular_grid(nc_file)
+        assert num_grid_cells == 12
+        weights[name] = wt.calculate_chunk_weights(
+            catchments, (sub_lat, sub_lon, grid_no), 'FEATUREID',
+            regular_grid=True)
+    assert weights['sub']['nldas_grid_no'].tolist() == [6, 6, 7, 10, 11]
+    assert weights['sub'].equals(weights['full'])
+
+
+def test_iterate_chunk_weights_workers():
+    lat = np.array([0.5, 1.5, 2.5])
+    lon = np.array([10.5, 11.5, 12.5, 13.5])
+    catchments = gpd.GeoDataFrame({'FEATUREID': [1, 2, 3, 4]},
+                                  geometry=[box(10, 0, 11, 1),
+                                            box(12, 1, 12.5, 3),
+                                            box(10.5, 0.5, 11.5, 1.5),
+                                            box(13, 2, 14, 3)],
+                                  crs='epsg:4326')
+    nhd_chunks = list(wt.split_catchments(catchments, 2))
+    serial = wt.iterate_chunk_weights(nhd_chunks, (lat, lon, None),
+                                      'FEATUREID', regular_grid=True)
+    parallel = wt.iterate_chunk_weights(nhd_chunks, (lat, lon, None),
+                                        'FEATUREID', regular_grid=True,
+                                        workers=2)
+    serial = pd.concat([w for _, w in serial])
+    serial = serial.sort_values(['nhd_comid', 'nldas_grid_no'])
+    parallel = pd.concat([w for _, w in parallel])
+    parallel = parallel.sort_values(['nhd_comid', 'nldas_grid_no'])
+    assert serial.reset_index(drop=True).equals(
+        parallel.reset_index(drop=True))
+
+
+def test_hilbert_distance():
+    x, y = np.meshgrid(np.arange(8), np.arange(8))
+    x = x.ravel()
+    y = y.ravel()
+    dist = wt.hilbert_distance(x, y, order=3)
+    assert sorted(dist) == list(range(64))
+    # consecutive points along the curve are neighboring cells
+    order = np.argsort(dist)
+    steps = np.abs(np.diff(x[order])) + np.abs(np.diff(y[order]))
+    assert (steps == 1).all()
+
+
+def test_read_catchment_batches(tmp_path):
+    catchments = gpd.GeoDataFrame({'FEATUREID': [1, 2, 3, 4, 5]},
+                                  geometry=[box(i, 0, i + 1, 1)
+                                            for i in range(5)],
+                                  crs='epsg:4326')
+    polygon_file = str(tmp_path / 'catchments.gpkg')
+    catchments.to_file(polygon_file, driver='GPKG')
+    batches = list(wt.read_catchment_batches(polygon_file, None, 2,
+                                             'epsg:5070'))
+    assert [b.shape[0] for _, b in batches] == [2, 2, 1]
+    assert batches[0][1].crs == 'epsg:5070'
+    assert [i for i, _ in batches] == ['0:2', '2:4', '4:6']
+    all_ids = pd.concat([b for _, b in batches])['FEATUREID'].tolist()
+    assert all_ids == [1, 2, 3, 4, 5]
+
+
+def test_merge_weight_grid(tmp_path):
+    df2.to_parquet(str(tmp_path / 'b_uint8.parquet'))
+    df1.to_parquet(str(tmp_path / 'a_uint8.parquet'))
+    assert wt.get_cols_from_chunk_folder(str(tmp_path)).equals(combined_cols)
+    wt.merge_weight_grid(str(tmp_path), 'all_weights', num_grid_cells=13,
+                         batch_size=2, write_size=4)
+    ds = xr.open_zarr(str(tmp_path / 'all_weights'))
+    assert ds.attrs['num_grid_cells'] == 13
+    # zeros are dropped, everything else is kept
+    assert ds.sizes['nnz'] == 16
+    assert ds['nhd_comid'].values.tolist() == [1, 1, 2, 2, 2, 3, 3, 3,
+                                               4, 4, 5, 5, 5, 6, 6, 6]
+    assert np.allclose(ds['weight'].values[:2], [2 / 255., 1 / 255.])
+
+    wt.merge_weight_grid(str(tmp_path), 'quantized', num_grid_cells=13,
+                         batch_size=2, write_size=4, weight_dtype='uint16')
+    ds = xr.open_zarr(str(tmp_path / 'quantized'))
+    assert ds.attrs['weight_scale'] == 65535
+    # the errors of all of the batches, not just the last one
+    assert ds.attrs['weight_num_weights'] == 16
+    assert 0 < ds.attrs['weight_mean_error'] <= \
+        ds.attrs['weight_max_error'] <= 1 / 65535.
+    assert ds.attrs['weight_max_sum_error'] <= 0.5 / 65535.
+
+
+def test_save_zarr_dense_append(tmp_path):
+    out_zarr = str(tmp_path / 'weights')
+    weights = pd.DataFrame(np.random.rand(70000, 2), columns=[0, 1],
+                           index=np.arange(70000))
+    # 35000 rows do not line up with the 30000-row zarr chunks
+    wt.save_zarr(weights.iloc[:35000], out_zarr, s3=False)
+    wt.save_zarr(weights.iloc[35000:], out_zarr, append=True, s3=False)
+    ds = xr.open_zarr(out_zarr)
+    assert np.allclose(ds['weight'].values, weights.values)
+    assert ds['nhd_comid'].values.tolist() == weights.index.tolist()
+
+
+def test_save_zarr_sparse_append(tmp_path):
+    out_zarr = str(tmp_path / 'weights')
+    triplets = pd.DataFrame({'nhd_comid': np.repeat(np.arange(10), 3),
+                             'nldas_grid_no': np.tile([0, 5, 9], 10),
+                             'weight': np.random.rand(30)})
+    triplets = triplets.astype({'nhd_comid': 'uint32',
+                                'nldas_grid_no': 'uint32',
+                                'weight': 'float32'})
+    # 15 triplets do not line up with the 10-triplet zarr chunks
+    wt.save_zarr(triplets.iloc[:15], out_zarr, num_grid_cells=10, s3=False,
+                 chunk_size=10)
+    wt.save_zarr(triplets.iloc[15:], out_zarr, num_grid_cells=10,
+                 append=True, s3=False, chunk_size=10)
+    ds = xr.open_zarr(out_zarr)
+    assert ds['weight'].encoding['chunks'] == (10,)
+    assert np.allclose(ds['weight'].values, triplets['weight'].values)
+    assert ds['nhd_comid'].values.tolist() == \
+        triplets['nhd_comid'].tolist()
+
+
+def fail_on_second_call(func):
+    calls = []
+
+    def failing(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 2:
+            raise IOError('ran out of time')
+        return func(*args, **kwargs)
+    return failing
+
+
+def test_resume_weight_matrix_chunks(tmp_path, monkeypatch):
+    lat = np.arange(36.0625, 37, 0.125)
+    lon = np.arange(-99.9375, -99, 0.125)
+    grid_nc = str(tmp_path / 'grid.nc')
+    xr.Dataset({'pressfc': (('lat', 'lon'), np.ones((len(lat), len(lon))))},
+               coords={'lat': lat, 'lon': lon}).to_netcdf(grid_nc)
+    catchments = gpd.GeoDataFrame(
+        {'FEATUREID': np.arange(1, 10)},
+        geometry=[box(-99.9 + 0.09 * i, 36.1, -99.75 + 0.09 * i,
+                      36.3 + 0.05 * i) for i in range(9)],
+        crs='epsg:4326')
+    polygon_file = str(tmp_path / 'catchments.gpkg')
+    catchments.to_file(polygon_file, driver='GPKG')
+    kwargs = {'num_splits': 3, 'regular_grid': True,
+              'weight_dtype': 'uint16', 's3': False}
+    full_zarr = str(tmp_path / 'full')
+    wt.calculate_weight_matrix_chunks(polygon_file, grid_nc, full_zarr,
+                                      **kwargs)
+    expected = xr.open_zarr(full_zarr)
+
+    calculate_chunk_weights = wt.calculate_chunk_weights
+    done_chunks = []
+
+    def record_chunk(nhd_chunk, *args, **kwargs):
+        done_chunks.append(nhd_chunk['FEATUREID'].tolist())
+        return calculate_chunk_weights(nhd_chunk, *args, **kwargs)
+
+    # die while working on the second chunk, or after writing it but before
+    # recording it in the manifest (so it has to be cut off the store)
+    for func_name in ['calculate_chunk_weights', 'write_manifest']:
+        out_zarr = str(tmp_path / func_name)
+        monkeypatch.setattr(wt, func_name,
+                            fail_on_second_call(getattr(wt, func_name)))
+        with pytest.raises(IOError):
+            wt.calculate_weight_matrix_chunks(polygon_file, grid_nc,
+                                              out_zarr, **kwargs)
+        monkeypatch.undo()
+        manifest = wt.read_manifest(wt.get_manifest_path(out_zarr), s3=False)
+        assert manifest['done'] == ['0:3']
+        if func_name == 'write_manifest':
+            assert xr.open_zarr(out_zarr).sizes['nnz'] > manifest['size']
+
+        done_chunks.clear()
+        monkeypatch.setattr(wt, 'calculate_chunk_weights', record_chunk)
+        wt.calculate_weight_matrix_chunks(polygon_file, grid_nc, out_zarr,
+                                          resume=True, **kwargs)
+        monkeypatch.undo()
+        # the finished chunk is not done again
+        assert done_chunks == [[4, 5, 6], [7, 8, 9]]
+        resumed = xr.open_zarr(out_zarr)
+        assert resumed.sizes['nnz'] == expected.sizes['nnz']
+        for var_name in expected.data_vars:
+            assert (resumed[var_name].values ==
+                    expected[var_name].values).all()
+        assert resumed.attrs == expected.attrs
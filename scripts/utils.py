@@ -13,6 +13,8 @@ import numpy as np
 import pandas as pd
 import requests
 import xarray as xr
+import zarr
+import http_client
 
 base_nldi_url = 'https://labs.waterdata.usgs.gov/api/nldi'
 hucs = [f'{h:02}' for h in range(1, 19)]
@@ -57,7 +59,7 @@ def generate_nldi_url(category, identifier, service=None):
 
 
 def json_from_nldi_request(url):
-    r = requests.get(url)
+    r = http_client.get(url)
     json_content = json.loads(r.content)
     return json_content
 
@@ -185,7 +187,7 @@ def get_nldi_data_huc2(identifiers, out_file, get_one_func, identifier_name,
                       flush=True)
                 if single_df is not None:
                     df_list.append(single_df)
-            except (requests.exceptions.ConnectionError,
+            except (requests.exceptions.RequestException,
                     json.decoder.JSONDecodeError):
                 continue
 
@@ -279,3 +281,93 @@ def convert_df_to_dataset(df, col_name, idx_name, data_name, chunks=None):
     return data_set
 
 
+def truncate_zarr(zarr_store, dim_name, new_size):
+    """
+    cut all of the arrays in a zarr store that have the dimension dim_name back
+    to new_size along that dimension. this gets rid of anything that was
+    appended after the last recorded write (e.g., if a run died after writing a
+    chunk but before recording it)
+    :param zarr_store: [str or s3fsMap] the zarr store
+    :param dim_name: [str] the name of the dimension that was appended to
+    :param new_size: [int] the size the dimension should have
+    :return: None
+    """
+    ds = xr.open_zarr(zarr_store)
+    if ds.sizes[dim_name] == new_size:
+        return
+    print(f"truncating {dim_name} from {ds.sizes[dim_name]} to {new_size}",
+          flush=True)
+    z = zarr.open_group(zarr_store, mode='a')
+    for var_name, var in ds.variables.items():
+        if dim_name in var.dims:
+            arr = z[var_name]
+            new_shape = list(arr.shape)
+            new_shape[var.dims.index(dim_name)] = new_size
+            arr.resize(tuple(new_shape))
+    # so the consolidated metadata shows the new sizes
+    zarr.consolidate_metadata(zarr_store)
+
+
+def align_chunks_for_append(ds, zarr_store, dim_name):
+    """
+    rechunk the variables of a dataset that is going to be appended to a zarr
+    store along dim_name so that its first dask chunk exactly fills the last,
+    partly filled zarr chunk of the store and every later dask chunk is one
+    whole zarr chunk. otherwise xarray will not append dask arrays whose
+    chunks would overlap the store's zarr chunks
+    :param ds: [xarray dataset] the data to append
+    :param zarr_store: [str or s3fsMap] the zarr store that will be appended to
+    :param dim_name: [str] the name of the dimension that is appended to
+    :return: [xarray dataset] the rechunked data
+    """
+    z = zarr.open_group(zarr_store, mode='r')
+    for var_name, var in ds.data_vars.items():
+        if dim_name not in var.dims or var_name not in z:
+            continue
+        arr = z[var_name]
+        axis = var.dims.index(dim_name)
+        zarr_chunk = arr.chunks[axis]
+        new_size = var.shape[axis]
+        first = min(zarr_chunk - arr.shape[axis] % zarr_chunk, new_size)
+        chunks = [first] if first else []
+        num_full, last = divmod(new_size - first, zarr_chunk)
+        chunks += [zarr_chunk] * num_full + ([last] if last else [])
+        ds[var_name] = var.chunk({dim_name: tuple(chunks)})
+    return ds
+
+
+def trim_to_time_done(ds):
+    """
+    cut a dataset with a time_done completion bitmap (e.g., an nldas store
+    pulled with region writes, which is pre-allocated to the end date) back
+    to the time steps before the first one that is not done, so steps that
+    have not been pulled yet are not read as data. datasets without a bitmap
+    are given back as they are
+    :param ds: [xarray dataset] the dataset
+    :return: [xarray dataset] the done time steps, without the bitmap
+    """
+    if 'time_done' not in ds.variables:
+        return ds
+    time_done = ds['time_done'].values
+    num_done = len(time_done) if time_done.all() else int(time_done.argmin())
+    if num_done < len(time_done):
+        print(f"only the first {num_done} of {len(time_done)} time steps are "
+              f"done. using those", flush=True)
+    return ds.isel(time=slice(0, num_done)).drop_vars('time_done')
+
+
+def get_nldas_grid_no(ds):
+    """
+    get the nldas_grid_no of each grid cell of nldas data in lat-major order.
+    the cells are numbered over the full nldas grid like the weight grids. the
+    cells of a store pulled for a bbox keep their full-grid numbers, which
+    come from the nldas_row and nldas_col coordinates and the nldas_num_lon
+    attribute that subset_nldas adds
+    :param ds: [xarray dataset] the (time x lat x lon) nldas data
+    :return: [numpy array] the nldas_grid_no of each cell
+    """
+    if 'nldas_row' not in ds.variables:
+        return np.arange(ds.sizes['lat'] * ds.sizes['lon'])
+    rows = ds['nldas_row'].values
+    cols = ds['nldas_col'].values
+    return (rows[:, np.newaxis] * ds.attrs['nldas_num_lon'] + cols).ravel()
@@ -1,16 +1,26 @@
 import os
+import json
 import numpy as np
 from pull_nldas import get_urs_pass_user, connect_to_urs
-from utils import convert_df_to_dataset, divide_chunks
+from utils import convert_df_to_dataset, divide_chunks, truncate_zarr, \
+    align_chunks_for_append, get_nldas_grid_no
+from sparse_weights import overlay_to_triplets, dense_to_triplets, \
+    is_sparse_weights, triplets_to_dataset, nldas_num_grid_cells, nnz_dim, \
+    quantize_triplets, is_quantized, combine_quantize_errors, \
+    write_quantize_errors
 import xarray as xr
 import pandas as pd
 import geopandas as gpd
 import rioxarray
+from shapely.geometry import box
 from osgeo import gdal, osr, ogr
 import s3fs
+import pyarrow as pa
+import pyarrow.parquet as pq
 import datetime
 from dateutil import tz
 import math
+from multiprocessing import Pool
 
 
 def make_example_nc(nldas_path, out_file):
@@ -98,7 +108,7 @@ def project_grid_vector(grid_vector_file, out_file, target_epsg=5070):
 def calculate_weight_matrix_one_chunk(nhd_catchments, grid_gdf, polygon_id_col,
                                       grid_id_col='grid_num',
                                       str_col_names=False,
-                                      ):
+                                      sparse=False):
     """
     calculate the weight matrix for a subset (or theoretically all) nhd
     catchments which are stored in a geodataframe
@@ -106,17 +116,19 @@ def calculate_weight_matrix_one_chunk(nhd_catchments, grid_gdf, polygon_id_col,
     :param grid_gdf: [geodataframe] the grid for which the weight matrix will
     :param str_col_names: [bool] whether the col names should be converted to
     a string be calculated
+    :param sparse: [bool] if True, return the weights as (nhd_comid,
+    nldas_grid_no, weight) triplets instead of a dense catchment x grid cell df
     :return:
     """
-
-    # create blank df to populate so that all have the same shape
     num_grid_cells = grid_gdf.shape[0]
-    blank_df = pd.DataFrame(0, index=nhd_catchments[polygon_id_col],
-                            columns=range(num_grid_cells))
 
     # get the original area before doing the intersection
     nhd_catchments['orig_area'] = nhd_catchments.geometry.area
 
+    # only overlay the grid cells inside the bounding box of the catchments
+    minx, miny, maxx, maxy = nhd_catchments.total_bounds
+    grid_gdf = grid_gdf.cx[minx:maxx, miny:maxy]
+
     inter = gpd.overlay(grid_gdf, nhd_catchments, how='intersection')
 
     # get the area after the intersection
@@ -125,6 +137,13 @@ def calculate_weight_matrix_one_chunk(nhd_catchments, grid_gdf, polygon_id_col,
     # get the weighted area
     inter['weighted_area'] = inter['new_area'] / inter['orig_area']
 
+    if sparse:
+        return overlay_to_triplets(inter, polygon_id_col, grid_id_col)
+
+    # create blank df to populate so that all have the same shape
+    blank_df = pd.DataFrame(0, index=nhd_catchments[polygon_id_col],
+                            columns=range(num_grid_cells))
+
     # pivot so we get the weight matrix
     print(inter)
     matrix_df = inter.pivot(index=polygon_id_col, columns=grid_id_col,
@@ -144,50 +163,532 @@ def calculate_weight_matrix_one_chunk(nhd_catchments, grid_gdf, polygon_id_col,
     return matrix_df
 
 
-def calculate_weight_matrix_chunks(polygon_file, grid_file, out_zarr_store,
-                                   num_splits=15, layer=None,
-                                   polygon_id_col='FEATUREID'):
+def read_regular_grid(grid_nc):
     """
-    calculate the weight matrix in chunks for all nhd catchments over a given
-    grid. The output of this is a zarr data store
-    :param polygon_file: [str] file path to the nhd geodatabase with the
-    catchment layer
-    :param grid_file: [str] file path to the geometric file that has the grid.
-    This should be a projected, vectorized representation of the grid
-    :param out_zarr_store: [str] path to the output zarr store
-    :return: None
+    read the cell center coordinates of a regular lat/lon grid from a netcdf
+    file (e.g., the sample nldas netcdf) and the nldas_grid_no of its cells.
+    if the file was taken from a store pulled for a bbox, its cells keep
+    their numbers in the full grid (see utils.get_nldas_grid_no) and the
+    number of cells is that of the full grid
+    :param grid_nc: [str] path to the netcdf file with 'lat' and 'lon' coords
+    :return: [tuple] (lat array, lon array, array of the nldas_grid_no of
+    each cell in lat-major order, number of cells in the full grid)
+    """
+    ds = xr.open_dataset(grid_nc)
+    lat = ds.lat.values
+    lon = ds.lon.values
+    grid_no = get_nldas_grid_no(ds)
+    if 'nldas_row' in ds.variables:
+        num_grid_cells = ds.attrs['nldas_num_lat'] * ds.attrs['nldas_num_lon']
+    else:
+        num_grid_cells = len(lat) * len(lon)
+    ds.close()
+    return lat, lon, grid_no, num_grid_cells
+
+
+def coords_to_indices(coords, min_vals, max_vals):
+    """
+    get the range of cell indices along one dimension of a regular grid that
+    a set of [min, max] bounds fall in. indices are clipped to the grid
+    :param coords: [numpy array] the evenly spaced cell center coordinates
+    :param min_vals: [numpy array] the minimum bound of each polygon
+    :param max_vals: [numpy array] the maximum bound of each polygon
+    :return: [tuple] (first index, last index) arrays
+    """
+    res = (coords[-1] - coords[0]) / (len(coords) - 1)
+    first_edge = coords[0] - res / 2
+    idx_min = np.floor((min_vals - first_edge) / res).astype(int)
+    idx_max = np.floor((max_vals - first_edge) / res).astype(int)
+    # for descending coordinates the max bound has the lower index
+    idx_lo = np.clip(np.minimum(idx_min, idx_max), 0, len(coords) - 1)
+    idx_hi = np.clip(np.maximum(idx_min, idx_max), -1, len(coords) - 1)
+    # polygons completely outside of the grid get an empty range
+    outside = (np.maximum(idx_min, idx_max) < 0) | \
+              (np.minimum(idx_min, idx_max) > len(coords) - 1)
+    idx_hi[outside] = idx_lo[outside] - 1
+    return idx_lo, idx_hi
+
+
+def get_candidate_cells(bounds, lat, lon):
+    """
+    find the grid cells that each polygon could intersect from the polygon
+    bounds by index arithmetic on the regular grid
+    :param bounds: [pandas df] the polygon bounds (minx, miny, maxx, maxy) in
+    the grid's crs
+    :param lat: [numpy array] the grid cell center latitudes
+    :param lon: [numpy array] the grid cell center longitudes
+    :return: [tuple] (polygon position array, grid_num array) with one entry
+    per candidate polygon/grid cell pair
+    """
+    row_lo, row_hi = coords_to_indices(lat, bounds['miny'].values,
+                                       bounds['maxy'].values)
+    col_lo, col_hi = coords_to_indices(lon, bounds['minx'].values,
+                                       bounds['maxx'].values)
+    num_rows = np.maximum(row_hi - row_lo + 1, 0)
+    num_cols = np.maximum(col_hi - col_lo + 1, 0)
+    counts = num_rows * num_cols
+    poly_pos = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                  counts)
+    num_cols = num_cols[poly_pos]
+    rows = row_lo[poly_pos] + offsets // num_cols
+    cols = col_lo[poly_pos] + offsets % num_cols
+    grid_nums = rows * len(lon) + cols
+    return poly_pos, grid_nums
+
+
+def make_grid_cells(grid_nums, lat, lon, grid_crs='epsg:4326'):
     """
-    grid_gdf = gpd.read_file(grid_file)
+    make polygons for a set of cells of a regular lat/lon grid
+    :param grid_nums: [numpy array] the grid_nums of the cells
+    :param lat: [numpy array] the grid cell center latitudes
+    :param lon: [numpy array] the grid cell center longitudes
+    :param grid_crs: [str] crs of the grid
+    :return: [geoseries] the cell polygons indexed by grid_num
+    """
+    lat_res = abs(lat[-1] - lat[0]) / (len(lat) - 1)
+    lon_res = abs(lon[-1] - lon[0]) / (len(lon) - 1)
+    cell_lat = lat[grid_nums // len(lon)]
+    cell_lon = lon[grid_nums % len(lon)]
+    cells = [box(x - lon_res / 2, y - lat_res / 2, x + lon_res / 2,
+                 y + lat_res / 2) for x, y in zip(cell_lon, cell_lat)]
+    return gpd.GeoSeries(cells, index=grid_nums, crs=grid_crs)
+
+
+def calculate_weight_matrix_regular_grid(nhd_catchments, lat, lon,
+                                         polygon_id_col,
+                                         grid_crs='epsg:4326', grid_no=None):
+    """
+    calculate the sparse weight matrix of (a subset of) nhd catchments over a
+    regular lat/lon grid without vectorizing the whole grid or doing a general
+    overlay. the candidate cells of each catchment are found from its bounds
+    and only those cells are made into polygons and clipped
+    :param nhd_catchments: [geodataframe] (subset of) nhd catchment layer in
+    a projected (equal area) crs
+    :param lat: [numpy array] the grid cell center latitudes
+    :param lon: [numpy array] the grid cell center longitudes
+    :param polygon_id_col: [str] name of the catchment id column
+    :param grid_crs: [str] crs of the grid
+    :param grid_no: [numpy array] the nldas_grid_no of each cell of the grid
+    in lat-major order (see read_regular_grid). if None, the cells are
+    numbered 0 to len(lat) * len(lon) - 1
+    :return: [pandas df] the weight triplets
+    """
+    bounds = nhd_catchments.geometry.to_crs(grid_crs).bounds
+    poly_pos, grid_nums = get_candidate_cells(bounds, lat, lon)
+
+    # project just the candidate cells into the catchment projection
+    unique_cells = np.unique(grid_nums)
+    cells = make_grid_cells(unique_cells, lat, lon, grid_crs)
+    cells = cells.to_crs(nhd_catchments.crs)
+
+    catchment_geoms = nhd_catchments.geometry.iloc[poly_pos]
+    catchment_geoms.index = range(len(poly_pos))
+    cell_geoms = gpd.GeoSeries(cells.loc[grid_nums].values,
+                               index=range(len(poly_pos)),
+                               crs=nhd_catchments.crs)
+    new_area = catchment_geoms.intersection(cell_geoms).area
+    orig_area = catchment_geoms.area
+
+    if grid_no is not None:
+        grid_nums = grid_no[grid_nums]
+    inter = pd.DataFrame({
+        polygon_id_col: nhd_catchments[polygon_id_col].values[poly_pos],
+        'grid_num': grid_nums,
+        'weighted_area': new_area.values / orig_area.values})
+    inter = inter[new_area.values > 0]
+    return overlay_to_triplets(inter, polygon_id_col)
+
+
+# the grid and options that a weight matrix worker process uses. these are set
+# once per worker (see init_weight_worker) instead of being sent with each chunk
+worker_grid_info = {}
+
+
+def calculate_chunk_weights(nhd_chunk, grid, polygon_id_col, sparse=False,
+                            regular_grid=False):
+    """
+    calculate the weight matrix for one chunk of catchments
+    :param nhd_chunk: [geodataframe] chunk of the nhd catchment layer
+    :param grid: [geodataframe or tuple] the vectorized grid or, if
+    regular_grid is True, a tuple of the (lat, lon) cell center arrays and
+    the nldas_grid_no of the cells (see read_regular_grid)
+    :param polygon_id_col: [str] name of the catchment id column
+    :param sparse: [bool] whether to return sparse weight triplets
+    :param regular_grid: [bool] whether the grid is a regular lat/lon grid
+    :return: [pandas df] dense weight matrix or weight triplets
+    """
+    if regular_grid:
+        lat, lon, grid_no = grid
+        return calculate_weight_matrix_regular_grid(nhd_chunk, lat, lon,
+                                                    polygon_id_col,
+                                                    grid_no=grid_no)
+    return calculate_weight_matrix_one_chunk(nhd_chunk, grid, polygon_id_col,
+                                             sparse=sparse)
+
+
+def init_weight_worker(grid, polygon_id_col, sparse, regular_grid):
+    """
+    store the grid and options in the worker process so they are only sent
+    to each worker once
+    """
+    worker_grid_info.update(grid=grid, polygon_id_col=polygon_id_col,
+                            sparse=sparse, regular_grid=regular_grid)
+
+
+def calculate_chunk_weights_worker(batch_id, nhd_chunk):
+    return batch_id, calculate_chunk_weights(nhd_chunk, **worker_grid_info)
 
-    catchment_gdf = gpd.read_file(polygon_file, layer=layer)
-    print("read in all catchments", flush=True)
-    # project catchments into same projection as grid
-    catchment_gdf = catchment_gdf.to_crs(grid_gdf.crs)
-    print("projected all catchments", flush=True)
+
+def hilbert_distance(x, y, order=16):
+    """
+    get the distance along a hilbert curve of points on a 2**order by 2**order
+    integer grid
+    :param x: [numpy array] integer x positions (0 to 2**order - 1)
+    :param y: [numpy array] integer y positions (0 to 2**order - 1)
+    :param order: [int] the order of the hilbert curve
+    :return: [numpy array] the hilbert distances
+    """
+    n = 2 ** order
+    x = np.asarray(x, dtype='int64')
+    y = np.asarray(y, dtype='int64')
+    d = np.zeros(len(x), dtype='int64')
+    s = n // 2
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant so the curve stays continuous
+        flip = rx & ~ry
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+        s //= 2
+    return d
+
+
+def sort_catchments_spatially(catchment_gdf, order=16):
+    """
+    sort the catchments along a hilbert curve through the centers of their
+    bounding boxes so that catchments that are near each other end up in the
+    same chunk
+    :param catchment_gdf: [geodataframe] the nhd catchments
+    :param order: [int] the order of the hilbert curve
+    :return: [geodataframe] the sorted catchments
+    """
+    bounds = catchment_gdf.geometry.bounds
+    x = ((bounds['minx'] + bounds['maxx']) / 2).values
+    y = ((bounds['miny'] + bounds['maxy']) / 2).values
+    max_pos = 2 ** order - 1
+    x_pos = (x - x.min()) / max(x.max() - x.min(), 1e-12) * max_pos
+    y_pos = (y - y.min()) / max(y.max() - y.min(), 1e-12) * max_pos
+    dist = hilbert_distance(x_pos.astype('int64'), y_pos.astype('int64'),
+                            order)
+    return catchment_gdf.iloc[np.argsort(dist, kind='stable')]
+
+
+def split_catchments(catchment_gdf, num_splits, done_batches=()):
+    """
+    split the catchments into num_splits chunks
+    :param catchment_gdf: [geodataframe] the nhd catchments
+    :param num_splits: [int] the number of chunks
+    :param done_batches: [collection] ids of the chunks that are already done
+    and should be skipped
+    :return: [generator] (chunk id, catchment chunk) tuples
+    """
     nrows = catchment_gdf.shape[0]
     num_per_chunk = nrows / num_splits
     for n in range(num_splits):
         start_chunk = math.floor(num_per_chunk * n)
         end_chunk = math.floor(num_per_chunk * (n + 1))
+        batch_id = f'{start_chunk}:{end_chunk}'
+        if batch_id in done_batches:
+            print(f"already did {start_chunk} to {end_chunk}", flush=True)
+            continue
         print(f"getting wgt matrix for {start_chunk} to {end_chunk}",
               flush=True)
-        nhd_chunk = catchment_gdf.iloc[start_chunk: end_chunk, :]
-        chunk_wgts = calculate_weight_matrix_one_chunk(nhd_chunk, grid_gdf,
-                                                       polygon_id_col)
-        save_zarr(chunk_wgts, out_zarr_store)
+        yield batch_id, catchment_gdf.iloc[start_chunk: end_chunk, :]
+
+
+def pop_finished(pending):
+    """
+    wait for one of the pending pool results to finish, remove it from the
+    list and return its value
+    :param pending: [list] pending multiprocessing AsyncResults
+    :return: the value of the finished result
+    """
+    while True:
+        for result in pending:
+            if result.ready():
+                pending.remove(result)
+                return result.get()
+        pending[0].wait(0.1)
 
 
-def save_zarr(chunk_df, out_zarr):
+def read_catchment_batches(polygon_file, layer, batch_size, target_crs,
+                           done_batches=()):
+    """
+    read the catchment layer batch_size rows at a time and project each batch
+    so that only one batch is in memory at a time
+    :param polygon_file: [str] file path to the nhd geodatabase with the
+    catchment layer
+    :param layer: [str] name of the catchment layer
+    :param batch_size: [int] the number of rows to read at a time
+    :param target_crs: the crs to project the catchments into
+    :param done_batches: [collection] ids of the batches that are already done
+    and should not be read
+    :return: [generator] (batch id, projected catchment batch) tuples
+    """
+    start = 0
+    while True:
+        batch_id = f'{start}:{start + batch_size}'
+        if batch_id in done_batches:
+            print(f"already did {batch_id}", flush=True)
+            start += batch_size
+            continue
+        batch = gpd.read_file(polygon_file, layer=layer,
+                              rows=slice(start, start + batch_size))
+        if batch.empty:
+            break
+        end = start + batch.shape[0]
+        print(f"read in catchments {start} to {end}", flush=True)
+        yield batch_id, batch.to_crs(target_crs)
+        start += batch_size
+
+
+def iterate_chunk_weights(nhd_chunks, grid, polygon_id_col, sparse=False,
+                          regular_grid=False, workers=1):
+    """
+    calculate the weight matrix for each chunk of catchments, either one after
+    another or spread over a pool of worker processes
+    :param nhd_chunks: [iterable] (chunk id, nhd catchment chunk) tuples
+    :param grid: [geodataframe or tuple] the vectorized grid or the (lat, lon)
+    cell center arrays and the nldas_grid_no of the cells of a regular grid
+    :param polygon_id_col: [str] name of the catchment id column
+    :param sparse: [bool] whether to return sparse weight triplets
+    :param regular_grid: [bool] whether the grid is a regular lat/lon grid
+    :param workers: [int] number of worker processes. if more than one, the
+    chunk weights are yielded in the order they finish. at most two chunks per
+    worker are read in ahead so that streamed chunks stay bounded in memory
+    :return: [generator] (chunk id, weights of the chunk) tuples
+    """
+    if workers > 1:
+        with Pool(workers, initializer=init_weight_worker,
+                  initargs=(grid, polygon_id_col, sparse,
+                            regular_grid)) as pool:
+            pending = []
+            for batch_id, nhd_chunk in nhd_chunks:
+                pending.append(pool.apply_async(calculate_chunk_weights_worker,
+                                                (batch_id, nhd_chunk)))
+                if len(pending) >= 2 * workers:
+                    yield pop_finished(pending)
+            while pending:
+                yield pop_finished(pending)
+    else:
+        for batch_id, nhd_chunk in nhd_chunks:
+            yield batch_id, calculate_chunk_weights(nhd_chunk, grid,
+                                                    polygon_id_col, sparse,
+                                                    regular_grid)
+
+
+def get_zarr_store(out_zarr, s3=True):
+    if s3:
+        fs = s3fs.S3FileSystem(profile='ds-drb-creds', anon=False)
+        return s3fs.S3Map(out_zarr, s3=fs)
+    return out_zarr
+
+
+def get_manifest_path(out_zarr):
+    """
+    get the path of the manifest file that sits next to the output zarr store
+    """
+    return out_zarr.rstrip('/') + '_manifest.json'
+
+
+def read_manifest(manifest_path, s3=True):
+    """
+    read the manifest of a weight grid build
+    :param manifest_path: [str] path to the manifest json file
+    :param s3: [bool] whether the manifest is on s3
+    :return: [dict] the manifest or None if there is no manifest yet
+    """
+    if s3:
+        fs = s3fs.S3FileSystem(profile='ds-drb-creds', anon=False)
+        if not fs.exists(manifest_path):
+            return None
+        with fs.open(manifest_path, 'r') as f:
+            return json.load(f)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def write_manifest(manifest, manifest_path, s3=True):
+    """
+    write the manifest of a weight grid build
+    :param manifest: [dict] the manifest
+    :param manifest_path: [str] path to the manifest json file
+    :param s3: [bool] whether the manifest is on s3
+    :return: None
+    """
+    if s3:
+        fs = s3fs.S3FileSystem(profile='ds-drb-creds', anon=False)
+        with fs.open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+    else:
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+
+
+def calculate_weight_matrix_chunks(polygon_file, grid_file, out_zarr_store,
+                                   num_splits=15, layer=None,
+                                   polygon_id_col='FEATUREID', sparse=False,
+                                   regular_grid=False, target_epsg=5070,
+                                   workers=1, chunk_order='row',
+                                   batch_size=None, resume=False,
+                                   weight_dtype=None, s3=True):
+    """
+    calculate the weight matrix in chunks for all nhd catchments over a given
+    grid. The output of this is a zarr data store. the chunks that are done
+    are recorded in a manifest file next to the zarr store
+    ([out_zarr_store]_manifest.json)
+    :param polygon_file: [str] file path to the nhd geodatabase with the
+    catchment layer
+    :param grid_file: [str] file path to the geometric file that has the grid.
+    This should be a projected, vectorized representation of the grid. if
+    regular_grid is True, this is instead a netcdf file with the grid's 'lat'
+    and 'lon' coordinates (e.g., the sample nldas netcdf). a sample taken from
+    a bbox store gives weights numbered over the full grid
+    :param out_zarr_store: [str] path to the output zarr store
+    :param sparse: [bool] if True, the weights are written as sparse
+    (nhd_comid, nldas_grid_no, weight) triplets. each chunk is appended to the
+    zarr store
+    :param regular_grid: [bool] if True, intersect the catchments with the
+    regular lat/lon grid analytically instead of overlaying a vectorized grid.
+    the weights are always written as sparse triplets in this case
+    :param target_epsg: [int] epsg code of the equal area projection the
+    catchments are projected to when regular_grid is True
+    :param workers: [int] number of processes to spread the chunks over. the
+    results are written to the zarr store as they finish
+    :param chunk_order: [str] 'row' to split the catchments in the order they
+    are in the file or 'hilbert' to first sort them along a hilbert curve so
+    each chunk covers a compact area (and only a small part of the grid)
+    :param batch_size: [int] if given, the catchment layer is streamed
+    batch_size rows at a time instead of read all at once and each batch is
+    its own chunk (num_splits and chunk_order are not used). this bounds the
+    memory by the batch size instead of the size of the layer
+    :param resume: [bool] if True and there is a manifest from an earlier run
+    with the same chunking, skip the chunks that run finished and append only
+    the missing ones
+    :param weight_dtype: [str] 'uint8' or 'uint16' to store the (sparse)
+    weights as quantized integers instead of float32. the quantization errors
+    of all of the chunks are kept in the manifest and in the attrs of the
+    zarr store (see write_quantize_errors)
+    :param s3: [bool] whether out_zarr_store is an s3 path
+    :return: None
+    """
+    if chunk_order not in ('row', 'hilbert'):
+        raise ValueError("chunk_order should be 'row' or 'hilbert'")
+    if regular_grid:
+        lat, lon, grid_no, num_grid_cells = read_regular_grid(grid_file)
+        grid = (lat, lon, grid_no)
+        target_crs = f'epsg:{target_epsg}'
+        sparse = True
+    else:
+        grid = gpd.read_file(grid_file)
+        target_crs = grid.crs
+        num_grid_cells = grid.shape[0]
+    append_dim = nnz_dim if sparse else 'nhd_comid'
+
+    manifest_path = get_manifest_path(out_zarr_store)
+    chunking = {'num_splits': num_splits, 'chunk_order': chunk_order,
+                'batch_size': batch_size, 'sparse': sparse,
+                'weight_dtype': weight_dtype}
+    manifest = read_manifest(manifest_path, s3) if resume else None
+    if manifest:
+        if manifest['chunking'] != chunking:
+            raise ValueError(f'the chunking {chunking} does not match the '
+                             f'chunking in the manifest '
+                             f'{manifest["chunking"]}')
+        if manifest['size']:
+            truncate_zarr(get_zarr_store(out_zarr_store, s3), append_dim,
+                          manifest['size'])
+    else:
+        manifest = {'chunking': chunking, 'done': [], 'size': 0}
+    done_batches = set(manifest['done'])
+    errors = manifest.get('quantize_errors')
+
+    if batch_size:
+        nhd_chunks = read_catchment_batches(polygon_file, layer, batch_size,
+                                            target_crs, done_batches)
+    else:
+        catchment_gdf = gpd.read_file(polygon_file, layer=layer)
+        print("read in all catchments", flush=True)
+        # project catchments into same projection as grid
+        catchment_gdf = catchment_gdf.to_crs(target_crs)
+        print("projected all catchments", flush=True)
+        if chunk_order == 'hilbert':
+            catchment_gdf = sort_catchments_spatially(catchment_gdf)
+        nhd_chunks = split_catchments(catchment_gdf, num_splits, done_batches)
+    all_chunk_wgts = iterate_chunk_weights(nhd_chunks, grid, polygon_id_col,
+                                           sparse, regular_grid, workers)
+    for batch_id, chunk_wgts in all_chunk_wgts:
+        if chunk_wgts.shape[0]:
+            if weight_dtype and is_sparse_weights(chunk_wgts):
+                chunk_wgts, chunk_errors = quantize_triplets(chunk_wgts,
+                                                             weight_dtype)
+                errors = combine_quantize_errors(errors, chunk_errors)
+            save_zarr(chunk_wgts, out_zarr_store,
+                      num_grid_cells=num_grid_cells,
+                      append=manifest['size'] > 0, s3=s3)
+            if errors:
+                write_quantize_errors(get_zarr_store(out_zarr_store, s3),
+                                      errors)
+        manifest['done'].append(batch_id)
+        manifest['size'] += chunk_wgts.shape[0]
+        manifest['quantize_errors'] = errors
+        write_manifest(manifest, manifest_path, s3)
+
+
+def save_zarr(chunk_df, out_zarr, num_grid_cells=nldas_num_grid_cells,
+              append=False, s3=True, weight_dtype=None, chunk_size=1000000):
+    """
+    write a weight matrix chunk to a zarr store. the chunk can either be a
+    dense df (catchments x grid cells) or sparse weight triplets
+    :param chunk_df: [pandas df] dense weight matrix or weight triplets
+    :param out_zarr: [str] path to the output zarr store
+    :param num_grid_cells: [int] total number of grid cells (only used for
+    sparse weights)
+    :param append: [bool] whether to append to an existing store (along
+    'nnz' for sparse weights and 'nhd_comid' for dense weights)
+    :param s3: [bool] whether out_zarr is an s3 path
+    :param weight_dtype: [str] 'uint8' or 'uint16' to store sparse weights as
+    quantized integers with a stored scale factor (see quantize_triplets)
+    :param chunk_size: [int] the zarr chunk size along 'nnz' (only used for
+    sparse weights when the store is made)
+    :return: None
+    """
     col_name = 'nldas_grid_no'
     idx_name = 'nhd_comid'
-    chunks = {col_name: 10000, idx_name: 30000}
-    ds = convert_df_to_dataset(chunk_df, col_name, idx_name, 'weight',
-                               chunks)
+    if is_sparse_weights(chunk_df):
+        if weight_dtype and not is_quantized(chunk_df):
+            chunk_df, _ = quantize_triplets(chunk_df, weight_dtype)
+        ds = triplets_to_dataset(chunk_df, num_grid_cells, chunk_size)
+        append_dim = nnz_dim
+    else:
+        chunks = {col_name: 10000, idx_name: 30000}
+        ds = convert_df_to_dataset(chunk_df, col_name, idx_name, 'weight',
+                                   chunks)
+        append_dim = idx_name
     print(ds)
     print(out_zarr)
-    fs = s3fs.S3FileSystem(profile='ds-drb-creds', anon=False)
-    out_zarr = s3fs.S3Map(out_zarr, s3=fs)
-    ds.to_zarr(out_zarr, mode='w')
+    out_zarr = get_zarr_store(out_zarr, s3)
+    if append:
+        ds = align_chunks_for_append(ds, out_zarr, append_dim)
+        ds.to_zarr(out_zarr, mode='a', append_dim=append_dim)
+    else:
+        ds.to_zarr(out_zarr, mode='w')
 
 
 
@@ -301,36 +802,103 @@ def get_df_list(chunk_folder):
     return df_list
 
 
+def get_chunk_file_cols(chunk_file):
+    """
+    get the (grid cell) column names of a parquet chunk file from its footer
+    without reading any of the data
+    :param chunk_file: [str] path to the parquet file
+    :return: [list] the column names, not including the index column(s)
+    """
+    schema = pq.read_schema(chunk_file)
+    pandas_metadata = schema.pandas_metadata or {}
+    # a RangeIndex is stored as a dict in the metadata, not as a column
+    index_cols = [c for c in pandas_metadata.get('index_columns', [])
+                  if isinstance(c, str)]
+    return [c for c in schema.names if c not in index_cols]
+
+
 def get_cols_from_chunk_folder(chunk_folder):
-    df_list = get_df_list(chunk_folder)
-    cols = get_all_col_or_idx(df_list, 'col')
-    return cols
+    """
+    get a sorted index of all of the unique columns of the parquet chunk files
+    in a folder. only the parquet footers are read
+    :param chunk_folder: [str] path to where the individual files are located
+    :return: [pandas index] unique and sorted columns
+    """
+    all_cols = np.array([], dtype='uint32')
+    for f in get_chunked_files_list(chunk_folder):
+        cols = np.array(get_chunk_file_cols(f)).astype('uint32')
+        all_cols = np.union1d(all_cols, cols)
+    return pd.Index(all_cols)
 
 
-def merge_weight_grid(chunk_folder, all_file_name):
+def read_chunk_file_batches(chunk_file, batch_size=1000):
+    """
+    read a parquet chunk file a batch of rows at a time
+    :param chunk_file: [str] path to the parquet file
+    :param batch_size: [int] the number of rows to read at a time
+    :return: [generator] the batches as pandas dfs
     """
-    read and merge the individual weight grid parquet files
+    parquet_file = pq.ParquetFile(chunk_file)
+    for batch in parquet_file.iter_batches(batch_size=batch_size):
+        yield pa.Table.from_batches([batch]).to_pandas()
+
+
+def merge_weight_grid(chunk_folder, all_file_name,
+                      num_grid_cells=nldas_num_grid_cells, batch_size=1000,
+                      write_size=1000000, weight_dtype=None):
+    """
+    merge the individual uint8 weight grid parquet files into one sparse
+    (triplet) zarr store. the files are streamed batch_size rows at a time and
+    only the non-zero weights are kept, so the memory used does not depend on
+    the number or size of the files
     :param chunk_folder: [str] path to where the individual files are located.
     it is assumed that the files end with "uint8.parquet"
-    :param all_file_name: [str] filename that you want the combined data to be
-    stored in. it assumed that the folder is the same as the one where the
-    individual files are stored
+    :param all_file_name: [str] name of the zarr store that you want the
+    combined data to be stored in. it assumed that the folder is the same as
+    the one where the individual files are stored
+    :param num_grid_cells: [int] total number of grid cells
+    :param batch_size: [int] the number of rows read from a file at a time
+    :param write_size: [int] the number of triplets written to the zarr store
+    at a time. this is also used as the zarr chunk size so that each zarr
+    chunk is written once
+    :param weight_dtype: [str] 'uint8' or 'uint16' to store the weights as
+    quantized integers instead of float32. the quantization errors of all of
+    the batches are stored in the attrs of the zarr store (see
+    write_quantize_errors)
     :return: None
     """
     all_cols = get_cols_from_chunk_folder(chunk_folder)
-    i = 0
-    chunk_files = get_chunked_files_list(chunk_folder)
+    if len(all_cols) and all_cols[-1] >= num_grid_cells:
+        raise ValueError(f'the chunk files have grid cell {all_cols[-1]} but '
+                         f'there are only {num_grid_cells} grid cells')
+    out_zarr = os.path.join(chunk_folder, all_file_name)
+    chunk_files = sorted(get_chunked_files_list(chunk_folder))
+    buffered = []
+    num_buffered = 0
+    num_written = 0
+    errors = None
     for f in chunk_files:
-        d = pd.read_parquet(f)
-        nrows = d.shape[0]
-        num_mini_splits = 20
-        num_per_split = nrows / num_mini_splits
-        for n in range(num_mini_splits):
-            start_chunk = math.floor(num_per_split * n)
-            end_chunk = math.floor(num_per_split * (n + 1))
-            print(f"processing mini-chunk {start_chunk} to {end_chunk}",
-                  flush=True)
-            mini_chunk = d.iloc[start_chunk: end_chunk, :]
-            resized = resize_individual_df_cols(all_cols, mini_chunk)
-            resized = resized/255.
-
+        print('merging ', f, flush=True)
+        for d in read_chunk_file_batches(f, batch_size):
+            triplets = dense_to_triplets(d, scale=255.)
+            if weight_dtype:
+                # quantize each batch whole so no catchment is split up
+                triplets, batch_errors = quantize_triplets(triplets,
+                                                           weight_dtype)
+                errors = combine_quantize_errors(errors, batch_errors)
+            buffered.append(triplets)
+            num_buffered += triplets.shape[0]
+            while num_buffered >= write_size:
+                triplets = pd.concat(buffered, ignore_index=True)
+                save_zarr(triplets.iloc[:write_size], out_zarr,
+                          num_grid_cells, append=num_written > 0, s3=False,
+                          chunk_size=write_size)
+                num_written += write_size
+                buffered = [triplets.iloc[write_size:]]
+                num_buffered = buffered[0].shape[0]
+    if buffered and (num_buffered or not num_written):
+        triplets = pd.concat(buffered, ignore_index=True)
+        save_zarr(triplets, out_zarr, num_grid_cells,
+                  append=num_written > 0, s3=False, chunk_size=write_size)
+    if errors:
+        write_quantize_errors(out_zarr, errors)